@@ -1,373 +1,2701 @@
 import argparse
+import concurrent.futures
+import contextlib
+import http.client
+import threading
 import time
 import copy
+import email.parser
+import functools
 import json
+import multiprocessing
 import os
 import glob
+import hashlib
 import sys
 import urllib
+import urllib.error
+import urllib.parse
 import urllib.request
 import shutil
+import sqlite3
+import tempfile
 import zipfile
+import zlib
 import numpy
-import nibabel
 import tarfile
+import fcntl
+import io
+import lzma
+import random
 import re
-import nrrd
+import resource
+import struct
 import xml.etree.ElementTree as et
 import glob
 #import xmltodict
 from datetime import datetime
 from collections import defaultdict
-from nipype.interfaces.ants import ApplyTransforms
-from nipype.interfaces.ants.base import ANTSCommand, ANTSCommandInputSpec
-from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Str, TraitedSpec, Directory, CommandLineInputSpec, CommandLine, InputMultiPath, isdefined, Bunch, OutputMultiPath
 from pathlib import Path
 
 API_SERVER = "http://api.brain-map.org/"
 API_DATA_PATH = API_SERVER + "api/v2/data/"
+CONNECTIONS_PER_HOST = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# HTTP statuses worth retrying, all other error statuses are permanent.
+TRANSIENT_HTTP_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+NRRD_MAGIC = b"NRRD000"
+MANIFEST_FILENAME = "manifest.jsonl"
+QUERY_FILENAME = "query.json"
+METADATA_INDEX_FILENAME = "metadata_index.sqlite"
+MATRIX_FILENAME = "connectivity.h5"
+STRUCTURE_SUMMARY_FILENAME = "structure_summary.h5"
+STRUCTURE_GRAPH_FILENAME = "structure_graph.json"
+METRICS_FILENAME = "metrics.jsonl"
+PACKAGE_NAME = "ABI-connectivity-data"
+# Modification time of all archive members, for reproducible archives.
+ARCHIVE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+OUTPUT_DTYPES = ('float32', 'uint16', 'int16')
+# Encoding of the registered volumes, see `encode_volume`.
+DEFAULT_ENCODING = {'dtype': 'float32', 'compression_level': 6, 'max_error': None}
+STAMP_FILENAME = ".stamp.json"
+# Version of the conversion, registration and encoding steps, recorded in the processing stamps.
+# Bump it whenever a change to these steps alters the processed volumes, so that they are rebuilt (see `rebuild_reason`).
+PROCESSING_VERSION = 1
+# ioctl to clone a file on copy-on-write filesystems, see ioctl_ficlone(2).
+FICLONE = 0x40049409
+# Memory-backed, so that the intermediate uncompressed NIfTI never touches the disk, if it has room, see `default_scratch_dir`.
+MEMORY_SCRATCH_DIR = "/dev/shm"
+# Scratch directory of the processing functions, None for the system temporary directory.
+SCRATCH_DIR = None
+# Shape of the ABI CCF grid of the 100 micron source volumes, in PIR order, which scales with the resolution.
+ABI_GRID_100UM = (132, 80, 114)
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ABI-connectivity")
+# HTTP response cache, see `set_http_cache`; disabled unless a directory is set.
+HTTP_CACHE_DIR = None
+HTTP_CACHE_SIZE = 50 * 2**30
+OFFLINE = False
+# Shard index and count of this run, see `set_shard`; None processes all experiments.
+SHARD = None
+# Change Orientation from PIR to RAS, as a `nibabel.orientations` transform (target axis and flip of each source axis).
+# Steps: PIR -> RIP -> RPI -> RPS -> RAS, and the first axis is reversed as well. #TODO: Check for Atlas files!!!!!!
+PIR_TO_RAS = numpy.array([[1, -1], [2, -1], [0, -1]])
+TEMPLATE_DIR = "/usr/share/mouse-brain-templates/"
+COMPOSITE_TRANSFORM = "abi2dsurqec_Composite.h5"
 
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+_connections = threading.local()
+_http_cache_lock = threading.Lock()
+_http_cache_used = None
+_metrics_path = None
+_metrics_lock = threading.Lock()
+_measurements = threading.local()
+
+
+def set_api_server(server):
+	"""
+	Point all queries and downloads at a different API server, e.g. a local stand-in for api.brain-map.org.
+
+	Parameters
+	----------
+	server : str
+		Base URL of the server, e.g. "http://localhost:8000/".
+	"""
+	global API_SERVER, API_DATA_PATH
+	if not server.endswith("/"):
+		server += "/"
+	API_SERVER = server
+	API_DATA_PATH = API_SERVER + "api/v2/data/"
+
+
+def parse_shard(value):
+	"""
+	Parse a shard specification of the form `i/N`, with 0 <= i < N, as given to `--shard`.
+
+	Returns
+	-------
+	tuple of int
+		Shard index and shard count.
+	"""
+	try:
+		index, count = (int(part) for part in value.split("/"))
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"`{value}` is not of the form `i/N`.")
+	if not 0 <= index < count:
+		raise argparse.ArgumentTypeError(f"Shard index {index} is not between 0 and {count - 1}.")
+	return index, count
+
+
+def parse_query_criterion(value):
+	"""
+	Parse a metadata index criterion of the form `COLUMN=VALUE`, as given to `--query`.
+
+	Returns
+	-------
+	tuple of str
+		Column, one of `METADATA_INDEX_COLUMNS`, and value.
+	"""
+	column, sep, match = value.partition("=")
+	if not sep:
+		raise argparse.ArgumentTypeError(f"`{value}` is not of the form `COLUMN=VALUE`.")
+	if column not in METADATA_INDEX_COLUMNS:
+		raise argparse.ArgumentTypeError(f"`{column}` is not a metadata index column, choose from: {', '.join(METADATA_INDEX_COLUMNS)}.")
+	return column, match
+
+
+def set_shard(shard):
+	"""
+	Restrict all stages to the experiments of one shard, see `in_shard`, or lift the restriction if None.
+
+	While a shard is set, experiment directories are listed (`list_experiment_dirs`), indexed, downloaded, processed and streamed only for the experiments of the shard.
+	The manifest, query rows and metadata index of a shard are kept in their own files (see `shard_filename`), so that the shards of a build can run at the same time on shared directories.
+
+	Parameters
+	----------
+	shard : tuple of int or None
+		Shard index and shard count, as returned by `parse_shard`.
+	"""
+	global SHARD
+	SHARD = tuple(shard) if shard else None
+
+
+def shard_of(exp, count):
+	"""
+	Return the shard of an experiment among `count` shards.
+
+	The experiment ID is hashed, so that the assignment is the same on every node and neighbouring IDs, which tend to come from the same project, are spread evenly.
+	"""
+	digest = hashlib.sha256(str(int(exp)).encode()).digest()
+	return int.from_bytes(digest[:8], 'big') % count
+
+
+def in_shard(exp):
+	"""
+	Return whether an experiment belongs to the current shard, which every experiment does unless a shard is set.
+	"""
+	return SHARD is None or shard_of(exp, SHARD[1]) == SHARD[0]
+
+
+def shard_filename(filename,
+	shard=None,
+	):
+	"""
+	Return the name of the per-shard version of a file, e.g. `manifest.shard-0-of-4.jsonl`, or `filename` itself if no shard is given or set.
+	"""
+	shard = shard or SHARD
+	if not shard:
+		return filename
+	stem, extension = os.path.splitext(filename)
+	return f"{stem}.shard-{shard[0]}-of-{shard[1]}{extension}"
+
+
+def scratch_bytes(resolution,
+	jobs=1,
+	batch_size=1,
+	):
+	"""
+	Estimate the scratch space taken by processing `jobs` experiments, or batches of `batch_size` experiments, at a time.
+
+	Each experiment in flight holds its converted float32 volume, the uncompressed registered volume and, when batched, its share of the stacked ANTs input and output.
+	"""
+	voxels = numpy.prod([round(size * 100 / (resolution or 100)) for size in ABI_GRID_100UM])
+	return int(jobs * max(batch_size, 1) * 3 * voxels * numpy.dtype(numpy.float32).itemsize)
+
+
+def default_scratch_dir(required):
+	"""
+	Return `MEMORY_SCRATCH_DIR` if it has `required` bytes free, or else the system temporary directory.
+
+	Containers usually mount a small `/dev/shm` (64 MiB under podman and docker), which does not even hold a single 25 micron volume.
+	"""
+	try:
+		if shutil.disk_usage(MEMORY_SCRATCH_DIR).free >= required:
+			return MEMORY_SCRATCH_DIR
+	except OSError:
+		pass
+	return tempfile.gettempdir()
+
+
+def set_metrics_log(path):
+	"""
+	Record all stage measurements (see `measure`) to the JSON-lines file `path`, which is truncated, or stop recording if None.
+	"""
+	global _metrics_path
+	if path:
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		open(path, 'w').close()
+	_metrics_path = path
+
+
+def _thread_io():
+	# Characters read and written by this thread through any file descriptor, including sockets.
+	try:
+		with open("/proc/thread-self/io") as f:
+			fields = dict(line.split(": ") for line in f.read().splitlines())
+		return int(fields['rchar']), int(fields['wchar'])
+	except (OSError, KeyError, ValueError):
+		return 0, 0
+
+
+@contextlib.contextmanager
+def measure(stage,
+	experiment=None,
+	):
+	"""
+	Record wall time, I/O, peak memory and counters of a pipeline stage to the metrics log, if one is set with `set_metrics_log`.
+
+	Measurements nest within a thread: inner ones inherit the experiment of the enclosing one, and `count_metric` adds to all active ones.
+	Each record holds `stage`, `experiment`, `depth` (nesting level), `seconds`, `io_read_bytes` and `io_write_bytes` (of this thread, sockets included), `network_bytes`, `retries`, `peak_rss_bytes` (of this process so far) and `ok`.
+
+	Parameters
+	----------
+	stage : str
+		Name of the stage.
+	experiment : int, optional
+		SectionDataSetID of the experiment the stage works on.
+
+	Yields
+	------
+	dict
+		The record, to which further fields may be added.
+	"""
+	if _metrics_path is None:
+		yield {}
+		return
+	stack = _measurements.__dict__.setdefault('stack', [])
+	if experiment is None and stack:
+		experiment = stack[-1]['experiment']
+	record = {'stage': stage, 'experiment': experiment, 'depth': len(stack), 'network_bytes': 0, 'retries': 0}
+	stack.append(record)
+	read_start, write_start = _thread_io()
+	start = time.perf_counter()
+	record['ok'] = False
+	try:
+		yield record
+		record['ok'] = True
+	finally:
+		stack.pop()
+		record['seconds'] = time.perf_counter() - start
+		read_end, write_end = _thread_io()
+		record['io_read_bytes'] = read_end - read_start
+		record['io_write_bytes'] = write_end - write_start
+		record['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+		line = json.dumps(record) + "\n"
+		with _metrics_lock, open(_metrics_path, 'a') as f:
+			f.write(line)
+
+
+def measured(stage,
+	experiment=None,
+	):
+	"""
+	Decorate a function to `measure` each of its calls as `stage`.
+
+	Parameters
+	----------
+	experiment : callable, optional
+		Called with the arguments of the function to obtain the experiment ID.
+	"""
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with measure(stage, experiment(*args, **kwargs) if experiment else None):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def count_metric(key,
+	amount=1,
+	):
+	"""
+	Add `amount` to the `key` counter of all measurements active in this thread.
+	"""
+	for record in getattr(_measurements, 'stack', ()):
+		record[key] = record.get(key, 0) + amount
+
+
+def experiment_id(experiment_dir):
+	"""
+	Return the SectionDataSetID of a `<safe_name>-<id>` experiment directory, or None.
+	"""
+	try:
+		return int(os.path.basename(os.path.normpath(experiment_dir)).rsplit("-", 1)[-1])
+	except ValueError:
+		return None
+
+
+def summarize_metrics(path,
+	slowest=5,
+	):
+	"""
+	Print per-stage latency percentiles and throughput, and the slowest experiments, from a metrics log.
+
+	Experiment totals add up the outermost measurements only, so that nested stages are not counted twice.
+	"""
+	with open(path) as f:
+		records = [json.loads(line) for line in f if line.strip()]
+	if not records:
+		return
+	stages = defaultdict(list)
+	experiments = defaultdict(float)
+	for record in records:
+		stages[record['stage']].append(record)
+		if record['experiment'] is not None and record['depth'] == 0:
+			experiments[record['experiment']] += record['seconds']
+	print(f"{'stage':<12}{'count':>7}{'failed':>7}{'total s':>10}{'p50 s':>9}{'p95 s':>9}{'net MB/s':>10}{'read MB/s':>11}{'write MB/s':>11}{'retries':>8}")
+	for stage, stage_records in stages.items():
+		seconds = numpy.array([r['seconds'] for r in stage_records])
+		total = seconds.sum()
+		rate = lambda key: sum(r[key] for r in stage_records) / 1e6 / total if total else 0
+		print(
+			f"{stage:<12}{len(stage_records):>7}{sum(not r['ok'] for r in stage_records):>7}{total:>10.1f}"
+			f"{numpy.percentile(seconds, 50):>9.2f}{numpy.percentile(seconds, 95):>9.2f}"
+			f"{rate('network_bytes'):>10.1f}{rate('io_read_bytes'):>11.1f}{rate('io_write_bytes'):>11.1f}"
+			f"{sum(r['retries'] for r in stage_records):>8}"
+			)
+	print(f"Peak RSS: {max(r['peak_rss_bytes'] for r in records) / 2**20:.0f} MiB.")
+	if experiments:
+		print("Slowest experiments:")
+		for experiment, seconds in sorted(experiments.items(), key=lambda item: -item[1])[:slowest]:
+			print(f"\t{experiment}: {seconds:.2f} s")
+
+
+def _host_semaphore(netloc):
+	with _host_semaphores_lock:
+		if netloc not in _host_semaphores:
+			_host_semaphores[netloc] = threading.BoundedSemaphore(CONNECTIONS_PER_HOST)
+		return _host_semaphores[netloc]
+
+
+def _get_connection(scheme, netloc, timeout):
+	"""
+	Return a keep-alive connection to `netloc` owned by the calling thread, and whether it has been used before.
+	"""
+	pool = getattr(_connections, 'pool', None)
+	if pool is None:
+		pool = _connections.pool = {}
+	key = (scheme, netloc)
+	if key in pool:
+		return pool[key], True
+	if scheme == "https":
+		conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+	else:
+		conn = http.client.HTTPConnection(netloc, timeout=timeout)
+	pool[key] = conn
+	return conn, False
+
+
+def _drop_connection(scheme, netloc):
+	conn = _connections.pool.pop((scheme, netloc), None)
+	if conn is not None:
+		conn.close()
+
+
+@contextlib.contextmanager
+def open_url(url,
+	timeout=60,
+	max_redirects=5,
+	headers=None,
+	):
+	"""
+	Issue a GET request over a persistent per-thread connection, following redirects.
+
+	At most `CONNECTIONS_PER_HOST` requests are in flight per host across all threads.
+	The response body must be consumed inside the `with` block; whatever is left is drained so that the connection can be reused.
+
+	Parameters
+	----------
+	url : str
+		URL to fetch.
+	timeout : int, optional
+		Socket timeout in seconds.
+	max_redirects : int, optional
+		Maximum number of redirects to follow.
+	headers : dict, optional
+		Additional request headers.
+
+	Yields
+	------
+	http.client.HTTPResponse
+	"""
+	for redirect in range(max_redirects + 1):
+		parsed = urllib.parse.urlsplit(url)
+		path = parsed.path or "/"
+		if parsed.query:
+			path += "?" + parsed.query
+		semaphore = _host_semaphore(parsed.netloc)
+		semaphore.acquire()
+		try:
+			conn, reused = _get_connection(parsed.scheme, parsed.netloc, timeout)
+			try:
+				conn.request("GET", path, headers=headers or {})
+				response = conn.getresponse()
+			except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+				_drop_connection(parsed.scheme, parsed.netloc)
+				if not reused:
+					raise
+				# The server closed an idle keep-alive connection, retry once on a fresh one.
+				conn, reused = _get_connection(parsed.scheme, parsed.netloc, timeout)
+				conn.request("GET", path, headers=headers or {})
+				response = conn.getresponse()
+			if response.status in (301, 302, 303, 307, 308):
+				response.read()
+				url = urllib.parse.urljoin(url, response.getheader("Location"))
+				continue
+			if response.status >= 400:
+				response.read()
+				raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+			try:
+				yield response
+				response.read()
+			except BaseException:
+				_drop_connection(parsed.scheme, parsed.netloc)
+				raise
+			if response.will_close:
+				_drop_connection(parsed.scheme, parsed.netloc)
+			return
+		except (OSError, http.client.HTTPException):
+			_drop_connection(parsed.scheme, parsed.netloc)
+			raise
+		finally:
+			semaphore.release()
+	raise urllib.error.URLError(f"Too many redirects for `{url}`.")
+
+
+def set_http_cache(cache_dir,
+	max_size=HTTP_CACHE_SIZE,
+	offline=False,
+	):
+	"""
+	Route all API requests and downloads through a content-addressed on-disk HTTP cache, see `fetch_url` and `cached_download`.
+
+	Parameters
+	----------
+	cache_dir : str or None
+		Directory of the cache, None disables it.
+	max_size : int, optional
+		Size in bytes beyond which the least recently used responses are evicted.
+	offline : bool, optional
+		Serve everything from the cache without any network access, failing for responses which are not cached.
+	"""
+	global HTTP_CACHE_DIR, HTTP_CACHE_SIZE, OFFLINE, _http_cache_used
+	HTTP_CACHE_DIR = os.path.expanduser(cache_dir) if cache_dir else None
+	HTTP_CACHE_SIZE = max_size
+	OFFLINE = offline
+	_http_cache_used = None
+	if offline and not HTTP_CACHE_DIR:
+		raise ValueError("Offline mode needs an HTTP cache directory.")
+
+
+def _url_key(url):
+	return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _blob_path(checksum):
+	return os.path.join(HTTP_CACHE_DIR, "objects", checksum[:2], checksum)
+
+
+def _entry_path(url):
+	key = _url_key(url)
+	return os.path.join(HTTP_CACHE_DIR, "urls", key[:2], key + ".json")
+
+
+def _write_entry(entry):
+	path = _entry_path(entry['url'])
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp_path = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(tmp_path, 'w') as f:
+		json.dump(entry, f)
+	os.replace(tmp_path, path)
+
+
+def http_cache_lookup(url):
+	"""
+	Return the cache entry of `url` and mark it as recently used, or None if its content is not cached.
+
+	Entries hold the `url`, the `sha256` and `size` of the response body, the raw response `headers`, its `etag` and `last_modified` validators, and the time it was `fetched` or last revalidated.
+	"""
+	try:
+		with open(_entry_path(url)) as f:
+			entry = json.load(f)
+		# Eviction order is by modification time of the content.
+		os.utime(_blob_path(entry['sha256']))
+	except (OSError, ValueError, KeyError):
+		return None
+	return entry
+
+
+def _cached_headers(entry):
+	return email.parser.Parser(_class=http.client.HTTPMessage).parsestr(entry['headers'], headersonly=True)
+
+
+def _conditional_headers(entry):
+	headers = {}
+	if entry and entry.get('etag'):
+		headers['If-None-Match'] = entry['etag']
+	if entry and entry.get('last_modified'):
+		headers['If-Modified-Since'] = entry['last_modified']
+	return headers
+
+
+def http_cache_store(url, path, headers, checksum):
+	"""
+	Move the complete response body in `path` into the cache, as the response of `url` with SHA256 `checksum`, and evict the least recently used responses beyond `HTTP_CACHE_SIZE`.
+
+	Returns
+	-------
+	str
+		Path to the cached content, which identical responses of other URLs share.
+		It is only ever replaced, never written in place, so hard links to it stay valid.
+	"""
+	global _http_cache_used
+	blob = _blob_path(checksum)
+	size = os.path.getsize(path)
+	os.makedirs(os.path.dirname(blob), exist_ok=True)
+	if os.path.isfile(blob):
+		os.remove(path)
+		size = 0
+	else:
+		os.replace(path, blob)
+	_write_entry({
+		'url': url,
+		'sha256': checksum,
+		'size': os.path.getsize(blob),
+		'headers': str(headers),
+		'etag': headers.get('ETag'),
+		'last_modified': headers.get('Last-Modified'),
+		'fetched': time.time(),
+		})
+	with _http_cache_lock:
+		if _http_cache_used is not None:
+			_http_cache_used += size
+		if _http_cache_used is None or _http_cache_used > HTTP_CACHE_SIZE:
+			_http_cache_used = evict_http_cache(HTTP_CACHE_SIZE, keep=blob)
+	return blob
+
+
+def http_cache_evict(url):
+	"""
+	Delete the cached content of `url`, e.g. once the copy it was downloaded to is deleted, so that the cache does not keep it alive.
+
+	The entry is left in place, and treated as missing by `http_cache_lookup`; other URLs with identical content lose it as well.
+	"""
+	global _http_cache_used
+	try:
+		with open(_entry_path(url)) as f:
+			blob = _blob_path(json.load(f)['sha256'])
+		size = os.path.getsize(blob)
+		os.remove(blob)
+	except (OSError, ValueError, KeyError):
+		return
+	with _http_cache_lock:
+		if _http_cache_used is not None:
+			_http_cache_used -= size
+
+
+def evict_http_cache(max_size,
+	keep=None,
+	):
+	"""
+	Delete the least recently used cached responses until the cache takes at most `max_size` bytes, returning the size left.
+
+	Entries of evicted content are left in place, and treated as missing by `http_cache_lookup`.
+	"""
+	blobs = []
+	for root, _, files in os.walk(os.path.join(HTTP_CACHE_DIR, "objects")):
+		for name in files:
+			path = os.path.join(root, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			blobs.append((stat.st_mtime, stat.st_size, path))
+	used = sum(size for _, size, _ in blobs)
+	for _, size, path in sorted(blobs):
+		if used <= max_size:
+			break
+		if path == keep:
+			continue
+		with contextlib.suppress(OSError):
+			os.remove(path)
+			used -= size
+	return used
+
+
+def fetch_url(url,
+	max_age=0,
+	):
+	"""
+	Return the body of a GET request, through the HTTP cache if one is set.
+
+	Cached responses younger than `max_age` seconds are used as they are, older ones are revalidated with `If-None-Match`/`If-Modified-Since`, and in offline mode cached responses are always used.
+
+	Raises
+	------
+	LookupError
+		In offline mode, if the response is not cached.
+	"""
+	if HTTP_CACHE_DIR is None:
+		with open_url(url) as s:
+			body = s.read()
+		count_metric('network_bytes', len(body))
+		return body
+	entry = http_cache_lookup(url)
+	if entry and not OFFLINE and time.time() - entry['fetched'] >= max_age:
+		with open_url(url, headers=_conditional_headers(entry)) as s:
+			body = s.read()
+			headers = s.headers
+			modified = s.status != 304
+		count_metric('network_bytes', len(body))
+		if modified:
+			entry = None
+		else:
+			entry['fetched'] = time.time()
+			_write_entry(entry)
+	elif not entry:
+		if OFFLINE:
+			raise LookupError(f"`{url}` is not in the HTTP cache, and offline mode is set.")
+		with open_url(url) as s:
+			body = s.read()
+			headers = s.headers
+		count_metric('network_bytes', len(body))
+	if entry:
+		with open(_blob_path(entry['sha256']), 'rb') as f:
+			return f.read()
+	tmp_path = os.path.join(HTTP_CACHE_DIR, "partial", f"{_url_key(url)}.{os.getpid()}.{threading.get_ident()}.tmp")
+	os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+	with open(tmp_path, 'wb') as f:
+		f.write(body)
+	http_cache_store(url, tmp_path, headers, hashlib.sha256(body).hexdigest())
+	return body
+
+
+def cached_download(url, path,
+	validator=None,
+	on_headers=None,
+	magic=None,
+	):
+	"""
+	Download `url` to `path` like `download_with_retry`, through the HTTP cache if one is set.
+
+	Cached responses are revalidated, or used as they are in offline mode.
+	Downloads resume within the cache, and `path` is made a hard link to the cached content where possible, so that it takes no additional space.
+	Across filesystems, `path` is a copy, and the content takes its space twice until it is evicted, see `http_cache_evict`.
+
+	Raises
+	------
+	LookupError
+		In offline mode, if the response is not cached.
+	"""
+	if HTTP_CACHE_DIR is None:
+		return download_with_retry(url, path, validator=validator, on_headers=on_headers, magic=magic)
+	entry = http_cache_lookup(url)
+	if entry is None and OFFLINE:
+		raise LookupError(f"`{url}` is not in the HTTP cache, and offline mode is set.")
+	if entry is None or not OFFLINE:
+		partial_path = os.path.join(HTTP_CACHE_DIR, "partial", _url_key(url) + ".part")
+		os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+		headers, checksum = download_with_retry(url, partial_path, validator=validator, on_headers=on_headers, magic=magic, headers=_conditional_headers(entry))
+		if checksum is None:
+			entry['fetched'] = time.time()
+			_write_entry(entry)
+		else:
+			entry = None
+			blob = http_cache_store(url, partial_path, headers, checksum)
+	if entry is not None:
+		print(f"Using cached {url}.")
+		headers, checksum = _cached_headers(entry), entry['sha256']
+		blob = _blob_path(checksum)
+		if on_headers:
+			on_headers(headers)
+	materialize(blob, path, link_mode='hardlink')
+	return headers, checksum
+
+
+def is_transient(error):
+	"""
+	Return whether a failed request is worth retrying: connection problems, timeouts, truncated responses and the `TRANSIENT_HTTP_STATUSES`.
+	"""
+	if isinstance(error, urllib.error.HTTPError):
+		return error.code in TRANSIENT_HTTP_STATUSES
+	return isinstance(error, (OSError, http.client.HTTPException))
+
+
+def backoff_delay(attempt,
+	backoff=1,
+	max_backoff=60,
+	error=None,
+	):
+	"""
+	Return the seconds to wait before retry number `attempt` (from 0): exponential backoff with full jitter, or the `Retry-After` the server asked for.
+	"""
+	retry_after = getattr(error, 'headers', None) and error.headers.get('Retry-After')
+	if retry_after and retry_after.isdigit():
+		return min(int(retry_after), max_backoff)
+	return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+@measured('query_page')
+def query_page(url,
+	max_age=0,
+	max_retries=5,
+	backoff=1,
+	):
+	"""
+	Fetch one page of an API JSON query, retrying transient failures with exponential backoff.
+
+	Parameters
+	----------
+	url : str
+		Query URL.
+	max_age : float, optional
+		Seconds for which a response in the HTTP cache is reused without revalidating it, see `fetch_url`.
+	max_retries : int, optional
+		Number of attempts before giving up.
+	backoff : float, optional
+		Seconds of the first backoff, see `backoff_delay`.
+
+	Returns
+	-------
+	dict
+		The decoded response.
+	"""
+	retries = 0
+	while True:
+		try:
+			response = json.loads(fetch_url(url, max_age=max_age))
+			if not response.get('success', True):
+				raise ValueError(f"Query not successful: {response.get('msg')}")
+			return response
+		except (OSError, http.client.HTTPException, ValueError) as e:
+			retries += 1
+			if retries >= max_retries or not (is_transient(e) or isinstance(e, ValueError)):
+				raise
+			count_metric('retries')
+			print(f"\tquery failed ({e}), retrying ({retries}/{max_retries})...")
+			time.sleep(backoff_delay(retries - 1, backoff, error=e))
+
+
+@measured('query')
 def get_exp_id(
 	startRow=0,
 	numRows=2000,
 	totalRows=-1,
+	rows_path=None,
+	jobs=1,
+	cache_ttl=0,
+	):
+	"""
+	Queries the Allen Mouse Brain Institute website for all gene expression data available for download.
+
+	Returns:
+	--------
+	GeneNames: list[dict()]
+		list of all genes where expression data is available for download. Dict contains experiment/gene metadata.
+
+	SectionDataSetID : list(int)
+		corresponding SectionDataSetID (SectionDataSet: see "http://help.brain-map.org/display/api/Data+Model")
+		ID needed to specify download target.
+
+	If `rows_path` is given, the full query response rows (including specimen and injection metadata) are saved there as JSON, see `load_exp_rows`.
+
+	The first page reports the total number of rows, the remaining pages are then fetched `jobs` at a time and merged in order.
+	Pages in the HTTP cache are reused without revalidation for `cache_ttl` seconds, see `query_page`.
+
+	"""
+
+	def paged_url(startRow):
+		r = "&start_row={0}&num_rows={1}".format(startRow,numRows)
+		return API_DATA_PATH + "query.json?criteria=model::SectionDataSet,rma::criteria,products%5Bid$eq5%5D,rma::include,specimen(stereotaxic_injections(primary_injection_structure,structures))" + r
+
+	info = list()
+	response = query_page(paged_url(startRow), max_age=cache_ttl)
+	rows = list(response['msg'])
+	if totalRows < 0:
+		totalRows = int(response['total_rows'])
+	# The server may cap the page size below `numRows`.
+	page_size = len(response['msg'])
+	if page_size:
+		starts = range(startRow + page_size, totalRows, page_size)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+			pages = executor.map(lambda start: query_page(paged_url(start), max_age=cache_ttl), starts)
+			for page in pages:
+				rows += page['msg']
+	for x in rows:
+		if x['failed'] == False :
+			info.append(x['id'])
+
+	if rows_path:
+		tmp_path = rows_path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump(rows, f)
+		os.replace(tmp_path, rows_path)
+
+	return info
+
+
+def load_exp_rows(rows_path):
+	"""
+	Load the query rows saved by `get_exp_id`.
+
+	Returns
+	-------
+	dict
+		Query row of each experiment, keyed by SectionDataSetID.
+	"""
+	with open(rows_path) as f:
+		rows = json.load(f)
+	return {row['id']: row for row in rows}
+
+
+# NumPy type codes of the NRRD types, by all the names the NRRD format allows for them.
+NRRD_TYPES = {
+	'i1': ('signed char', 'int8', 'int8_t'),
+	'u1': ('uchar', 'unsigned char', 'uint8', 'uint8_t'),
+	'i2': ('short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'),
+	'u2': ('ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'),
+	'i4': ('int', 'signed int', 'int32', 'int32_t'),
+	'u4': ('uint', 'unsigned int', 'uint32', 'uint32_t'),
+	'i8': ('longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64', 'int64_t'),
+	'u8': ('ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'),
+	'f4': ('float',),
+	'f8': ('double',),
+	}
+NRRD_TYPECODES = {name: code for code, names in NRRD_TYPES.items() for name in names}
+
+def nrrd_dtype(header):
+	"""
+	Return the NumPy dtype of the raw data of an NRRD file from its `type` and `endian` header fields, or None if the type has no such equivalent (e.g. `block`).
+	"""
+	code = NRRD_TYPECODES.get(header.get('type'))
+	if code is None:
+		return None
+	dtype = numpy.dtype(code)
+	if dtype.itemsize > 1:
+		byteorder = {'little': '<', 'big': '>'}.get(header.get('endian'))
+		if byteorder is None:
+			raise ValueError(f"Invalid or missing NRRD endian field: {header.get('endian')!r}.")
+		dtype = dtype.newbyteorder(byteorder)
+	return dtype
+
+def read_nrrd(file):
+	"""
+	Read an NRRD file, memory-mapping the data if it is stored raw in the same file.
+
+	Returns
+	-------
+	data : numpy.ndarray
+		Data in Fortran order, as returned by `nrrd.read`.
+	header : dict
+	"""
+	import nrrd
+	with open(file, 'rb') as fh:
+		header = nrrd.read_header(fh)
+		dtype = nrrd_dtype(header) if header.get('encoding') == 'raw' else None
+		mappable = (
+			dtype is not None
+			and 'data file' not in header
+			and 'datafile' not in header
+			and not header.get('line skip')
+			and not header.get('byte skip')
+			)
+		if not mappable:
+			return nrrd.read_data(header, fh, file), header
+		offset = fh.tell()
+	data = numpy.memmap(file, dtype=dtype, mode='r', offset=offset, shape=tuple(header['sizes']), order='F')
+	return data, header
+
+def nrrd_to_image(file):
+	"""
+	Read an ABI NRRD volume and reorient it from PIR to RAS.
+
+	The reorientation only creates a view, so no copy of the data is made (and memory-mapped data is not read) before the image is saved.
+
+	Returns
+	-------
+	nibabel.Nifti1Image
+	"""
+	import nibabel.orientations
+	print(f"Reading `{file}`.")
+	data, header = read_nrrd(file)
+	print(f"Converting `{file}`.")
+
+	affine_matrix = numpy.eye(4)
+	affine_matrix[:3,:3] = numpy.array(header["space directions"],dtype=float)*0.001
+
+	data = nibabel.orientations.apply_orientation(data, PIR_TO_RAS)
+	img = nibabel.Nifti1Image(data,affine_matrix)
+	return img
+
+@measured('convert')
+def nrrd_to_nifti(file,
+	target_dir=False,
+	):
+	import nibabel
+	img = nrrd_to_image(file)
+	target_dir = os.path.abspath(os.path.expanduser(target_dir))
+	os.makedirs(target_dir, exist_ok=True)
+	nii_path = os.path.join(target_dir, os.path.basename(file).split(".")[0] + '.nii')
+	nibabel.save(img,nii_path)
+
+	return nii_path
+
+# Index columns extracted from the experiment XML, as (parent tag, tag) of their first occurrence.
+METADATA_FIELDS = {
+	'seed_acronym': ('primary-injection-structure', 'acronym'),
+	'safe_name': ('primary-injection-structure', 'safe-name'),
+	'injection_method': ('stereotaxic-injection', 'injection-method'),
+	'injection_quality': ('stereotaxic-injection', 'injection-quality'),
+	'specimen_name': ('specimen', 'name'),
+	}
+METADATA_INDEX_COLUMNS = ('directory', 'id', 'cre_line', 'xml_path', 'data_path') + tuple(METADATA_FIELDS)
+
+def get_cre_line(specimen_name):
+	"""
+	Return the acronym of the Cre line a specimen name refers to, or None if it lists no Cre selector.
+	"""
+	# !!! Some files don't have Cre selectors listed, why?
+	if not specimen_name or not "Cre" in specimen_name:
+		return None
+	m = re.match("(?P<expression_acronym>.+?)-(IRES-)?Cre.*", specimen_name)
+	if not m:
+		return None
+	return m.groupdict()['expression_acronym'].replace("-", "")
+
+def parse_experiment_metadata(metadata):
+	"""
+	Extract the indexed fields from an experiment XML metadata file in a single streaming pass.
+
+	Parsing stops as soon as all fields have been seen; fields which are missing from the file are missing from the returned dictionary.
+
+	Parameters
+	----------
+	metadata : str
+		Path to the XML metadata file.
+
+	Returns
+	-------
+	dict
+		The first `id` of the document, the `METADATA_FIELDS` and the derived `cre_line`.
+	"""
+	fields = {}
+	stack = []
+	wanted = len(METADATA_FIELDS) + 1
+	for event, element in et.iterparse(metadata, events=('start', 'end')):
+		if event == 'start':
+			stack.append(element.tag)
+			continue
+		tag = stack.pop()
+		if tag == 'id':
+			fields.setdefault('id', element.text)
+		elif stack:
+			for column, (parent, child) in METADATA_FIELDS.items():
+				if tag == child and stack[-1] == parent:
+					fields.setdefault(column, element.text)
+		element.clear()
+		if len(fields) == wanted:
+			break
+	fields['cre_line'] = get_cre_line(fields.get('specimen_name'))
+	return fields
+
+def get_identifying_structure(metadata):
+	return parse_experiment_metadata(metadata)['safe_name']
+
+def _experiment_files(experiment_dir):
+	xml_data = glob.glob(os.path.join(experiment_dir, "*.xml"))
+	data = glob.glob(os.path.join(experiment_dir, "*.nrrd")) + glob.glob(os.path.join(experiment_dir, "*.nii.gz"))
+	return (
+		xml_data[0] if len(xml_data) == 1 else None,
+		data[0] if len(data) == 1 else None,
+		)
+
+def experiment_metadata_row(experiment_dir,
+	xml_data=None,
+	data=None,
+	):
+	"""
+	Return the metadata index row of a single experiment directory, as stored by `build_metadata_index`.
+
+	The XML metadata and volume files are looked up unless given.
+	"""
+	if xml_data is None and data is None:
+		xml_data, data = _experiment_files(experiment_dir)
+	fields = parse_experiment_metadata(xml_data) if xml_data else {'cre_line': None}
+	row = {
+		'directory': os.path.basename(os.path.normpath(experiment_dir)),
+		'id': fields.get('id'),
+		'cre_line': fields['cre_line'],
+		'xml_path': xml_data,
+		'data_path': data,
+		}
+	row.update({column: fields.get(column) for column in METADATA_FIELDS})
+	return row
+
+def list_experiment_dirs(data_dir):
+	"""
+	Return the names of the experiment directories in `data_dir`, sorted, leaving out those of other shards.
+	"""
+	directories = []
+	for directory in sorted(os.listdir(data_dir)):
+		experiment_dir = os.path.join(data_dir, directory)
+		if not os.path.isdir(experiment_dir):
+			continue
+		exp = experiment_id(experiment_dir)
+		if exp is not None and not in_shard(exp):
+			continue
+		directories.append(directory)
+	return directories
+
+def build_metadata_index(data_dir,
+	index_path=None,
+	):
+	"""
+	Create or refresh an SQLite index of the experiment metadata in a data directory.
+
+	Only experiments whose XML file is new or changed (by size and modification time) since the last refresh are parsed, and rows of removed experiment directories are dropped.
+	The `xml_path` and `data_path` (NRRD or NIfTI volume) columns are NULL unless the experiment directory holds exactly one such file.
+
+	Parameters
+	----------
+	data_dir : str
+		Directory containing one directory per experiment.
+	index_path : str, optional
+		Path of the index, defaults to `METADATA_INDEX_FILENAME` inside `data_dir`, or its per-shard version (see `shard_filename`).
+
+	Returns
+	-------
+	str
+		Path of the index.
+	"""
+	if not index_path:
+		index_path = os.path.join(data_dir, shard_filename(METADATA_INDEX_FILENAME))
+	db = sqlite3.connect(index_path)
+	try:
+		with db:
+			db.execute(f"""CREATE TABLE IF NOT EXISTS experiments (
+				directory TEXT PRIMARY KEY,
+				id INTEGER,
+				cre_line TEXT,
+				xml_path TEXT,
+				data_path TEXT,
+				{', '.join(f'{column} TEXT' for column in METADATA_FIELDS)},
+				xml_mtime_ns INTEGER,
+				xml_size INTEGER
+				)""")
+			db.execute("CREATE INDEX IF NOT EXISTS experiments_seed ON experiments (seed_acronym)")
+			known = {row[0]: row[1:] for row in db.execute("SELECT directory, xml_mtime_ns, xml_size, data_path FROM experiments")}
+			seen = set()
+			for directory in list_experiment_dirs(data_dir):
+				experiment_dir = os.path.join(data_dir, directory)
+				xml_data, data = _experiment_files(experiment_dir)
+				seen.add(directory)
+				stat = os.stat(xml_data) if xml_data else None
+				if stat and known.get(directory) == (stat.st_mtime_ns, stat.st_size, data):
+					continue
+				row = experiment_metadata_row(experiment_dir, xml_data, data)
+				row.update({'xml_mtime_ns': stat and stat.st_mtime_ns, 'xml_size': stat and stat.st_size})
+				db.execute(
+					f"INSERT OR REPLACE INTO experiments ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+					tuple(row.values()),
+					)
+			for directory in set(known) - seen:
+				db.execute("DELETE FROM experiments WHERE directory = ?", (directory,))
+	finally:
+		db.close()
+	return index_path
+
+def query_metadata_index(index_path, **criteria):
+	"""
+	Return the indexed experiments matching all given column values, ordered by directory.
+
+	Parameters
+	----------
+	index_path : str
+		Path of an index created by `build_metadata_index`.
+	**criteria
+		Column values to match, e.g. `seed_acronym='CP'` or `cre_line=None` for experiments without a Cre line.
+
+	Returns
+	-------
+	list of dict
+		One dictionary per experiment, keyed by `METADATA_INDEX_COLUMNS`.
+
+	Examples
+	--------
+	All Cre lines injected into the caudoputamen:
+
+	>>> {row['cre_line'] for row in query_metadata_index(index_path, seed_acronym='CP')}
+	"""
+	unknown = set(criteria) - set(METADATA_INDEX_COLUMNS)
+	if unknown:
+		raise ValueError(f"Unknown metadata index columns: {', '.join(sorted(unknown))}.")
+	clauses = [f"{column} IS ?" for column in criteria]
+	where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+	db = sqlite3.connect(index_path)
+	db.row_factory = sqlite3.Row
+	try:
+		rows = db.execute(
+			f"SELECT {', '.join(METADATA_INDEX_COLUMNS)} FROM experiments {where} ORDER BY directory",
+			tuple(criteria.values()),
+			).fetchall()
+	finally:
+		db.close()
+	return [dict(row) for row in rows]
+
+def get_safe_name(row):
+	"""
+	Return the safe name of the primary injection structure from a query row, as `get_identifying_structure` does from the XML metadata.
+	"""
+	return row['specimen']['stereotaxic_injections'][0]['primary_injection_structure']['safe_name']
+
+def _metadata_element(parent, key, value):
+	tag = key.replace("_", "-")
+	if isinstance(value, dict):
+		element = et.SubElement(parent, tag)
+		# Scalars first and nested records last, as in the API's XML responses.
+		for k in sorted(value, key=lambda k: (isinstance(value[k], (dict, list)), k)):
+			_metadata_element(element, k, value[k])
+	elif isinstance(value, list):
+		element = et.SubElement(parent, tag, type="array")
+		for v in value:
+			_metadata_element(element, key[:-1] if key.endswith("s") else key, v)
+	elif value is None:
+		et.SubElement(parent, tag, nil="true")
+	elif isinstance(value, bool):
+		et.SubElement(parent, tag).text = str(value).lower()
+	else:
+		et.SubElement(parent, tag).text = str(value)
+
+def write_exp_metadata(row, path):
+	"""
+	Write the query row of an experiment as XML metadata file, in the layout of the `SectionDataSet/query.xml` response which `get_exp_metadata` downloads.
+
+	Returns
+	-------
+	str
+		Path to the metadata file.
+	"""
+	root = et.Element("Response", success="true", start_row="0", num_rows="1", total_rows="1")
+	section_data_sets = et.SubElement(root, "section-data-sets")
+	_metadata_element(section_data_sets, "section_data_set", row)
+	et.indent(root)
+	path_to_metadata = os.path.join(path, str(row['id']) + "_experiment_metadata.xml")
+	et.ElementTree(root).write(path_to_metadata, encoding="UTF-8")
+	return path_to_metadata
+
+def get_exp_metadata(exp,path):
+	url_meta = API_DATA_PATH + "/SectionDataSet/query.xml?id=" + str(exp) + "&include=specimen(stereotaxic_injections(primary_injection_structure,structures))"
+	filename = str(exp) + "_experiment_metadata.xml"
+	contents = fetch_url(url_meta)
+	path_to_metadata = os.path.join(path,filename)
+	file = open(path_to_metadata, 'wb')
+	file.write(contents)
+	file.close()
+
+	return path_to_metadata
+
+
+def load_manifest(manifest_path):
+	"""
+	Read the sourcedata manifest, a JSON-lines log of per-experiment download records.
+
+	Later records for an experiment supersede earlier ones.
+
+	Returns
+	-------
+	dict
+		Latest record per experiment, keyed by experiment ID string.
+	"""
+	manifest = {}
+	if not os.path.isfile(manifest_path):
+		return manifest
+	with open(manifest_path) as f:
+		for line in f:
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				entry = json.loads(line)
+			except json.JSONDecodeError:
+				# Truncated last line from an interrupted run.
+				continue
+			manifest[str(entry['id'])] = entry
+	return manifest
+
+
+def save_manifest(manifest, manifest_path):
+	"""
+	Atomically rewrite the manifest with one record per experiment.
+	"""
+	tmp_path = manifest_path + ".tmp"
+	with open(tmp_path, 'w') as f:
+		for key in sorted(manifest, key=int):
+			f.write(json.dumps(manifest[key]) + "\n")
+	os.replace(tmp_path, manifest_path)
+
+
+@contextlib.contextmanager
+def manifest_recorder(dir_name):
+	"""
+	Open the manifest in `dir_name` for appending, yielding the current records and a thread-safe function to log an updated record.
+
+	The log is compacted on entry and on exit.
+	If a shard is set (see `set_shard`), the shard has a manifest of its own, which starts out with the shard's records of the full manifest.
+	"""
+	manifest_path = os.path.join(dir_name, shard_filename(MANIFEST_FILENAME))
+	manifest = load_manifest(manifest_path)
+	if SHARD and not os.path.isfile(manifest_path):
+		manifest = {key: entry for key, entry in load_manifest(os.path.join(dir_name, MANIFEST_FILENAME)).items() if in_shard(key)}
+	# Compact the log left behind by the previous run.
+	save_manifest(manifest, manifest_path)
+	manifest_lock = threading.Lock()
+	manifest_file = open(manifest_path, 'a')
+
+	def record(entry):
+		with manifest_lock:
+			manifest[str(entry['id'])] = entry
+			manifest_file.write(json.dumps(entry) + "\n")
+			manifest_file.flush()
+
+	try:
+		yield manifest, record
+	finally:
+		manifest_file.close()
+		save_manifest(manifest, manifest_path)
+
+
+def find_experiment_dir(exp, dir_name):
+	"""
+	Return the existing directory of an experiment under `dir_name`, renamed (`<safe_name>-<id>`) or not (`<id>`), or None.
+	"""
+	candidates = glob.glob(os.path.join(dir_name, f"*-{exp}"))
+	candidates = [c for c in candidates if os.path.isdir(c)]
+	if candidates:
+		return candidates[0]
+	path_to_exp = os.path.join(dir_name, str(exp))
+	if os.path.isdir(path_to_exp):
+		return path_to_exp
+	return None
+
+
+@measured('download', lambda exp, *args, **kwargs: exp)
+def get_experiment_sourcedata(exp, dir_name,
+	resolution=100,
+	entry=None,
+	record=None,
+	row=None,
+	):
+	"""
+	Download metadata and projection density volume for a single experiment into `<safe_name>-<id>/` under `dir_name`.
+
+	Whatever is already present from earlier runs is reused: complete experiments are skipped, and partially downloaded volumes are resumed.
+
+	Parameters
+	----------
+	exp : int
+		SectionDataSetID of the experiment.
+	dir_name : str
+		Directory in which the experiment directory is created.
+	resolution : int, optional
+		Resolution of the projection density volume, in microns.
+	entry : dict, optional
+		Manifest record of this experiment from a previous run.
+	record : callable, optional
+		Called with the updated manifest record whenever the download state changes.
+	row : dict, optional
+		Query row of the experiment from `get_exp_id`.
+		If given, the metadata file is written from it instead of being downloaded.
+
+	Returns
+	-------
+	str
+		Path to the experiment directory.
+	"""
+
+	resolution_url = "?image=projection_density&resolution=" + str(resolution)
+	url = API_SERVER + "grid_data/download_file/" + str(exp) + resolution_url
+	if entry and entry.get('status') == 'complete' and entry.get('url') == url:
+		path_to_exp = os.path.join(dir_name, entry['directory'])
+		file_path_nrrd = os.path.join(path_to_exp, entry['filename'])
+		path_to_metadata = os.path.join(path_to_exp, entry['metadata'])
+		if os.path.isfile(path_to_metadata) and os.path.isfile(file_path_nrrd) and os.path.getsize(file_path_nrrd) == entry['size']:
+			print(f"Experiment {exp} already downloaded, skipping.")
+			return path_to_exp
+
+	path_to_exp = find_experiment_dir(exp, dir_name)
+	if path_to_exp is None:
+		path_to_exp = os.path.join(dir_name,str(exp))
+		os.mkdir(path_to_exp)
+	#TODO: so far no coordinate info.
+	path_to_metadata = os.path.join(path_to_exp, str(exp) + "_experiment_metadata.xml")
+	if row is not None:
+		if not os.path.isfile(path_to_metadata):
+			path_to_metadata = write_exp_metadata(row, path_to_exp)
+		struc_name = get_safe_name(row)
+	else:
+		try:
+			struc_name=get_identifying_structure(path_to_metadata)
+		except (OSError, et.ParseError, KeyError):
+			path_to_metadata = get_exp_metadata(exp,path_to_exp)
+			struc_name=get_identifying_structure(path_to_metadata)
+	struc_name = struc_name.lower()
+	struc_name= re.sub(" ","_",struc_name)
+	struc_name=re.sub("[()]","",struc_name)
+	new_name = struc_name + "-" + str(exp)
+	new_path = os.path.join(dir_name,new_name)
+	if path_to_exp != new_path:
+		os.rename(path_to_exp,new_path)
+	entry = dict(entry or {}, id=exp, url=url, directory=new_name, metadata=os.path.basename(path_to_metadata))
+	if entry.get('status') == 'complete':
+		# Files went missing or changed since the manifest was written, start over.
+		entry['status'] = 'downloading'
+	# Trying higher timout to avoid spontaneous drop, unit is seconds
+	# Last failed at:
+	# http://api.brain-map.org/grid_data/download_file/165975096?image=projection_density&resolution=100
+	part_path = os.path.join(new_path, str(exp) + "_projection_density.nrrd.part")
+
+	def on_headers(headers):
+		entry.update(
+			status='downloading',
+			etag=headers.get('ETag'),
+			last_modified=headers.get('Last-Modified'),
+			)
+		if record:
+			record(dict(entry))
+
+	validator = entry.get('etag') or entry.get('last_modified')
+	headers, checksum = cached_download(url, part_path, validator=validator, on_headers=on_headers, magic=NRRD_MAGIC)
+	filename = os.path.basename(headers.get_filename() or f"{exp}_projection_density.nrrd")
+	file_path_nrrd = os.path.join(new_path,filename)
+	os.replace(part_path, file_path_nrrd)
+	entry.update(
+		status='complete',
+		filename=filename,
+		size=os.path.getsize(file_path_nrrd),
+		sha256=checksum,
+		)
+	if record:
+		record(dict(entry))
+
+	return new_path
+
+
+def get_sourcedata(info, dir_name,
+	resolution=100,
+	jobs=1,
+	rows=None,
+	retry_passes=1,
+	):
+	"""
+	Download metadata and projection density volumes for all given experiments.
+
+	Progress is recorded in a manifest (`MANIFEST_FILENAME` in `dir_name`), so that repeated runs only fetch experiments which are new or incomplete.
+	A failing experiment is recorded as failed in the manifest and does not abort the others; failed experiments are retried once all others are done.
+
+	Parameters:
+	-----------
+	info : list(int)
+		list of SectionDataSetID to download.
+	dir_name : str
+		Directory in which the `<safe_name>-<id>/` experiment directories are created.
+	resolution : int, optional
+		Resolution of the projection density volume, in microns.
+	jobs : int, optional
+		Number of experiments to download concurrently.
+		Requests to any one host are additionally bounded by `CONNECTIONS_PER_HOST`.
+	rows : dict, optional
+		Query rows keyed by SectionDataSetID, as returned by `load_exp_rows`.
+		Metadata of experiments with a row is written from it rather than requested one experiment at a time.
+	retry_passes : int, optional
+		Number of times the failed experiments are retried after the first pass.
+
+	Returns
+	-------
+	dict
+		Exceptions of experiments which still failed after the retry passes, keyed by SectionDataSetID.
+	"""
+	if rows is None:
+		rows = {}
+	info = [exp for exp in info if in_shard(exp)]
+
+	failures = {}
+	with manifest_recorder(dir_name) as (manifest, record):
+		pending = list(info)
+		for attempt in range(retry_passes + 1):
+			if attempt and pending:
+				print(f"Retrying {len(pending)} failed experiments ({attempt}/{retry_passes})...")
+			failures = {}
+			with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+				futures = {executor.submit(get_experiment_sourcedata, exp, dir_name, resolution, manifest.get(str(exp)), record, rows.get(exp)): exp for exp in pending}
+				try:
+					for future in concurrent.futures.as_completed(futures):
+						exp = futures[future]
+						try:
+							future.result()
+						except Exception as e:
+							print(f"\t❌downloading experiment {exp} failed: {e}")
+							failures[exp] = e
+							record(dict(manifest.get(str(exp)) or {'id': exp}, status='failed', error=str(e)))
+				except BaseException:
+					for f in futures:
+						f.cancel()
+					raise
+			pending = sorted(failures)
+			if not pending:
+				break
+
+	if failures:
+		print(f"Downloading failed for {len(failures)} of {len(info)} experiments:")
+		for exp in sorted(failures):
+			print(f"\t{exp}")
+	return failures
+
+
+def _expected_size(response):
+	# Total size of the resource, from Content-Range for partial responses.
+	if response.status == 206:
+		total = (response.headers.get('Content-Range') or "").rpartition("/")[2]
+		return int(total) if total.isdigit() else None
+	length = response.headers.get('Content-Length')
+	return int(length) if length and length.isdigit() else None
+
+
+def _download(url, path,
+	validator=None,
+	on_headers=None,
+	magic=None,
+	headers=None,
+	):
+	offset = os.path.getsize(path) if os.path.isfile(path) else 0
+	headers = dict(headers or {})
+	if offset:
+		headers['Range'] = f"bytes={offset}-"
+		if validator:
+			headers['If-Range'] = validator
+	checksum = hashlib.sha256()
+	try:
+		with open_url(url, headers=headers) as s:
+			if s.status == 304:
+				return s.headers, None
+			if offset and s.status == 206:
+				print(f"\tresuming at byte {offset}.")
+				with open(path, 'rb') as f:
+					for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+						checksum.update(chunk)
+				mode = 'ab'
+			else:
+				mode = 'wb'
+			if on_headers:
+				on_headers(s.headers)
+			expected = _expected_size(s)
+			with open(path, mode) as f:
+				for chunk in iter(lambda: s.read(DOWNLOAD_CHUNK_SIZE), b''):
+					count_metric('network_bytes', len(chunk))
+					checksum.update(chunk)
+					f.write(chunk)
+			response_headers = s.headers
+	except urllib.error.HTTPError as e:
+		if e.code != 416:
+			raise
+		# Requested range not satisfiable, the partial file is unusable.
+		os.remove(path)
+		return _download(url, path, on_headers=on_headers, magic=magic, headers={k: v for k, v in headers.items() if k not in ('Range', 'If-Range')})
+
+	size = os.path.getsize(path)
+	if expected is not None and size < expected:
+		# Kept for resuming on the next attempt.
+		raise http.client.IncompleteRead(b'', expected - size)
+	if expected is not None and size > expected:
+		os.remove(path)
+		raise ValueError(f"`{url}` returned {size} bytes, {expected} expected.")
+	if magic:
+		with open(path, 'rb') as f:
+			start = f.read(len(magic))
+		if start != magic:
+			os.remove(path)
+			raise ValueError(f"`{url}` did not return the expected file type, it starts with {start!r}.")
+	return response_headers, checksum.hexdigest()
+
+
+def download_with_retry(url, path,
+	max_retries=5,
+	backoff=1,
+	validator=None,
+	on_headers=None,
+	magic=None,
+	headers=None,
+	):
+	"""
+	Download `url` to `path`, resuming from the bytes already present in `path`.
+
+	Transient failures (see `is_transient`) are retried with exponential backoff and jitter, resuming where the previous attempt stopped.
+	Permanent failures, such as a 404 status or a response which fails validation, are raised right away.
+
+	Parameters
+	----------
+	url : str
+		URL to download.
+	path : str
+		Path of the (partial) file to write.
+	max_retries : int, optional
+		Number of attempts before giving up.
+	backoff : float, optional
+		Seconds of the first backoff, see `backoff_delay`.
+	validator : str, optional
+		ETag or Last-Modified value of the partial file, sent as `If-Range` so that a changed upstream file is downloaded afresh.
+	on_headers : callable, optional
+		Called with the response headers before the body is written.
+	magic : bytes, optional
+		Bytes the complete file must start with, e.g. `NRRD_MAGIC`.
+	headers : dict, optional
+		Additional request headers, e.g. conditional ones.
+
+	Returns
+	-------
+	headers : http.client.HTTPMessage
+		Headers of the last response.
+	checksum : str or None
+		SHA256 hex digest of the complete file, or None if the server answered `304 Not Modified` to conditional `headers`.
+
+	Raises
+	------
+	urllib.error.HTTPError, OSError, http.client.HTTPException
+		If the download failed permanently, or on the last attempt.
+	ValueError
+		If the complete file is larger than announced or does not start with `magic`.
+	"""
+	print(f"Trying to download {url}.")
+	for attempt in range(max_retries):
+		try:
+			fh = _download(url, path, validator=validator, on_headers=on_headers, magic=magic, headers=headers)
+			print(f"\t✔️ {'not modified' if fh[1] is None else 'downloaded'}.")
+			return fh
+		except (OSError, http.client.HTTPException) as e:
+			if not is_transient(e) or attempt + 1 == max_retries:
+				print(f"\t❌download failed: {e}")
+				raise
+			delay = backoff_delay(attempt, backoff, error=e)
+			print(f"\t{e or type(e).__name__}, retrying in {delay:.1f} s ({attempt + 1}/{max_retries})...")
+			count_metric('retries')
+			time.sleep(delay)
+		except ValueError as e:
+			print(f"\t❌download failed: {e}")
+			raise
+
+
+def _file_record(path,
+	previous=None,
+	):
+	stat = os.stat(path)
+	if previous and previous.get('path') == path and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+		return previous
+	return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(path)}
+
+def experiment_inputs(nrrd_data, resolution, registration,
+	previous=None,
+	encoding=None,
+	):
+	"""
+	Describe everything the processed data of an experiment depends on: content hashes of the NRRD volume, transform and reference template, the `PROCESSING_VERSION`, and the processing options.
+
+	Parameters
+	----------
+	nrrd_data : str or None
+		Path to the NRRD volume, or None if it was deleted after processing, in which case its record is taken from `previous`.
+	previous : dict, optional
+		Inputs recorded by an earlier run; hashes of files whose size and modification time are unchanged are taken from it.
+	encoding : dict, optional
+		Output encoding, see `encode_volume`.
+
+	Returns
+	-------
+	dict
+	"""
+	previous_files = (previous or {}).get('files', {})
+	files = {
+		'nrrd': nrrd_data,
+		'transform': os.path.join(TEMPLATE_DIR, COMPOSITE_TRANSFORM),
+		'reference': get_reference_image(resolution)[0],
+		}
+	return {
+		'files': {key: _file_record(path, previous_files.get(key)) if path else previous_files[key] for key, path in files.items()},
+		'processing_version': PROCESSING_VERSION,
+		'resolution': resolution,
+		'registration': registration,
+		'encoding': dict(DEFAULT_ENCODING, **(encoding or {})),
+		}
+
+def _inputs_key(inputs):
+	key = {k: v for k, v in inputs.items() if k != 'files'}
+	key['files'] = {k: v['sha256'] for k, v in inputs['files'].items()}
+	return key
+
+def read_stamp(target_dir):
+	"""
+	Return the stamp written by `write_stamp` into a processed experiment directory, or None.
+	"""
+	try:
+		with open(os.path.join(target_dir, STAMP_FILENAME)) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def write_stamp(target_dir, inputs, outputs,
+	encoding=None,
+	):
+	"""
+	Record the inputs a processed experiment directory was built from, the size and modification time of its outputs, and the encoding of the registered volume as returned by `encode_volume`.
+	"""
+	stamp = {
+		'inputs': inputs,
+		'outputs': {os.path.basename(path): {'size': os.stat(path).st_size, 'mtime_ns': os.stat(path).st_mtime_ns} for path in outputs},
+		}
+	if encoding:
+		stamp['encoding'] = encoding
+	_save_stamp(target_dir, stamp)
+
+def mark_source_deleted(target_dir):
+	"""
+	Note in the stamp of a processed experiment directory that its NRRD volume was deleted, so that it is still considered up to date.
+	"""
+	stamp = read_stamp(target_dir)
+	stamp['source_deleted'] = True
+	_save_stamp(target_dir, stamp)
+
+def _save_stamp(target_dir, stamp):
+	tmp_path = os.path.join(target_dir, STAMP_FILENAME + ".tmp")
+	with open(tmp_path, 'w') as f:
+		json.dump(stamp, f)
+	os.replace(tmp_path, os.path.join(target_dir, STAMP_FILENAME))
+
+def rebuild_reason(nrrd_dir, procdata_dir, resolution, registration,
+	encoding=None,
+	):
+	"""
+	Return why an experiment needs to be (re)processed, or None if its processed data is up to date.
+
+	If the NRRD volume was deleted after processing (see `stream_data`), its recorded content hash stands in for it.
+	"""
+	target_dir = os.path.join(procdata_dir, os.path.basename(nrrd_dir))
+	stamp = read_stamp(target_dir)
+	if stamp is None:
+		return "not processed yet"
+	for name, record in stamp['outputs'].items():
+		try:
+			stat = os.stat(os.path.join(target_dir, name))
+		except OSError:
+			return f"`{name}` is missing"
+		if stat.st_size != record['size'] or stat.st_mtime_ns != record['mtime_ns']:
+			return f"`{name}` was modified"
+	try:
+		if stamp.get('source_deleted') and not glob.glob(os.path.join(nrrd_dir,"*.nrrd")):
+			nrrd_data = None
+		else:
+			nrrd_data, _ = find_experiment_files(nrrd_dir)
+		inputs = experiment_inputs(nrrd_data, resolution, registration, previous=stamp['inputs'], encoding=encoding)
+	except (OSError, ValueError) as e:
+		return f"inputs cannot be checked ({e})"
+	old_key = _inputs_key(stamp['inputs'])
+	new_key = _inputs_key(inputs)
+	if old_key != new_key:
+		changed = [k for k in new_key['files'] if new_key['files'][k] != old_key['files'].get(k)]
+		changed += [k for k in new_key if k != 'files' and new_key[k] != old_key.get(k)]
+		return "changed " + ", ".join(changed)
+	return None
+
+#def process_data(source_dir, data_dir, scratch_dir="~/.local/share/ABI-connectivity/", resolution=100,):
+def find_experiment_files(nrrd_dir):
+	"""
+	Return the NRRD volume and XML metadata file of an experiment directory, raising ValueError unless there is exactly one of each.
+	"""
+	nrrd_data = glob.glob(os.path.join(nrrd_dir,"*.nrrd"))
+	xml_data = glob.glob(os.path.join(nrrd_dir,"*.xml"))
+	if len(nrrd_data) != 1:
+		raise ValueError(f"One NRRD data file expected in the `{nrrd_dir}` experiment directory, {len(nrrd_data)} found.")
+	else:
+		nrrd_data = nrrd_data[0]
+	if len(xml_data) != 1:
+		raise ValueError(f"One XML metadata file expected the `{nrrd_dir}` in experiment directory, {len(xml_data)} found.")
+	else:
+		xml_data = xml_data[0]
+	return nrrd_data, xml_data
+
+
+@measured('process', lambda nrrd_dir, *args, **kwargs: experiment_id(nrrd_dir))
+def process_experiment(nrrd_dir, procdata_dir,
+	resolution=100,
+	ants_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	registration='ants',
+	cache_dir=CACHE_DIR,
+	validate_tolerance=None,
+	encoding=None,
+	):
+	"""
+	Convert and register the projection density volume of a single experiment directory.
+
+	The registered volume is written uncompressed to the scratch directory, and then encoded into the processed experiment directory by `encode_volume`, compressing on `ants_threads` threads.
+
+	Parameters
+	----------
+	nrrd_dir : str
+		Experiment directory containing one NRRD volume and one XML metadata file.
+	procdata_dir : str
+		Directory under which the processed experiment directory is created.
+	resolution : int, optional
+		Resolution of the source volume, in microns.
+	ants_threads : int, optional
+		Number of threads ANTs may use for this experiment.
+	scratch_dir : str, optional
+		Directory for the intermediate uncompressed NIfTI file, ideally memory-backed.
+		Defaults to the system temporary directory if None.
+	registration : {'ants', 'cached'}, optional
+		Whether to register with ANTs (`apply_composite`) or with the cached sampling map (`apply_cached_composite`).
+	cache_dir : str, optional
+		Directory holding the cached sampling maps.
+	validate_tolerance : float, optional
+		If given, cached registrations are also run through ANTs, and must agree to within this relative tolerance.
+	encoding : dict, optional
+		Output encoding of the registered volume, see `encode_volume`.
+
+	Returns
+	-------
+	str
+		Path to the registered volume.
+	"""
+	nrrd_data, xml_data = find_experiment_files(nrrd_dir)
+	target_dir = os.path.join(procdata_dir, os.path.basename(nrrd_dir))
+	os.makedirs(target_dir, exist_ok=True)
+
+	with tempfile.TemporaryDirectory(prefix="abi-connectivity-", dir=scratch_dir) as scratch:
+		if registration == 'cached':
+			img = nrrd_to_image(nrrd_data)
+			nii_name = os.path.basename(nrrd_data).split(".")[0] + '.nii'
+			registered = apply_cached_composite(img, nii_name, resolution, scratch, cache_dir=cache_dir, num_threads=ants_threads, scratch_dir=scratch_dir, compressed=False)
+			if validate_tolerance is not None:
+				# ANTs names its output like the cached registration, so it goes into a directory of its own.
+				ants_dir = os.path.join(scratch, "ants")
+				nii_data = nrrd_to_nifti(nrrd_data, ants_dir)
+				reference = apply_composite(nii_data, resolution=resolution, num_threads=ants_threads, output_dir=ants_dir, compressed=False)
+				compare_registrations(registered, reference, validate_tolerance)
+		else:
+			nii_data = nrrd_to_nifti(nrrd_data, scratch)
+			registered = apply_composite(nii_data, resolution=resolution, num_threads=ants_threads, output_dir=scratch, compressed=False)
+		file_path_2dsurqec = os.path.join(target_dir, os.path.basename(registered) + ".gz")
+		encoded = encode_volume(registered, file_path_2dsurqec, encoding, threads=ants_threads or 1)
+	source_xml_path = xml_data
+	target_xml_path = os.path.join(target_dir, os.path.basename(xml_data))
+	shutil.copyfile(source_xml_path, target_xml_path)
+	write_stamp(target_dir, experiment_inputs(nrrd_data, resolution, registration, encoding=encoding), [file_path_2dsurqec, target_xml_path], encoding=encoded)
+
+	return file_path_2dsurqec
+
+
+@measured('process_batch')
+def process_batch(nrrd_dirs, procdata_dir,
+	resolution=100,
+	ants_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	encoding=None,
+	):
+	"""
+	Convert several experiments and register them with a single ANTs call, see `apply_composite_batch`, and encode the registered volumes, see `encode_volume`.
+
+	Experiments whose directory does not hold exactly one NRRD and one XML file are left out of the batch.
+
+	Returns
+	-------
+	dict
+		Error messages of the experiments left out, keyed by experiment directory.
+	"""
+	failures = {}
+	experiments = []
+	for nrrd_dir in nrrd_dirs:
+		try:
+			experiments.append((nrrd_dir,) + find_experiment_files(nrrd_dir))
+		except ValueError as e:
+			failures[nrrd_dir] = str(e)
+	if not experiments:
+		return failures
+
+	target_dirs = []
+	for nrrd_dir, _, _ in experiments:
+		target_dir = os.path.join(procdata_dir, os.path.basename(nrrd_dir))
+		os.makedirs(target_dir, exist_ok=True)
+		target_dirs.append(target_dir)
+	images = [nrrd_to_image(nrrd_data) for _, nrrd_data, _ in experiments]
+	names = [os.path.basename(nrrd_data).split(".")[0] + '.nii' for _, nrrd_data, _ in experiments]
+	with tempfile.TemporaryDirectory(prefix="abi-connectivity-", dir=scratch_dir) as scratch:
+		registered = apply_composite_batch(images, names, resolution, [scratch] * len(images), num_threads=ants_threads, scratch_dir=scratch_dir, compressed=False)
+		for (_, nrrd_data, xml_data), target_dir, registered_image in zip(experiments, target_dirs, registered):
+			output_image = os.path.join(target_dir, os.path.basename(registered_image) + ".gz")
+			encoded = encode_volume(registered_image, output_image, encoding, threads=ants_threads or 1)
+			os.remove(registered_image)
+			target_xml_path = os.path.join(target_dir, os.path.basename(xml_data))
+			shutil.copyfile(xml_data, target_xml_path)
+			write_stamp(target_dir, experiment_inputs(nrrd_data, resolution, 'ants', encoding=encoding), [output_image, target_xml_path], encoding=encoded)
+
+	return failures
+
+
+# Module settings which the worker processes of `process_pool` take over from the parent process.
+WORKER_SETTINGS = ('TEMPLATE_DIR', 'SCRATCH_DIR', '_metrics_path')
+
+def _init_worker(settings):
+	globals().update(settings)
+
+def process_pool(jobs):
+	"""
+	Return an executor running tasks in `jobs` worker processes.
+
+	Workers are spawned rather than forked, since the pool may be created from one of several threads (e.g. one per resolution), and they take over the `WORKER_SETTINGS` of the parent process, such as a `TEMPLATE_DIR` or metrics log set at runtime.
+	"""
+	settings = {name: globals()[name] for name in WORKER_SETTINGS}
+	return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(settings,))
+
+def _run_isolated(function, *args):
+	"""
+	Run `function` in a worker process, re-raising any exception as one which survives pickling back to the parent process.
+	"""
+	try:
+		return function(*args)
+	except Exception as e:
+		raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
+def process_data(source_dir, procdata_dir,
+	resolution=100,
+	jobs=1,
+	ants_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	registration='ants',
+	cache_dir=CACHE_DIR,
+	validate_tolerance=None,
+	batch_size=1,
+	force=False,
+	dry_run=False,
+	encoding=None,
+	):
+	"""
+	Convert and register all experiments in `source_dir`, `jobs` at a time.
+
+	Experiments whose processed data is up to date with their inputs (see `rebuild_reason`) are skipped.
+	A failing experiment is reported and skipped, without aborting the others.
+	If a batch fails, its experiments are retried one at a time.
+
+	Parameters
+	----------
+	source_dir : str
+		Directory containing the experiment directories.
+	procdata_dir : str
+		Directory under which the processed experiment directories are created.
+	resolution : int, optional
+		Resolution of the source volumes, in microns.
+	jobs : int, optional
+		Number of experiments to process concurrently, each in its own process.
+	ants_threads : int, optional
+		Number of threads ANTs may use per experiment.
+		Defaults to an even share of the available CPUs, so that the jobs do not oversubscribe the machine.
+	scratch_dir : str, optional
+		Directory for the intermediate uncompressed NIfTI files.
+	registration : {'ants', 'cached'}, optional
+		Registration method, see `process_experiment`.
+	cache_dir : str, optional
+		Directory holding the cached sampling maps.
+	validate_tolerance : float, optional
+		Relative tolerance to validate cached registrations against ANTs with, see `process_experiment`.
+	batch_size : int, optional
+		Number of experiments to register per ANTs call, see `process_batch`.
+		Each job holds this many uncompressed volumes in memory.
+		Only applies to ANTs registration.
+	force : bool, optional
+		Process all experiments, even those which are up to date.
+	dry_run : bool, optional
+		Only report which experiments would be processed, and why, without writing anything, not even the metadata index.
+	encoding : dict, optional
+		Output encoding of the registered volumes, see `encode_volume`.
+
+	Returns
+	-------
+	dict
+		Exceptions of failed experiments, keyed by experiment directory.
+	"""
+	if ants_threads is None:
+		ants_threads = max(1, (os.cpu_count() or 1) // jobs)
+	if not os.path.isdir(source_dir):
+		print(f"No source data in `{source_dir}`, nothing to process.")
+		return {}
+	if dry_run:
+		experiments = [{'directory': directory} for directory in list_experiment_dirs(source_dir)]
+	else:
+		experiments = query_metadata_index(build_metadata_index(source_dir))
+	nrrd_dirs = [os.path.join(source_dir, experiment['directory']) for experiment in experiments]
+
+	if not force:
+		stale = []
+		for nrrd_dir in nrrd_dirs:
+			reason = rebuild_reason(nrrd_dir, procdata_dir, resolution, registration, encoding)
+			if reason:
+				stale.append(nrrd_dir)
+				if dry_run:
+					print(f"Would process `{nrrd_dir}`: {reason}.")
+		print(f"{len(nrrd_dirs) - len(stale)} of {len(nrrd_dirs)} experiments are up to date.")
+		nrrd_dirs = stale
+	elif dry_run:
+		for nrrd_dir in nrrd_dirs:
+			print(f"Would process `{nrrd_dir}`: forced.")
+	if dry_run:
+		return {}
+
+	if registration == 'cached' and nrrd_dirs:
+		nrrd_data = [experiment['data_path'] for experiment in experiments if experiment['data_path']]
+		if nrrd_data:
+			prepare_sampling_map(nrrd_data[0], resolution, cache_dir=cache_dir, num_threads=ants_threads * jobs, scratch_dir=scratch_dir)
+
+	failures = {}
+	with process_pool(jobs) as executor:
+		single = nrrd_dirs
+		if registration == 'ants' and batch_size > 1:
+			single = []
+			batches = [nrrd_dirs[i:i + batch_size] for i in range(0, len(nrrd_dirs), batch_size)]
+			futures = {executor.submit(_run_isolated, process_batch, batch, procdata_dir, resolution, ants_threads, scratch_dir, encoding): batch for batch in batches}
+			for future in concurrent.futures.as_completed(futures):
+				batch = futures[future]
+				try:
+					for nrrd_dir, message in future.result().items():
+						print(f"\t❌processing `{nrrd_dir}` failed: {message}")
+						failures[nrrd_dir] = ValueError(message)
+				except Exception as e:
+					print(f"\t❌processing batch of {len(batch)} experiments starting at `{batch[0]}` failed, retrying them one at a time: {e}")
+					single += batch
+		futures = {executor.submit(_run_isolated, process_experiment, nrrd_dir, procdata_dir, resolution, ants_threads, scratch_dir, registration, cache_dir, validate_tolerance, encoding): nrrd_dir for nrrd_dir in single}
+		for future in concurrent.futures.as_completed(futures):
+			nrrd_dir = futures[future]
+			try:
+				future.result()
+			except Exception as e:
+				print(f"\t❌processing `{nrrd_dir}` failed: {e}")
+				failures[nrrd_dir] = e
+
+	if failures:
+		print(f"Processing failed for {len(failures)} of {len(nrrd_dirs)} experiments:")
+		for nrrd_dir in sorted(failures):
+			print(f"\t{nrrd_dir}")
+	return failures
+
+
+def _is_up_to_date(source, target, link_mode):
+	if not os.path.lexists(target):
+		return False
+	if link_mode == 'symlink':
+		return os.path.islink(target) and os.readlink(target) == os.path.relpath(source, os.path.dirname(target))
+	if os.path.islink(target):
+		return False
+	if link_mode == 'hardlink' and os.path.samefile(source, target):
+		return True
+	source_stat = os.stat(source)
+	target_stat = os.stat(target)
+	if source_stat.st_size != target_stat.st_size:
+		return False
+	if source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+		return True
+	if file_hash(source) == file_hash(target):
+		os.utime(target, ns=(target_stat.st_atime_ns, source_stat.st_mtime_ns))
+		return True
+	return False
+
+def _reflink(source, target):
+	with open(source, 'rb') as src, open(target, 'wb') as dst:
+		fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+	shutil.copystat(source, target)
+
+def materialize(source, target,
+	link_mode='copy',
+	):
+	"""
+	Make `target` provide the contents of `source`, unless it already does.
+
+	Targets with the same size and modification time as the source (or, failing that, the same content) are considered up to date.
+	Hard links and reflinks fall back to copies where the filesystem does not support them, e.g. across filesystems.
+
+	Parameters
+	----------
+	source : str
+		Path to the source file.
+	target : str
+		Path to the target file.
+	link_mode : {'copy', 'hardlink', 'symlink', 'reflink'}, optional
+		How to materialize the target: as copy, hard link, relative symbolic link, or copy-on-write clone.
+
+	Returns
+	-------
+	bool
+		Whether the target was (re)written.
+	"""
+	if _is_up_to_date(source, target, link_mode):
+		return False
+	tmp_path = target + ".tmp"
+	if os.path.lexists(tmp_path):
+		os.remove(tmp_path)
+	if link_mode == 'symlink':
+		os.symlink(os.path.relpath(source, os.path.dirname(target)), tmp_path)
+	else:
+		try:
+			if link_mode == 'hardlink':
+				os.link(source, tmp_path)
+			elif link_mode == 'reflink':
+				_reflink(source, tmp_path)
+			else:
+				shutil.copy2(source, tmp_path)
+		except OSError:
+			if link_mode == 'copy':
+				raise
+			if os.path.lexists(tmp_path):
+				os.remove(tmp_path)
+			shutil.copy2(source, tmp_path)
+	os.replace(tmp_path, target)
+	return True
+
+
+@measured('bids', lambda experiment, *args, **kwargs: experiment_id(experiment['directory']))
+def bids_rename_experiment(experiment, procdata_dir, bids_dir,
+	link_mode='copy',
 	):
 	"""
-	Queries the Allen Mouse Brain Institute website for all gene expression data available for download.
+	Reformat a single processed experiment to pseudo-BIDS, see `bids_rename`.
 
-	Returns:
-	--------
-	GeneNames: list[dict()]
-		list of all genes where expression data is available for download. Dict contains experiment/gene metadata.
+	The sidecar records the output encoding of the volume, see `encode_volume`, if the processing stamp holds it.
 
-	SectionDataSetID : list(int)
-		corresponding SectionDataSetID (SectionDataSet: see "http://help.brain-map.org/display/api/Data+Model")
-		ID needed to specify download target.
+	Parameters
+	----------
+	experiment : dict
+		Metadata index row of the experiment, see `experiment_metadata_row`.
+	procdata_dir : str
+		Directory containing the processed experiment directory.
+	bids_dir : str
+		Directory to write the pseudo-BIDS data to.
+	link_mode : {'copy', 'hardlink', 'symlink', 'reflink'}, optional
+		How to materialize the volume, see `materialize`.
 
+	Returns
+	-------
+	str or None
+		Path of the pseudo-BIDS volume, or None if the experiment has no Cre line.
 	"""
+	nii_dir = os.path.join(procdata_dir, experiment['directory'])
+	if not experiment['xml_path']:
+		print(f"One XML metadata file expected in the `{nii_dir}` experiment directory.")
+		raise ValueError
+	nii_data = experiment['data_path']
+	if not nii_data or not nii_data.endswith(".nii.gz"):
+		print(f"One NIfTI data file expected in the `{nii_dir}` experiment directory.")
+		raise ValueError
 
-	startRow = startRow
-	numRows = numRows
-	totalRows = totalRows
-	rows = []
-	GeneNames = []
-	SectionDataSetID = []
-	info = list()
-	done = False
+	# Collect metadata from the index:
+	metadata = {}
+	metadata['seed'] = {
+		'acronym': experiment['seed_acronym'],
+		'safe name': experiment['safe_name'],
+		'injection method': experiment['injection_method'],
+		'injection quality': experiment['injection_quality'],
+		}
+	if not experiment['cre_line']:
+		return None
+	metadata['expression'] = {
+		'acronym': experiment['cre_line'],
+		}
+	metadata['id'] = str(experiment['id'])
+	stamp = read_stamp(nii_dir)
+	if stamp and 'encoding' in stamp:
+		metadata['encoding'] = stamp['encoding']
 
-	while not done:
-		r = "&start_row={0}&num_rows={1}".format(startRow,numRows)
-		pagedUrl = API_DATA_PATH + "query.json?criteria=model::SectionDataSet,rma::criteria,products%5Bid$eq5%5D,rma::include,specimen(stereotaxic_injections(primary_injection_structure,structures))" + r
-		source = urllib.request.urlopen(pagedUrl).read()
-		response = json.loads(source)
-		rows += response['msg']
-		for x in response['msg']:
+	# Create filenames.
+	new_data_dir = os.path.join(
+		bids_dir,
+		f"seed-{metadata['seed']['acronym']}",
+		)
+	new_data_path = os.path.join(
+		new_data_dir,
+		f"seed-{metadata['seed']['acronym']}_expression-{metadata['expression']['acronym']}_FLUO.nii.gz"
+		)
+	new_path_dir = os.path.dirname(new_data_path)
+	new_metadata_path = os.path.join(
+		new_data_dir,
+		f"seed-{metadata['seed']['acronym']}_expression-{metadata['expression']['acronym']}_FLUO.json"
+		)
 
-			if x['failed'] == False :
-				info.append(x['id'])
-		if totalRows < 0:
-			totalRows = int(response['total_rows'])
+	# Write files.
+	os.makedirs(new_path_dir, exist_ok=True)
+	materialize(nii_data, new_data_path, link_mode=link_mode)
+	metadata_json = json.dumps(metadata)
+	if os.path.isfile(new_metadata_path):
+		with open(new_metadata_path) as f:
+			if f.read() == metadata_json:
+				return new_data_path
+	with open(new_metadata_path, 'w') as f:
+		f.write(metadata_json)
+	return new_data_path
 
-		startRow += len(response['msg'])
 
-		if startRow >= totalRows:
-			done = True
+def bids_rename(procdata_dir, bids_dir,
+	link_mode='copy',
+	):
+	"""
+	Reformat processed experiments with Cre-line metadata to pseudo-BIDS, as `seed-<acronym>/seed-<acronym>_expression-<acronym>_FLUO.{nii.gz,json}`.
 
-	return info
+	Files which are already up to date are left untouched, so re-running on an unchanged `procdata_dir` is cheap.
 
+	Parameters
+	----------
+	procdata_dir : str
+		Directory containing the processed experiment directories.
+	bids_dir : str
+		Directory to write the pseudo-BIDS data to.
+	link_mode : {'copy', 'hardlink', 'symlink', 'reflink'}, optional
+		How to materialize the volumes, see `materialize`.
+	"""
+	if not os.path.isdir(procdata_dir):
+		print(f"No processed data in `{procdata_dir}`, nothing to reformat.")
+		return
+	index_path = build_metadata_index(procdata_dir)
+	for experiment in query_metadata_index(index_path):
+		bids_rename_experiment(experiment, procdata_dir, bids_dir, link_mode=link_mode)
 
-def nrrd_to_nifti(file,
-	target_dir=False,
+
+def stream_data(info, source_dir, procdata_dir, bids_dir,
+	resolution=100,
+	jobs=1,
+	ants_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	registration='ants',
+	cache_dir=CACHE_DIR,
+	link_mode='copy',
+	rows=None,
+	queue_size=None,
+	delete_source=False,
+	force=False,
+	encoding=None,
 	):
-	print(f"Reading `{file}`.")
-	readnrrd = nrrd.read(file)
-	data = readnrrd[0]
-	header = readnrrd[1]
-	print(f"Converting `{file}`.")
+	"""
+	Download and process experiments as a pipeline, so that downloads overlap with processing, then reformat them to pseudo-BIDS.
 
-	affine_matrix = numpy.array(header["space directions"],dtype=float)
-	affine_matrix = affine_matrix*0.001
-	affine_matrix = numpy.insert(affine_matrix,3,[0,0,0], axis=1)
-	affine_matrix = numpy.insert(affine_matrix,3,[0,0,0,1], axis=0)
-
-	#Change Orientation from PIR to RAS. Steps: PIR -> RIP -> RPI -> RPS -> RAS
-	data.setflags(write=1)
-	data = numpy.swapaxes(data,0,2)
-	data = numpy.swapaxes(data,1,2)
-	data = data[:,:,::-1]
-	data = data[:,::-1,:]
-	data = data[::-1,:,:] #TODO: Check for Atlas files!!!!!!
-	img = nibabel.Nifti1Image(data,affine_matrix)
-	target_dir = os.path.abspath(os.path.expanduser(target_dir))
-	os.makedirs(target_dir, exist_ok=True)
-	nii_path = os.path.join(target_dir, os.path.basename(file).split(".")[0] + '.nii')
-	nibabel.save(img,nii_path)
+	Each experiment is processed as soon as its download completes.
+	Experiments whose processed data is up to date are not processed again, see `rebuild_reason`.
+	Reformatting waits until all experiments are processed, so that it runs in the deterministic order of `bids_rename`.
+	A failing experiment is reported and skipped, without aborting the others.
 
-	return nii_path
+	Parameters
+	----------
+	info : list(int)
+		SectionDataSetIDs of the experiments.
+	source_dir : str
+		Directory for the downloaded experiment directories and manifest, see `get_sourcedata`.
+	procdata_dir : str
+		Directory under which the processed experiment directories are created.
+	bids_dir : str or None
+		Directory to write the pseudo-BIDS data to, None to only download and process.
+	resolution : int, optional
+		Resolution of the projection density volumes, in microns.
+	jobs : int, optional
+		Number of experiments to download, and separately to process, concurrently.
+	ants_threads : int, optional
+		Number of threads ANTs may use per experiment, see `process_data`.
+	scratch_dir : str, optional
+		Directory for the intermediate uncompressed NIfTI files.
+	registration : {'ants', 'cached'}, optional
+		Registration method, see `process_experiment`.
+	cache_dir : str, optional
+		Directory holding the cached sampling maps.
+	link_mode : {'copy', 'hardlink', 'symlink', 'reflink'}, optional
+		How to materialize the pseudo-BIDS volumes, see `materialize`.
+	rows : dict, optional
+		Query rows keyed by SectionDataSetID, see `get_sourcedata`.
+	queue_size : int, optional
+		Maximum number of experiments downloaded or downloading but not yet processed, which bounds the disk space taken by source volumes when `delete_source` is set.
+		Defaults to twice `jobs`.
+	delete_source : bool, optional
+		Delete each NRRD volume once its registered volume has been verified to be readable and up to date, together with its copy in the HTTP cache, if one is set.
+		The manifest and processing stamp record the deletion, so that later streaming runs do not download it again.
+	force : bool, optional
+		Process all experiments, even those which are up to date.
+	encoding : dict, optional
+		Output encoding of the registered volumes, see `encode_volume`.
 
-def get_identifying_structure(metadata):
-	tree = et.parse(metadata)
-	root = tree.getroot()
-	struc = root.findall('.//primary-injection-structure/safe-name')[0]
-	return struc.text
+	Returns
+	-------
+	dict
+		Exceptions of failed experiments, keyed by SectionDataSetID.
+	"""
+	import nibabel
+	if rows is None:
+		rows = {}
+	info = [exp for exp in info if in_shard(exp)]
+	if ants_threads is None:
+		ants_threads = max(1, (os.cpu_count() or 1) // jobs)
+	if queue_size is None:
+		queue_size = 2 * jobs
+	slots = threading.BoundedSemaphore(queue_size)
+	aborted = threading.Event()
+	sampling_map_lock = threading.Lock()
+	sampling_map_ready = registration != 'cached'
+	failures = {}
 
-def get_exp_metadata(exp,path):
-	url_meta = API_DATA_PATH + "/SectionDataSet/query.xml?id=" + str(exp) + "&include=specimen(stereotaxic_injections(primary_injection_structure,structures))"
-	filename = str(exp) + "_experiment_metadata.xml"
-	s = urllib.request.urlopen(url_meta)
-	contents = s.read()
-	path_to_metadata = os.path.join(path,filename)
-	file = open(path_to_metadata, 'wb')
-	file.write(contents)
-	file.close()
+	with manifest_recorder(source_dir) as (manifest, record):
 
-	return path_to_metadata
+		def fetch(exp):
+			"""Download an experiment, returning its directory, whether it holds a slot, and whether it needs processing."""
+			nonlocal sampling_map_ready
+			entry = manifest.get(str(exp))
+			if entry and entry.get('status') == 'deleted' and not force:
+				nrrd_dir = os.path.join(source_dir, entry['directory'])
+				if rebuild_reason(nrrd_dir, procdata_dir, resolution, registration, encoding) is None:
+					print(f"Experiment {exp} already processed and its source deleted, skipping.")
+					return nrrd_dir, False, False
+			while not slots.acquire(timeout=1):
+				if aborted.is_set():
+					raise concurrent.futures.CancelledError()
+			try:
+				nrrd_dir = get_experiment_sourcedata(exp, source_dir, resolution, entry, record, rows.get(exp))
+				stale = force or bool(rebuild_reason(nrrd_dir, procdata_dir, resolution, registration, encoding))
+				if stale:
+					with sampling_map_lock:
+						if not sampling_map_ready:
+							prepare_sampling_map(find_experiment_files(nrrd_dir)[0], resolution, cache_dir=cache_dir, num_threads=ants_threads * jobs, scratch_dir=scratch_dir)
+							sampling_map_ready = True
+				return nrrd_dir, True, stale
+			except BaseException:
+				slots.release()
+				raise
 
+		def finish(exp, nrrd_dir):
+			"""Delete the source volume of a processed experiment, if `delete_source` is set."""
+			nrrd_data = glob.glob(os.path.join(nrrd_dir,"*.nrrd"))
+			if delete_source and nrrd_data:
+				target_dir = os.path.join(procdata_dir, os.path.basename(nrrd_dir))
+				experiment = experiment_metadata_row(target_dir)
+				reason = rebuild_reason(nrrd_dir, procdata_dir, resolution, registration, encoding)
+				if reason:
+					raise ValueError(f"Processed data of `{nrrd_dir}` could not be verified: {reason}.")
+				# Decompress the whole volume, so that truncated files are caught.
+				numpy.asanyarray(nibabel.load(experiment['data_path']).dataobj)
+				for path in nrrd_data:
+					os.remove(path)
+				if HTTP_CACHE_DIR and manifest[str(exp)].get('url'):
+					http_cache_evict(manifest[str(exp)]['url'])
+				mark_source_deleted(target_dir)
+				record(dict(manifest[str(exp)], status='deleted'))
 
-def get_sourcedata(info, dir_name,
+		# Finishing runs on its own threads, as download threads may all be waiting for the slots it releases.
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as downloads, process_pool(jobs) as processes, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as finishing:
+			pending = {downloads.submit(fetch, exp): ('download', exp, None, False) for exp in info}
+			try:
+				while pending:
+					done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+					for future in done:
+						stage, exp, nrrd_dir, holds_slot = pending.pop(future)
+						try:
+							if stage == 'download':
+								nrrd_dir, holds_slot, stale = future.result()
+								if stale:
+									process = processes.submit(_run_isolated, process_experiment, nrrd_dir, procdata_dir, resolution, ants_threads, scratch_dir, registration, cache_dir, None, encoding)
+									pending[process] = ('processing', exp, nrrd_dir, holds_slot)
+									continue
+							else:
+								future.result()
+							if stage != 'finishing':
+								pending[finishing.submit(finish, exp, nrrd_dir)] = ('finishing', exp, nrrd_dir, holds_slot)
+								continue
+						except Exception as e:
+							print(f"\t❌{stage} of experiment {exp} failed: {e}")
+							failures[exp] = e
+						if holds_slot:
+							slots.release()
+			except BaseException:
+				aborted.set()
+				for future in pending:
+					future.cancel()
+				raise
+
+	if bids_dir:
+		bids_rename(procdata_dir, bids_dir, link_mode=link_mode)
+	if failures:
+		print(f"Streaming failed for {len(failures)} of {len(info)} experiments:")
+		for exp in sorted(failures):
+			print(f"\t{exp}")
+	return failures
+
+
+def merge_shards(source_dir, procdata_dir,
 	resolution=100,
+	registration='ants',
+	encoding=None,
 	):
 	"""
-	Download all given genes corresponding to SectionDataSetID given in 100um and 25um resolution, converts nrrd to nii, registers to dsurqec... and resamples files to 40 and 200 respectively.
+	Combine the per-shard manifests of a sharded build (see `set_shard`) into the manifest of `source_dir`, and check that every experiment has been processed.
 
-	Parameters:
-	-----------
-	SectionDataSetID : list(int)
-		o=[0.200000002980232 0 0 -6.26999998092651; 0 0.200000002980232 0 -10.6000003814697; 0 0 0.200000002980232 -7.88000011444092; 0 0 0 1]list of SectionDataSetID to download.
+	All shards of the build must have written their manifest.
+	Records of the shards supersede those of the existing manifest, whose other records are kept.
+	The processed data needs no merging, as every shard writes its own experiment directories.
+
+	Parameters
+	----------
+	source_dir : str
+		Directory containing the downloaded experiment directories and the per-shard manifests.
+	procdata_dir : str
+		Directory containing the processed experiment directories.
+	resolution : int, optional
+		Resolution of the source volumes, in microns.
+	registration : {'ants', 'cached'}, optional
+		Registration method of the build, see `rebuild_reason`.
+	encoding : dict, optional
+		Output encoding of the build, see `encode_volume`.
+
+	Returns
+	-------
+	dict
+		Exceptions of experiments which failed to download or are not processed, keyed by SectionDataSetID.
 	"""
+	stem, extension = os.path.splitext(MANIFEST_FILENAME)
+	pattern = re.compile(re.escape(stem) + r"\.shard-(\d+)-of-(\d+)" + re.escape(extension) + "$")
+	shards = {}
+	for name in os.listdir(source_dir):
+		m = pattern.match(name)
+		if m:
+			shards[int(m.group(1)), int(m.group(2))] = os.path.join(source_dir, name)
+	if not shards:
+		raise ValueError(f"No shard manifests found in `{source_dir}`.")
+	counts = sorted({count for _, count in shards})
+	if len(counts) > 1:
+		raise ValueError(f"Manifests of builds with different shard counts ({', '.join(map(str, counts))}) found in `{source_dir}`.")
+	count = counts[0]
+	missing = [str(index) for index in range(count) if (index, count) not in shards]
+	if missing:
+		raise ValueError(f"No manifest of shard {', '.join(missing)} of {count} in `{source_dir}`.")
 
-	download_url = "http://api.brain-map.org/grid_data/download_file/"
+	manifest_path = os.path.join(source_dir, MANIFEST_FILENAME)
+	manifest = load_manifest(manifest_path)
+	for shard in sorted(shards):
+		manifest.update(load_manifest(shards[shard]))
+	save_manifest(manifest, manifest_path)
+	rows_path = os.path.join(source_dir, shard_filename(QUERY_FILENAME, (0, count)))
+	if os.path.isfile(rows_path):
+		shutil.copyfile(rows_path, os.path.join(source_dir, QUERY_FILENAME))
 
-	for exp in info:
-		path_to_exp = os.path.join(dir_name,str(exp))
-		#TODO: look inside if stuff is there...
-		os.mkdir(path_to_exp)
-		#TODO: so far no coordinate info. Also, avoid downloading twice
-		path_to_metadata = get_exp_metadata(exp,path_to_exp)
-		struc_name=get_identifying_structure(path_to_metadata)
-		struc_name = struc_name.lower()
-		struc_name= re.sub(" ","_",struc_name)
-		struc_name=re.sub("[()]","",struc_name)
-		new_name = struc_name + "-" + os.path.basename(path_to_exp)
-		new_path = os.path.join(os.path.dirname(path_to_exp),new_name)
-		os.rename(path_to_exp,new_path)
-		resolution_url = "?image=projection_density&resolution=" + str(resolution)
-		url = download_url + str(exp) + resolution_url
-		# Trying higher timout to avoid spontaneous drop, unit is seconds
-		# Last failed at:
-		# http://api.brain-map.org/grid_data/download_file/165975096?image=projection_density&resolution=100
-		fh = download_with_retry(url)
-		filename = str.split((fh[1]._headers[6][1]),'filename=')[1] #TODO: Consistent??
-		#TODO: do that differenttly ...
-		filename = str.split(filename,";")[0]
-		file_path_nrrd = os.path.join(new_path,filename)
-		shutil.copy(fh[0],file_path_nrrd)
-		os.remove(fh[0])
-
-	return
-
-
-def download_with_retry(url, max_retries=5, timeout=5):
-	retries = 0
-	print(f"Trying to download {url}.")
- 
-	while retries < max_retries:
-		try:
-			fh = urllib.request.urlretrieve(url)
-			print(f"\t✔️ downloaded.")
-			return fh
-		#except urllib.error.URLError as e:
-		except:
-			#if isinstance(e.reason, TimeoutError):
-			print(f"\ttimeout occurred, retrying ({retries + 1}/{max_retries})...")
-			retries += 1
-			time.sleep(timeout)  # Wait for a moment before retrying
-			#else:
-			#	raise
-	print(f"\t❌download failed after {max_retries} retries.")
+	failures = {}
+	for key, entry in manifest.items():
+		if entry.get('status') not in ('complete', 'deleted'):
+			failures[int(key)] = ValueError(entry.get('error') or f"download {entry.get('status')}")
+			continue
+		reason = rebuild_reason(os.path.join(source_dir, entry['directory']), procdata_dir, resolution, registration, encoding)
+		if reason:
+			failures[int(key)] = ValueError(f"processing incomplete, {reason}")
+	print(f"Merged the manifests of {count} shards in `{source_dir}`: {len(manifest) - len(failures)} of {len(manifest)} experiments downloaded and processed.")
+	for exp in sorted(failures):
+		print(f"\t❌experiment {exp}: {failures[exp]}")
+	return failures
 
 
-#def process_data(source_dir, data_dir, scratch_dir="~/.local/share/ABI-connectivity/", resolution=100,):
-def process_data(source_dir, procdata_dir,
+def write_connectivity_matrix(bids_dir, matrix_path,
 	resolution=100,
+	chunk_experiments=16,
+	chunk_voxels=4096,
+	compression=4,
 	):
-	for nrrd_dir_name in os.listdir(source_dir):
-		if os.path.isdir(os.path.join(source_dir,nrrd_dir_name)):
-			nrrd_dir = os.path.join(source_dir,nrrd_dir_name)
-			nrrd_data = glob.glob(os.path.join(nrrd_dir,"*.nrrd"))
-			xml_data = glob.glob(os.path.join(nrrd_dir,"*.xml"))
-			if len(nrrd_data) != 1:
-				print(f"One NRRD data file expected in the `{nrrd_dir}` experiment directory, {len(nrrd_data)} found.")
-				raise ValueError
-			else:
-				nrrd_data = nrrd_data[0]
-			if len(xml_data) != 1:
-				print(f"One XML metadata file expected the `{nrrd_dir}` in experiment directory, {len(xml_data)} found.")
-				raise ValueError
-			else:
-				xml_data = xml_data[0]
+	"""
+	Consolidate the pseudo-BIDS volumes into a single chunked and compressed HDF5 experiment-by-voxel matrix.
 
-			target_dir = os.path.join(procdata_dir, nrrd_dir_name)
-			os.makedirs(target_dir, exist_ok=True)
+	Only voxels inside the brain mask of the reference template are stored.
+	Volumes are read one at a time and buffered for a row of chunks, which is then written at once, so that each chunk is compressed only once and memory use does not grow with the number of experiments.
 
-			nii_data = nrrd_to_nifti(nrrd_data, target_dir)
-			file_path_2dsurqec = apply_composite(nii_data, resolution=resolution)
-			os.remove(nii_data)
-			source_xml_path = xml_data
-			target_xml_path = os.path.join(target_dir, os.path.basename(xml_data))
-			shutil.copyfile(source_xml_path, target_xml_path)
-
-
-def bids_rename(procdata_dir, bids_dir):
-	for nii_dir in os.listdir(procdata_dir):
-		if os.path.isdir(os.path.join(procdata_dir,nii_dir)):
-			nii_dir = os.path.join(procdata_dir,nii_dir)
-			nii_data = glob.glob(os.path.join(nii_dir,"*.nii.gz"))
-			xml_data = glob.glob(os.path.join(nii_dir,"*.xml"))
-			if len(nii_data) != 1:
-				print(f"One NIfTI data file expected in the `{nii_dir}` experiment directory, {len(nii_data)} found.")
-				raise ValueError
-			else:
-				nii_data = nii_data[0]
-			if len(xml_data) != 1:
-				print(f"One XML metadata file expected the `{nii_dir}` in experiment directory, {len(xml_data)} found.")
-				raise ValueError
-			else:
-				xml_data = xml_data[0]
-
-			# Extract metadata:
-			metadata = {}
-			tree = et.parse(xml_data)
-			root = tree.getroot()
-			# Maybe include an explicit list length check
-			metadata['seed'] = {
-				'acronym': root.findall('.//primary-injection-structure/acronym')[0].text,
-				'safe name': root.findall('.//primary-injection-structure/safe-name')[0].text,
-				'injection method': root.findall('.//stereotaxic-injection/injection-method')[0].text,
-				'injection quality': root.findall('.//stereotaxic-injection/injection-quality')[0].text,
-				}
-			metadata['expression'] = {
-				'name': root.findall('.//specimen/name')[0].text,
-				}
-			metadata['id'] = root.findall('.//id')[0].text
-			# !!! Some files don't have Cre selectors listed, why?
-			if not "Cre" in metadata['expression']['name']:
-				continue
-			m = re.match("(?P<expression_acronym>.+?)-(IRES-)?Cre.*",metadata['expression']['name'])
-			if m:
-				expression_acronym = m.groupdict()['expression_acronym'].replace("-", "")
-				metadata['expression'] = {
-					'acronym': expression_acronym,
-					}
-			else:
-				continue
+	The file holds:
+
+	* `data`: float32 array of shape (experiments, voxels), chunked so that slicing either by experiment or by voxel range only decompresses the chunks it touches.
+	* `mask`: boolean volume of the reference template grid, with the voxel-to-world `affine` as attribute; `data[:, k]` is the k-th true voxel of `mask` in C order.
+	* `experiments/<column>`: one dataset per metadata column (`id`, `seed`, `expression`, `path`), aligned with the first axis of `data`.
+
+	Parameters
+	----------
+	bids_dir : str
+		Directory containing the pseudo-BIDS data, as written by `bids_rename`.
+	matrix_path : str
+		Path of the HDF5 file to write; it is replaced atomically.
+	resolution : int, optional
+		Resolution of the source volumes, in microns, selecting the reference template and thus the mask.
+	chunk_experiments : int, optional
+		Number of experiments per chunk, and thus of volumes held in memory at a time.
+	chunk_voxels : int, optional
+		Number of voxels per chunk.
+	compression : int, optional
+		Gzip compression level of the data chunks.
+
+	Returns
+	-------
+	int
+		Number of experiments written.
+	"""
+	import h5py
+	import nibabel
+	reference = nibabel.load(get_reference_image(resolution)[0])
+	mask = numpy.asanyarray(reference.dataobj) != 0
+	sidecars = sorted(glob.glob(os.path.join(bids_dir, "seed-*", "seed-*_expression-*_FLUO.json")))
+	n_voxels = int(mask.sum())
+	if not n_voxels:
+		raise ValueError(f"The `{get_reference_image(resolution)[0]}` reference has an empty brain mask.")
+	tmp_path = matrix_path + ".tmp"
+	with h5py.File(tmp_path, 'w') as f:
+		data = f.create_dataset('data',
+			shape=(len(sidecars), n_voxels),
+			maxshape=(None, n_voxels),
+			dtype='float32',
+			chunks=(chunk_experiments, min(chunk_voxels, n_voxels)),
+			compression='gzip',
+			compression_opts=compression,
+			shuffle=True,
+			)
+		mask_dataset = f.create_dataset('mask', data=mask, compression='gzip')
+		mask_dataset.attrs['affine'] = reference.affine
+		# Rows written one at a time would evict partially filled chunks from the chunk cache, and recompress each chunk once per row.
+		block = numpy.empty((data.chunks[0], n_voxels), dtype=numpy.float32)
+		for start in range(0, len(sidecars), len(block)):
+			rows = sidecars[start:start + len(block)]
+			for i, sidecar in enumerate(rows):
+				path = sidecar[:-len(".json")] + ".nii.gz"
+				img = nibabel.load(path)
+				if img.shape[:3] != mask.shape:
+					raise ValueError(f"The `{path}` volume has shape {img.shape}, but the `{resolution}` micron reference has shape {mask.shape}.")
+				block[i] = numpy.asanyarray(img.dataobj, dtype=numpy.float32).reshape(mask.shape)[mask]
+			data[start:start + len(rows)] = block[:len(rows)]
+		_write_experiment_columns(f.create_group('experiments'), bids_dir, sidecars)
+	os.replace(tmp_path, matrix_path)
+	return len(sidecars)
 
-			# Create filenames.
-			new_data_dir = os.path.join(
-				bids_dir,
-				f"seed-{metadata['seed']['acronym']}",
-				)
-			new_data_path = os.path.join(
-				new_data_dir,
-				f"seed-{metadata['seed']['acronym']}_expression-{metadata['expression']['acronym']}_FLUO.nii.gz"
-				)
-			new_path_dir = os.path.dirname(new_data_path)
-			new_metadata_path = os.path.join(
-				new_data_dir,
-				f"seed-{metadata['seed']['acronym']}_expression-{metadata['expression']['acronym']}_FLUO.json"
-				)
 
-			# Write files.
-			os.makedirs(new_path_dir, exist_ok=True)
-			shutil.copyfile(nii_data, new_data_path)
-			with open(new_metadata_path, 'w') as f:
-				json.dump(metadata, f)
+def _write_experiment_columns(group, bids_dir, sidecars):
+	# One dataset per metadata column, aligned with the order of `sidecars`.
+	import h5py
+	columns = {'id': [], 'seed': [], 'expression': [], 'path': []}
+	for sidecar in sidecars:
+		with open(sidecar) as sidecar_file:
+			metadata = json.load(sidecar_file)
+		columns['id'].append(int(metadata['id']))
+		columns['seed'].append(metadata['seed']['acronym'])
+		columns['expression'].append(metadata['expression']['acronym'])
+		columns['path'].append(os.path.relpath(sidecar[:-len(".json")] + ".nii.gz", bids_dir))
+	group.create_dataset('id', data=numpy.array(columns['id'], dtype=numpy.int64))
+	for column in ('seed', 'expression', 'path'):
+		group.create_dataset(column, data=columns[column], dtype=h5py.string_dtype())
 
 
-def download_all_connectivity(info,dir_name,resolution=[100,25]):
+def load_structure_graph(path):
 	"""
-	Download all given genes corresponding to SectionDataSetID given in 100um and 25um resolution, converts nrrd to nii, registers to dsurqec... and resamples files to 40 and 200 respectively.
+	Flatten the structure hierarchy downloaded by `download_annotation_file`.
 
-	Parameters:
-	-----------
-	SectionDataSetID : list(int)
-		o=[0.200000002980232 0 0 -6.26999998092651; 0 0.200000002980232 0 -10.6000003814697; 0 0 0.200000002980232 -7.88000011444092; 0 0 0 1]list of SectionDataSetID to download.
-	"""
-
-	if resolution is None:
-		resolution=[100,25]
-
-	download_url = "http://api.brain-map.org/grid_data/download_file/"
-
-	for resolution in res:
-		if resolution == 100:
-			path_to_res = dir_name
-		if resolution <= 40:
-			path_to_res = dir_name + "HD"
-		if not os.path.isdir(path_to_res):
-			os.mkdir(path_to_res)
-		for exp in info:
-			path_to_exp = os.path.join(path_to_res,str(exp))
-			#TODO: look inside if stuff is there...
-			os.mkdir(path_to_exp)
-			path_to_metadata = get_exp_metadata(exp,path_to_exp) #TODO: so far no coordinate info. Also, avoid downloading twice
-			struc_name=get_identifying_structure(path_to_metadata)
-			struc_name = struc_name.lower()
-			struc_name= re.sub(" ","_",struc_name)
-			struc_name=re.sub("[()]","",struc_name)
-			new_name = struc_name + "-" + os.path.basename(path_to_exp)
-			new_path = os.path.join(os.path.dirname(path_to_exp),new_name)
-			os.rename(path_to_exp,new_path)
-			resolution_url = "?image=projection_density&resolution=" + str(resolution)
-			url = download_url + str(exp) + resolution_url
-			fh = urllib.request.urlretrieve(url)
-			filename = str.split((fh[1]._headers[6][1]),'filename=')[1] #TODO: Consistent??
-			#TODO: do that differenttly ...
-			filename = str.split(filename,";")[0]
-			file_path_nrrd = os.path.join(new_path,filename)
-			shutil.copy(fh[0],file_path_nrrd)
-			os.remove(fh[0])
-			#os.rename(fh[0],file_path_nrrd) only works if source and dest are on the same filesystem
-			file_path_nii = nrrd_to_nifti(file_path_nrrd)
-			os.remove(file_path_nrrd)
-			file_path_2dsurqec = apply_composite(file_path_nii,resolution)
-			os.remove(file_path_nii)
-
-		# Create archives:
-		if resolution == 25:
-			save_info(info,dir_name)
-			tarname = dir_name + "HD" + ".tar.xz"
-			create_archive(tarname, path_to_res)
-		elif resolution == 100:
-			save_info(info,dir_name)
-			tarname = dir_name + ".tar.xz"
-			create_archive(tarname, path_to_res)
-
-	return
-
-def apply_composite(file,resolution):
-	#TODO: does this downsample if composite file is low resolution? Currently composite file is 40um. If it does,is it a problem? Target resolution is 40 anyway, but maybe get a
-	#composite file at 25um as well? ResampleImage is possibly not needed otherwise, just specify reference image resolution of 40 and 200
+	Returns
+	-------
+	list of dict
+		`id`, `acronym`, `name`, `parent_id` (None for the root) and `depth` of each structure, parents before their children.
 	"""
-	Uses ANTS ApplyTransforms to register image to
+	with open(path) as f:
+		roots = json.load(f)['msg']
+	structures = []
+	stack = [(root, 0) for root in reversed(roots)]
+	while stack:
+		structure, depth = stack.pop()
+		structures.append({
+			'id': int(structure['id']),
+			'acronym': structure['acronym'],
+			'name': structure['name'],
+			'parent_id': structure.get('parent_structure_id'),
+			'depth': depth,
+			})
+		stack.extend((child, depth + 1) for child in reversed(structure.get('children') or []))
+	return structures
 
-	Parameters :
-	------------
 
-	file : str
-		path to image
+def structure_label_index(annotation, structures):
+	"""
+	Precompute the aggregation of voxel values into structures, including all their descendants, for `structure_summary`.
+
+	Voxels are indexed by their dense label number once, so that summarizing a volume takes two `numpy.bincount` calls rather than one mask per structure: one from voxels to labels, and one from labels to each structure they roll up into.
 
+	Parameters
+	----------
+	annotation : numpy.ndarray
+		Structure ID of each voxel, 0 outside the brain.
+	structures : list of dict
+		Structure hierarchy, as returned by `load_structure_graph`.
+
+	Returns
+	-------
+	dict
+		`inside` (boolean mask of the annotated voxels), `labels` (dense label number of each annotated voxel), `n_labels`, `pair_labels` and `pair_structures` (each label with each structure it rolls up into, as positions in `structures`) and `voxels` (number of voxels of each structure).
+	"""
+	annotation = numpy.asanyarray(annotation)
+	inside = annotation != 0
+	label_ids, labels = numpy.unique(annotation[inside], return_inverse=True)
+	position = {structure['id']: i for i, structure in enumerate(structures)}
+	unknown = [int(label) for label in label_ids if int(label) not in position]
+	if unknown:
+		print(f"{len(unknown)} annotation labels are not in the structure graph and only count towards the root, e.g. {unknown[:5]}.")
+	pair_labels = []
+	pair_structures = []
+	for label_number, label in enumerate(label_ids):
+		i = position.get(int(label), 0)
+		while i is not None:
+			pair_labels.append(label_number)
+			pair_structures.append(i)
+			i = position.get(structures[i]['parent_id'])
+	pair_labels = numpy.array(pair_labels, dtype=numpy.intp)
+	pair_structures = numpy.array(pair_structures, dtype=numpy.intp)
+	label_voxels = numpy.bincount(labels, minlength=len(label_ids))
+	voxels = numpy.bincount(pair_structures, weights=label_voxels[pair_labels], minlength=len(structures)).astype(numpy.int64)
+	return {'inside': inside, 'labels': labels.ravel(), 'n_labels': len(label_ids), 'pair_labels': pair_labels, 'pair_structures': pair_structures, 'voxels': voxels}
+
+
+def structure_summary(data, index):
+	"""
+	Return the mean of a volume over each structure, including its descendants, using an index from `structure_label_index`.
+	"""
+	label_sums = numpy.bincount(index['labels'], weights=numpy.asanyarray(data)[index['inside']], minlength=index['n_labels'])
+	sums = numpy.bincount(index['pair_structures'], weights=label_sums[index['pair_labels']], minlength=len(index['voxels']))
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		return sums / index['voxels']
+
+
+def get_annotation_image(resolution):
+	"""
+	Return the ABI annotation registered to the DSURQEC template matching a source resolution, see `get_reference_image`.
+	"""
+	if resolution == 100:
+		return os.path.join(TEMPLATE_DIR, 'abi2dsurqec_200micron_annotation.nii')
+	else:
+		return os.path.join(TEMPLATE_DIR, 'abi2dsurqec_40micron_annotation.nii')
+
+
+def write_structure_summary(bids_dir, summary_path, structure_graph,
+	annotation=None,
+	resolution=100,
+	jobs=1,
+	compression=4,
+	):
+	"""
+	Reduce the pseudo-BIDS volumes to a structure-by-experiment table of mean projection density, stored as columnar HDF5.
+
+	Each structure covers the voxels of all its descendants in the hierarchy, see `structure_label_index`.
+	Structures without any voxel in the annotation are left out.
+
+	The file holds:
+
+	* `density`: float32 array of shape (structures, experiments), chunked by blocks of structures, so that reading the row of one structure touches few chunks.
+	* `structures/<column>`: one dataset per structure column (`id`, `acronym`, `name`, `parent_id`, with -1 for the root, `depth` and `voxels`), aligned with the first axis of `density`.
+	* `experiments/<column>`: one dataset per metadata column (`id`, `seed`, `expression`, `path`), aligned with the second axis of `density`, as in the connectivity matrix.
+
+	Parameters
+	----------
+	bids_dir : str
+		Directory containing the pseudo-BIDS data, as written by `bids_rename`.
+	summary_path : str
+		Path of the HDF5 file to write; it is replaced atomically.
+	structure_graph : str
+		Path to the structure hierarchy, as downloaded by `download_annotation_file`.
+	annotation : str, optional
+		Path to the structure annotation on the grid of the pseudo-BIDS volumes, defaults to `get_annotation_image`.
+	resolution : int, optional
+		Resolution of the source volumes, in microns, selecting the default annotation.
+	jobs : int, optional
+		Number of volumes to decompress concurrently.
+	compression : int, optional
+		Gzip compression level of the table.
+
+	Returns
+	-------
+	int
+		Number of experiments summarized.
+	"""
+	import h5py
+	import nibabel
+	if annotation is None:
+		annotation = get_annotation_image(resolution)
+	if not os.path.isfile(annotation):
+		raise FileNotFoundError(f"No structure annotation at `{annotation}`, give the annotation on the grid of the pseudo-BIDS volumes with `--annotation`.")
+	labels = numpy.asanyarray(nibabel.load(annotation).dataobj).astype(numpy.int64)
+	structures = load_structure_graph(structure_graph)
+	if not structures:
+		raise ValueError(f"The `{structure_graph}` structure graph holds no structures.")
+	index = structure_label_index(labels, structures)
+	keep = numpy.flatnonzero(index['voxels'])
+	sidecars = sorted(glob.glob(os.path.join(bids_dir, "seed-*", "seed-*_expression-*_FLUO.json")))
+
+	def summarize(sidecar):
+		path = sidecar[:-len(".json")] + ".nii.gz"
+		img = nibabel.load(path)
+		if img.shape[:3] != labels.shape:
+			raise ValueError(f"The `{path}` volume has shape {img.shape}, but the `{annotation}` annotation has shape {labels.shape}.")
+		return structure_summary(numpy.asanyarray(img.dataobj, dtype=numpy.float32).reshape(labels.shape), index)[keep]
+
+	# The table is small, so it is filled in memory and written at once rather than chunk by chunk.
+	table = numpy.empty((len(keep), len(sidecars)), dtype=numpy.float32)
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		for i, summary in enumerate(executor.map(summarize, sidecars)):
+			table[:, i] = summary
+
+	tmp_path = summary_path + ".tmp"
+	with h5py.File(tmp_path, 'w') as f:
+		density = f.create_dataset('density',
+			data=table,
+			maxshape=(len(keep), None),
+			chunks=(max(1, min(64, len(keep))), max(1, min(1024, len(sidecars)))),
+			compression='gzip',
+			compression_opts=compression,
+			shuffle=True,
+			)
+		density.attrs['annotation'] = os.path.abspath(annotation)
+		group = f.create_group('structures')
+		for column in ('id', 'parent_id', 'depth'):
+			values = [structures[i][column] for i in keep]
+			group.create_dataset(column, data=numpy.array([-1 if value is None else value for value in values], dtype=numpy.int64))
+		for column in ('acronym', 'name'):
+			group.create_dataset(column, data=[structures[i][column] for i in keep], dtype=h5py.string_dtype())
+		group.create_dataset('voxels', data=index['voxels'][keep])
+		_write_experiment_columns(f.create_group('experiments'), bids_dir, sidecars)
+	os.replace(tmp_path, summary_path)
+	return len(sidecars)
+
+
+def dataset_suffix(resolution):
+	"""
+	Return the suffix of the data directories and archive of a resolution: `HD` for high-resolution data, registered to the 40 micron template (see `get_reference_image`), and none otherwise.
+	"""
+	return "" if resolution in (None, 100) else "HD"
+
+def dataset_dirs(resolution):
+	"""
+	Return the source, processed and pseudo-BIDS data directories for a resolution.
+
+	The directories of high-resolution data carry an `HD` suffix (see `dataset_suffix`), as the archive does, whether or not other resolutions are built in the same run.
+	"""
+	suffix = dataset_suffix(resolution)
+	return f"sourcedata{suffix}", f"procdata{suffix}", f"bids{suffix}"
+
+def get_reference_image(resolution):
+	"""
+	Return the DSURQEC template matching a source resolution, and the template resolution (both in microns).
 	"""
-	at = ApplyTransforms()
-	at.inputs.dimension = 3
-	at.inputs.input_image = file
 	if resolution == 100:
-		ref_image = '/usr/share/mouse-brain-templates/dsurqec_200micron_masked.nii'
-		resolution = 200
+		return os.path.join(TEMPLATE_DIR, 'dsurqec_200micron_masked.nii'), 200
 	else:
-		ref_image = '/usr/share/mouse-brain-templates/dsurqec_40micron_masked.nii'
-		resolution = 40
+		return os.path.join(TEMPLATE_DIR, 'dsurqec_40micron_masked.nii'), 40
 
+def registered_name(file, resolution,
+	compressed=True,
+	):
+	"""
+	Return the file name of the registered version of `file`, with the resolution token replaced by the template `resolution`, gzipped unless `compressed` is False.
+	"""
 	#TODO: theres got to be an easier way...
 	output_image = ""
 	for s in os.path.basename(file).split("_"):
@@ -376,42 +2704,589 @@ def apply_composite(file,resolution):
 		else:
 			output_image += (str(resolution) + "um_")
 	output_image = output_image[:-1]
-	output_image = os.path.join(os.path.dirname(file),output_image)
+	return str.split(output_image,'.nii')[0] + ('_2dsurqec.nii.gz' if compressed else '_2dsurqec.nii')
+
+@measured('register')
+def apply_composite(file,resolution,
+	num_threads=None,
+	output_dir=None,
+	compressed=True,
+	):
+	#TODO: does this downsample if composite file is low resolution? Currently composite file is 40um. If it does,is it a problem? Target resolution is 40 anyway, but maybe get a
+	#composite file at 25um as well? ResampleImage is possibly not needed otherwise, just specify reference image resolution of 40 and 200
+	"""
+	Uses ANTS ApplyTransforms to register image to
+
+	Parameters :
+	------------
+
+	file : str
+		path to image
+	resolution : int
+		resolution of the image, in microns.
+	num_threads : int, optional
+		number of threads ANTs may use (sets ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS).
+	output_dir : str, optional
+		directory to write the registered image to, defaults to the directory of `file`.
+	compressed : bool, optional
+		whether ANTs gzips the registered image.
+
+	"""
+	from nipype.interfaces.ants import ApplyTransforms
+	at = ApplyTransforms()
+	if num_threads:
+		at.inputs.num_threads = num_threads
+	at.inputs.dimension = 3
+	at.inputs.input_image = file
+	ref_image, resolution = get_reference_image(resolution)
+
+	if output_dir is None:
+		output_dir = os.path.dirname(file)
+	output_image = os.path.join(output_dir, registered_name(file, resolution, compressed=compressed))
 
 	at.inputs.reference_image = ref_image
-	name = str.split(os.path.basename(output_image),'.nii')[0] + '_2dsurqec.nii.gz'
 	#at.inputs.interpolation = 'NearestNeighbor' #TODO: Sure??
 	at.inputs.interpolation = 'BSpline'
-	output_image = os.path.join(os.path.dirname(output_image),name)
 	at.inputs.output_image = output_image
-	at.inputs.transforms = '/usr/share/mouse-brain-templates/abi2dsurqec_Composite.h5'
+	at.inputs.transforms = os.path.join(TEMPLATE_DIR, COMPOSITE_TRANSFORM)
 	at.run()
 
 	#TODO sform to qform
 	return output_image
 
+_file_hashes = {}
+
+def file_hash(path):
+	"""
+	Return the SHA256 hex digest of a file, memoized on its size and modification time.
+	"""
+	stat = os.stat(path)
+	key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+	if key not in _file_hashes:
+		checksum = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+				checksum.update(chunk)
+		_file_hashes[key] = checksum.hexdigest()
+	return _file_hashes[key]
+
+def sampling_map_dir(img, ref_image,
+	transform=None,
+	cache_dir=CACHE_DIR,
+	):
+	"""
+	Return the cache directory of the sampling map from the grid of `img` to `ref_image`, keyed by the transform, the reference image and the input grid.
+	"""
+	if transform is None:
+		transform = os.path.join(TEMPLATE_DIR, COMPOSITE_TRANSFORM)
+	key = hashlib.sha256()
+	key.update(file_hash(transform).encode())
+	key.update(file_hash(ref_image).encode())
+	key.update(str(img.shape[:3]).encode())
+	key.update(numpy.asarray(img.affine, dtype=numpy.float64).tobytes())
+	return os.path.join(os.path.expanduser(cache_dir), "sampling-" + key.hexdigest()[:32])
+
+def compute_sampling_map(img, ref_image, map_dir,
+	transform=None,
+	num_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	):
+	"""
+	Compute where each reference voxel samples the input grid of `img`, and store the result in `map_dir`.
+
+	ANTs is run once, with linear interpolation, on a time series of three volumes holding the voxel indices of the input grid.
+	Linear interpolation of an index is exact, so the output is the continuous input index at which `transform` samples each reference voxel.
+	Reference voxels which fall outside the input grid are dropped.
+
+	Parameters
+	----------
+	img : nibabel.Nifti1Image
+		Image defining the input grid.
+	ref_image : str
+		Path to the reference image defining the output grid.
+	map_dir : str
+		Directory to store `indices.npy` (flat reference voxel indices) and `coordinates.npy` (input voxel coordinates, 3 x N) in.
+	transform : str, optional
+		Path to the transform, defaults to `COMPOSITE_TRANSFORM` in `TEMPLATE_DIR`.
+	"""
+	import nibabel
+	from nipype.interfaces.ants import ApplyTransforms
+	print(f"Computing sampling map `{map_dir}`.")
+	if transform is None:
+		transform = os.path.join(TEMPLATE_DIR, COMPOSITE_TRANSFORM)
+	shape = img.shape[:3]
+	with tempfile.TemporaryDirectory(prefix="abi-connectivity-", dir=scratch_dir) as scratch:
+		index_image = os.path.join(scratch, "index.nii")
+		indices = numpy.indices(shape, dtype=numpy.float32)
+		nibabel.save(nibabel.Nifti1Image(numpy.moveaxis(indices, 0, -1), img.affine), index_image)
+		del indices
+		at = ApplyTransforms()
+		if num_threads:
+			at.inputs.num_threads = num_threads
+		at.inputs.dimension = 3
+		at.inputs.input_image_type = 3
+		at.inputs.input_image = index_image
+		at.inputs.reference_image = ref_image
+		at.inputs.interpolation = 'Linear'
+		at.inputs.default_value = -1
+		at.inputs.output_image = os.path.join(scratch, "sampling.nii")
+		at.inputs.transforms = transform
+		at.run()
+		sampling = numpy.asanyarray(nibabel.load(at.inputs.output_image).dataobj)
+		sampling = sampling.reshape(sampling.shape[:3] + (3,))
+		valid = (sampling >= 0).all(axis=-1)
+		indices = numpy.flatnonzero(valid)
+		coordinates = numpy.ascontiguousarray(sampling[valid].T, dtype=numpy.float32)
+
+	# Write to a private directory first, so that concurrent workers never see a partial map.
+	tmp_dir = tempfile.mkdtemp(prefix=".sampling-", dir=os.path.dirname(map_dir))
+	numpy.save(os.path.join(tmp_dir, "indices.npy"), indices)
+	numpy.save(os.path.join(tmp_dir, "coordinates.npy"), coordinates)
+	try:
+		os.rename(tmp_dir, map_dir)
+	except OSError:
+		# Another worker got there first.
+		shutil.rmtree(tmp_dir)
+
+def load_sampling_map(img, ref_image,
+	transform=None,
+	cache_dir=CACHE_DIR,
+	num_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	):
+	"""
+	Return the cached sampling map from the grid of `img` to `ref_image`, computing it if needed.
+
+	Returns
+	-------
+	indices : numpy.ndarray
+		Flat indices of the reference voxels inside the input grid.
+	coordinates : numpy.ndarray
+		Input voxel coordinates sampled by these reference voxels, 3 x N, memory-mapped.
+	"""
+	map_dir = sampling_map_dir(img, ref_image, transform=transform, cache_dir=cache_dir)
+	if not os.path.isdir(map_dir):
+		os.makedirs(os.path.dirname(map_dir), exist_ok=True)
+		compute_sampling_map(img, ref_image, map_dir, transform=transform, num_threads=num_threads, scratch_dir=scratch_dir)
+	indices = numpy.load(os.path.join(map_dir, "indices.npy"), mmap_mode='r')
+	coordinates = numpy.load(os.path.join(map_dir, "coordinates.npy"), mmap_mode='r')
+	return indices, coordinates
+
+def prepare_sampling_map(nrrd_data, resolution,
+	cache_dir=CACHE_DIR,
+	num_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	):
+	"""
+	Compute the sampling map for the grid of the NRRD file `nrrd_data` once up front, rather than concurrently in every worker of `apply_cached_composite`.
+
+	All volumes of a resolution share their grid, so any one of them will do.
+	"""
+	load_sampling_map(nrrd_to_image(nrrd_data), get_reference_image(resolution)[0], cache_dir=cache_dir, num_threads=num_threads, scratch_dir=scratch_dir)
+
+@measured('register')
+def apply_cached_composite(img, name, resolution, output_dir,
+	cache_dir=CACHE_DIR,
+	num_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	compressed=True,
+	):
+	"""
+	Register an image to DSURQEC space by cubic B-spline interpolation at the cached sampling map, as a faster alternative to `apply_composite`.
+
+	Parameters
+	----------
+	img : nibabel.Nifti1Image
+		Image in ABI space, as returned by `nrrd_to_image`.
+	name : str
+		File name the image would have as input to `apply_composite`, used to name the output.
+	resolution : int
+		Resolution of the image, in microns.
+	output_dir : str
+		Directory to write the registered image to.
+	compressed : bool, optional
+		Whether to gzip the registered image.
+
+	Returns
+	-------
+	str
+		Path to the registered image.
+	"""
+	import nibabel
+	import scipy.ndimage
+	ref_image, ref_resolution = get_reference_image(resolution)
+	indices, coordinates = load_sampling_map(img, ref_image, cache_dir=cache_dir, num_threads=num_threads, scratch_dir=scratch_dir)
+	ref = nibabel.load(ref_image)
+	data = numpy.asanyarray(img.dataobj, dtype=numpy.float32)
+	registered = numpy.zeros(ref.shape[:3], dtype=numpy.float32)
+	registered.flat[indices] = scipy.ndimage.map_coordinates(data, coordinates, order=3, mode='constant', cval=0.0)
+	out = nibabel.Nifti1Image(registered, ref.affine, ref.header)
+	out.set_data_dtype(numpy.float32)
+	output_image = os.path.join(output_dir, registered_name(name, ref_resolution, compressed=compressed))
+	nibabel.save(out, output_image)
+	return output_image
+
+@measured('register')
+def apply_composite_batch(images, names, resolution, output_dirs,
+	num_threads=None,
+	scratch_dir=SCRATCH_DIR,
+	compressed=True,
+	):
+	"""
+	Register several images on the same grid with a single ANTs ApplyTransforms call.
+
+	The images are stacked into a time series, registered with `-e 3`, and the result is split back into one file per image, named as `apply_composite` would.
+
+	Parameters
+	----------
+	images : list of nibabel.Nifti1Image
+		Images in ABI space, as returned by `nrrd_to_image`.
+	names : list of str
+		File names the images would have as input to `apply_composite`.
+	resolution : int
+		Resolution of the images, in microns.
+	output_dirs : list of str
+		Directory to write each registered image to.
+	compressed : bool, optional
+		Whether to gzip the registered images.
+
+	Returns
+	-------
+	list of str
+		Paths to the registered images.
+	"""
+	import nibabel
+	from nipype.interfaces.ants import ApplyTransforms
+	for img in images[1:]:
+		if img.shape != images[0].shape or not numpy.allclose(img.affine, images[0].affine):
+			raise ValueError("All images of a batch must share the same grid.")
+	ref_image, ref_resolution = get_reference_image(resolution)
+	output_images = []
+	with tempfile.TemporaryDirectory(prefix="abi-connectivity-", dir=scratch_dir) as scratch:
+		stack = numpy.stack([numpy.asanyarray(img.dataobj, dtype=numpy.float32) for img in images], axis=-1)
+		input_image = os.path.join(scratch, "batch.nii")
+		nibabel.save(nibabel.Nifti1Image(stack, images[0].affine), input_image)
+		del stack
+		at = ApplyTransforms()
+		if num_threads:
+			at.inputs.num_threads = num_threads
+		at.inputs.dimension = 3
+		at.inputs.input_image_type = 3
+		at.inputs.input_image = input_image
+		at.inputs.reference_image = ref_image
+		at.inputs.interpolation = 'BSpline'
+		at.inputs.output_image = os.path.join(scratch, "batch_2dsurqec.nii")
+		at.inputs.transforms = os.path.join(TEMPLATE_DIR, COMPOSITE_TRANSFORM)
+		at.run()
+		registered = nibabel.load(at.inputs.output_image)
+		data = numpy.asanyarray(registered.dataobj)
+		data = data.reshape(data.shape[:3] + (len(images),))
+		for i, (name, output_dir) in enumerate(zip(names, output_dirs)):
+			out = nibabel.Nifti1Image(data[..., i], registered.affine, registered.header)
+			output_image = os.path.join(output_dir, registered_name(name, ref_resolution, compressed=compressed))
+			nibabel.save(out, output_image)
+			output_images.append(output_image)
+	return output_images
+
+def compare_registrations(file, reference, tolerance):
+	"""
+	Check that two registered images agree to within `tolerance`, relative to the maximum absolute value of `reference`.
+
+	Returns
+	-------
+	float
+		The relative maximum absolute difference.
+	"""
+	import nibabel
+	data = numpy.asanyarray(nibabel.load(file).dataobj, dtype=numpy.float64)
+	reference_data = numpy.asanyarray(nibabel.load(reference).dataobj, dtype=numpy.float64)
+	scale = numpy.abs(reference_data).max() or 1.0
+	error = numpy.abs(data - reference_data).max() / scale
+	if error > tolerance:
+		raise ValueError(f"Cached registration of `{file}` deviates from ANTs by {error:.2e} (relative), exceeding the tolerance of {tolerance:.2e}.")
+	print(f"Cached registration of `{file}` agrees with ANTs to {error:.2e} (relative).")
+	return error
+
+@measured('encode')
+def encode_volume(source, target,
+	encoding=None,
+	threads=1,
+	):
+	"""
+	Write a registered volume as gzipped NIfTI in the given output encoding.
+
+	Integer encodings store the data scaled by `scl_slope` and offset by `scl_inter`, spanning the value range of the volume with zero kept exact, so that the quantization error is at most half a step.
+	Compression runs block-parallel on `threads` threads, see `_ParallelGzipWriter`, and the target is replaced atomically.
+
+	Parameters
+	----------
+	source : str
+		Path to the registered volume.
+	target : str
+		Path of the `.nii.gz` file to write.
+	encoding : dict, optional
+		Output `dtype` (one of `OUTPUT_DTYPES`), gzip `compression_level`, and `max_error`, the largest acceptable quantization error relative to the maximum absolute value, or None; defaults to `DEFAULT_ENCODING`.
+	threads : int, optional
+		Number of compression threads.
+
+	Returns
+	-------
+	dict
+		The encoding actually used, with the scaling and the maximum absolute quantization error of integer encodings, as recorded in the sidecar.
+	"""
+	import nibabel
+	encoding = dict(DEFAULT_ENCODING, **(encoding or {}))
+	dtype = numpy.dtype(encoding['dtype'])
+	img = nibabel.load(source)
+	data = numpy.asanyarray(img.dataobj, dtype=numpy.float32)
+	record = {'dtype': dtype.name, 'compression_level': encoding['compression_level']}
+	if dtype.kind in 'iu':
+		low, high = min(float(data.min()), 0.0), max(float(data.max()), 0.0)
+		info = numpy.iinfo(dtype)
+		if dtype.kind == 'i':
+			# Symmetric, so that negative interpolation overshoots keep their sign.
+			slope = numpy.float32(max(-low, high) / info.max or 1.0)
+			offset = 0
+		else:
+			# One step is reserved for rounding the offset of zero to a whole number of steps.
+			slope = (high - low) / (info.max - (low < 0)) or 1.0
+			if low < 0:
+				# Round the slope up to 8 significant bits, so that the 16 bit offset times the slope, and thus zero, is exact in float32.
+				mantissa, exponent = numpy.frexp(slope)
+				slope = numpy.ldexp(numpy.ceil(mantissa * 256) / 256, exponent)
+			slope = numpy.float32(slope)
+			offset = int(numpy.ceil(-low / slope))
+		inter = numpy.float32(-offset * float(slope))
+		quantized = numpy.clip(numpy.rint(data / slope) + offset, info.min, info.max).astype(dtype)
+		error = float(numpy.abs(quantized.astype(numpy.float32) * slope + inter - data).max())
+		scale = max(-low, high) or 1.0
+		if encoding['max_error'] is not None and error / scale > encoding['max_error']:
+			raise ValueError(f"Quantization of `{source}` to {dtype.name} has a relative error of {error / scale:.2e}, exceeding the maximum of {encoding['max_error']:.2e}.")
+		print(f"Encoded `{target}` as {dtype.name}, with a maximum quantization error of {error:.3g} ({error / scale:.2e} relative).")
+		out = nibabel.Nifti1Image(quantized, img.affine, img.header)
+		out.set_data_dtype(dtype)
+		out.header.set_slope_inter(slope, inter)
+		record.update({'scl_slope': float(slope), 'scl_inter': float(inter), 'quantization_error': error})
+	else:
+		out = nibabel.Nifti1Image(data, img.affine, img.header)
+		out.set_data_dtype(dtype)
+	tmp_path = target + ".tmp"
+	with open(tmp_path, 'wb') as handle:
+		writer = _ParallelGzipWriter(handle, threads, encoding['compression_level'])
+		out.to_stream(writer)
+		writer.close()
+	os.replace(tmp_path, target)
+	return record
+
 def download_annotation_file(path):
-	anno_url_json = "http://api.brain-map.org/api/v2/structure_graph_download/1.json"
-	anno_url_xml = "http://api.brain-map.org/api/v2/structure_graph_download/1.xml"
+	"""
+	Download the structure hierarchy as JSON and XML into `path`.
+
+	Each file is replaced atomically, so that concurrent runs, e.g. the shards of a build, never leave a partially written one.
+	"""
+	anno_url_json = API_SERVER + "api/v2/structure_graph_download/1.json"
+	anno_url_xml = API_SERVER + "api/v2/structure_graph_download/1.xml"
 	filename_xml = "structure_graph.xml"
-	filename_json = "structure_graph.json"
+	filename_json = STRUCTURE_GRAPH_FILENAME
 
-	s = urllib.request.urlopen(anno_url_json)
-	contents = s.read()
-	file = open(os.path.join(path,filename_json), 'wb')
-	file.write(contents)
-	file.close()
+	for url, filename in ((anno_url_json, filename_json), (anno_url_xml, filename_xml)):
+		contents = fetch_url(url)
+		target = os.path.join(path, filename)
+		tmp_path = f"{target}.{os.getpid()}.tmp"
+		with open(tmp_path, 'wb') as f:
+			f.write(contents)
+		os.replace(tmp_path, target)
 
-	s = urllib.request.urlopen(anno_url_xml)
-	contents = s.read()
-	file = open(os.path.join(path,filename_xml), 'wb')
-	file.write(contents)
-	file.close()
 
+def _normalize_tarinfo(tarinfo):
+	tarinfo.mtime = ARCHIVE_MTIME
+	tarinfo.uid = tarinfo.gid = 0
+	tarinfo.uname = tarinfo.gname = ""
+	tarinfo.mode = 0o755 if tarinfo.isdir() else 0o644
+	return tarinfo
+
+
+class _ParallelBlockWriter(io.RawIOBase):
+	"""
+	Writable file object which compresses blocks of its input on `jobs` threads, and writes them to `handle` in order.
+
+	Compressed blocks are written as soon as more than two per thread are pending, which bounds memory use however much is written.
+	Subclasses implement `_compress`, and submit blocks to it with `_submit`.
+	"""
+	def __init__(self, handle, jobs, block_size):
+		self.handle = handle
+		self.jobs = jobs
+		self.block_size = block_size
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+		self.pending = []
+		self.buffer = bytearray()
+
+	def writable(self):
+		return True
+
+	def _compress(self, block, *args):
+		raise NotImplementedError
+
+	def _submit(self, block, *args):
+		self.pending.append(self.executor.submit(self._compress, block, *args))
+		self._drain(2 * self.jobs)
+
+	def _drain(self, limit):
+		while len(self.pending) > limit:
+			self._write_block(self.pending.pop(0).result())
+
+	def _write_block(self, compressed):
+		self.handle.write(compressed)
+
+	def _finish(self):
+		self._drain(0)
+		self.executor.shutdown()
 
-def create_archive(tar_path, files_path):
-	with tarfile.open(tar_path, "w:xz") as tar_handle:
-		tar_handle.add(files_path, arcname=os.path.basename(files_path))
+
+class _ParallelXZWriter(_ParallelBlockWriter):
+	"""
+	Writable file object which compresses its input in independent blocks on `jobs` threads, and writes them to `handle` in order.
+
+	Each block becomes a complete xz stream. Concatenated streams are valid xz, readable by `xz -d` and `tar -xJf`.
+	The SHA512 checksum of the compressed output is updated as it is written.
+	"""
+	def __init__(self, handle, jobs, preset, block_size):
+		super().__init__(handle, jobs, block_size)
+		self.preset = preset
+		self.checksum = hashlib.sha512()
+
+	def write(self, data):
+		self.buffer.extend(data)
+		while len(self.buffer) >= self.block_size:
+			self._submit(bytes(self.buffer[:self.block_size]))
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	def close(self):
+		if not self.closed:
+			if self.buffer:
+				self._submit(bytes(self.buffer))
+				self.buffer.clear()
+			self._finish()
+		super().close()
+
+	def _compress(self, block):
+		return lzma.compress(block, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=self.preset)
+
+	def _write_block(self, compressed):
+		self.checksum.update(compressed)
+		super()._write_block(compressed)
+
+
+class _ParallelGzipWriter(_ParallelBlockWriter):
+	"""
+	Writable file object which deflates its input in blocks on `jobs` threads, and writes them to `handle` as a single gzip member, as pigz does.
+
+	Each block is primed with the last 32 KiB of the previous one, so that the compression ratio stays close to that of serial gzip.
+	All but the last block end on a byte boundary (sync flush), so the raw deflate blocks can simply be concatenated.
+	"""
+	def __init__(self, handle, jobs, level, block_size=1024 * 1024):
+		super().__init__(handle, jobs, block_size)
+		self.level = level
+		self.crc = 0
+		self.size = 0
+		self.dictionary = b''
+		# Magic, deflate, no flags, no modification time, no extra flags, unknown OS.
+		self.handle.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+	def tell(self):
+		return self.size
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		# Only seeks to the current position, as nibabel makes before writing, are possible on a stream.
+		if (offset, whence) not in ((self.size, io.SEEK_SET), (0, io.SEEK_CUR)):
+			raise io.UnsupportedOperation("seek")
+		return self.size
+
+	def write(self, data):
+		data = memoryview(data).cast('B')
+		self.buffer.extend(data)
+		self.crc = zlib.crc32(data, self.crc)
+		self.size += len(data)
+		# Keep a block back, as the last one has to be finished rather than flushed.
+		while len(self.buffer) > self.block_size:
+			self._submit(bytes(self.buffer[:self.block_size]), False)
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	def close(self):
+		if not self.closed:
+			self._submit(bytes(self.buffer), True)
+			self.buffer.clear()
+			self._finish()
+			self.handle.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+		super().close()
+
+	def _submit(self, block, last):
+		super()._submit(block, self.dictionary, last)
+		self.dictionary = block[-32 * 1024:]
+
+	def _compress(self, block, dictionary, last):
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, **({'zdict': dictionary} if dictionary else {}))
+		return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+@measured('archive')
+def create_archive(tar_path, files_path,
+	arcname=None,
+	exclude=(),
+	jobs=1,
+	preset=6,
+	block_size=24 * 1024 * 1024,
+	):
+	"""
+	Create a reproducible xz-compressed tarball of a directory, and its SHA512 checksum file.
+
+	Files are added in sorted order, dereferencing symlinks, with normalized modification times, owners and modes, so that identical inputs give identical archives.
+	Compression runs block-parallel on `jobs` threads, and the checksum is computed on the compressed stream as it is written.
+
+	Parameters
+	----------
+	tar_path : str
+		Path of the archive to create, e.g. `ABI-connectivity-data-0.3.tar.xz`.
+	files_path : str
+		Directory to archive.
+	arcname : str, optional
+		Name of the top-level directory in the archive, defaults to the base name of `files_path`.
+	exclude : iterable of str, optional
+		Paths relative to `files_path` to leave out of the archive.
+	jobs : int, optional
+		Number of compression threads.
+	preset : int, optional
+		xz compression preset.
+	block_size : int, optional
+		Uncompressed bytes per independently compressed block.
+
+	Returns
+	-------
+	str
+		SHA512 hex digest of the archive, also written to `<name>.sha512` next to it in `sha512sum` format.
+	"""
+	if arcname is None:
+		arcname = os.path.basename(os.path.normpath(files_path))
+	excluded = {f"{arcname}/{os.path.normpath(path)}".replace(os.sep, "/") for path in exclude}
+	def normalize(tarinfo):
+		if tarinfo.name in excluded:
+			return None
+		return _normalize_tarinfo(tarinfo)
+	tmp_path = tar_path + ".tmp"
+	with open(tmp_path, 'wb') as handle:
+		writer = _ParallelXZWriter(handle, jobs, preset, block_size)
+		with tarfile.open(fileobj=writer, mode="w|", dereference=True, format=tarfile.PAX_FORMAT) as tar_handle:
+			tar_handle.add(files_path, arcname=arcname, filter=normalize)
+		writer.close()
+	os.replace(tmp_path, tar_path)
+
+	digest = writer.checksum.hexdigest()
+	checksum_path = re.sub(r"(\.tar)?\.xz$", "", tar_path) + ".sha512"
+	with open(checksum_path, 'w') as f:
+		f.write(f"{digest}  {os.path.basename(tar_path)}\n")
+	return digest
 
 
 #TODO: Do I really need that? Useful for expression data, but here?
@@ -423,36 +3298,169 @@ def save_info(info,dir_name):
 		f.write(str(exp))
 
 def main():
-	#TODO: some sort of parallel download should be possible, stating totalrows and startrows differently for simultaneous download
+	global CONNECTIONS_PER_HOST
 	parser = argparse.ArgumentParser(description="Similarity",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument('--download-only', action='store_true', help='Only download source data.')
 	parser.add_argument('--process-only', action='store_true', help='Only process already present source data.')
 	parser.add_argument('--bids-only', action='store_true', help='Only reformat data to pseudo-BIDS.')
+	parser.add_argument('--archive', action='store_true', help=f'Additionally package the pseudo-BIDS data as a release archive, with SHA512 checksum file. `{MATRIX_FILENAME}` and `{STRUCTURE_SUMMARY_FILENAME}` are left out of it.')
 	parser.add_argument('--version','-v',type=str,default="9999")
 	parser.add_argument('--startRow','-s',type=int,default=0)
 	parser.add_argument('--numRows','-r',type=int,default=2000)
 	parser.add_argument('--totalRows','-t',type=int,default=-1)
-	parser.add_argument('--resolution','-x',type=int)
+	parser.add_argument('--resolution','-x',type=int,nargs='+',help='Resolution(s) of the source volumes, in microns. Several resolutions, e.g. `-x 100 25`, are built in one run: metadata is queried once, downloads run concurrently, and high-resolution data always goes to `*HD` directories and archives.')
+	parser.add_argument('--jobs','-j',type=int,default=1,help='Number of experiments to download or process concurrently.')
+	parser.add_argument('--ants-threads',type=int,help='Number of threads each ANTs registration may use. Defaults to the CPU count divided by `--jobs`.')
+	parser.add_argument('--scratch-dir',type=str,help=f'Directory for intermediate uncompressed NIfTI files, ideally memory-backed. Each concurrent job needs room for a few uncompressed volumes. Defaults to `{MEMORY_SCRATCH_DIR}` if it has enough free space for all jobs, and to the system temporary directory otherwise.')
+	parser.add_argument('--registration',type=str,choices=['ants','cached'],default='ants',help='Register each volume with ANTs, or by interpolation at a sampling map computed once with ANTs and cached.')
+	parser.add_argument('--cache-dir',type=str,default=CACHE_DIR,help='Directory for cached sampling maps and, with `--offline` and no `--http-cache-dir`, the HTTP cache.')
+	parser.add_argument('--batch-size',type=int,default=1,help='Number of experiments to register in a single ANTs call, as one 4D volume. Each job holds this many uncompressed volumes in memory.')
+	parser.add_argument('--output-dtype',type=str,choices=OUTPUT_DTYPES,default=DEFAULT_ENCODING['dtype'],help='Data type of the registered volumes. Integer types store the data scaled with `scl_slope`/`scl_inter`, at a quantization error of at most half a step (about 8e-6 of the maximum for uint16, 2e-5 for int16), which is recorded in the pseudo-BIDS sidecar.')
+	parser.add_argument('--max-quantization-error',type=float,help='Fail experiments whose quantization error with an integer `--output-dtype`, relative to the maximum absolute value, exceeds this.')
+	parser.add_argument('--compression-level',type=int,choices=range(10),default=DEFAULT_ENCODING['compression_level'],metavar='{0-9}',help='Gzip compression level of the registered volumes. Compression runs on the `--ants-threads` of each job.')
+	parser.add_argument('--validate-tolerance',type=float,help='Also register each volume with ANTs when using `--registration=cached`, and fail experiments whose relative maximum deviation exceeds this tolerance.')
+	parser.add_argument('--query-cache-ttl',type=float,default=0,help='Seconds for which API query responses in the HTTP cache are reused without revalidating them. Needs the HTTP cache, see `--http-cache-dir`.')
+	parser.add_argument('--http-cache-dir',type=str,help='Route all API responses and downloads through a content-addressed cache in this directory, e.g. for `--offline` rebuilds. Downloaded volumes are hard links to the cache, so keep it on the same filesystem as the data; elsewhere they are copies, and take their space twice. No cache is used unless this or `--offline` is given.')
+	parser.add_argument('--http-cache-size',type=float,default=HTTP_CACHE_SIZE / 2**30,help='Size in GiB beyond which the least recently used cached responses are evicted; 0 disables the HTTP cache.')
+	parser.add_argument('--offline',action='store_true',help='Serve all API responses and downloads from the HTTP cache, without network access. The cache defaults to `http/` in `--cache-dir`.')
+	parser.add_argument('--per-experiment-metadata',action='store_true',help='Request the XML metadata of each experiment separately, instead of writing it from the bulk query response.')
+	parser.add_argument('--link-mode',type=str,choices=LINK_MODES,default='copy',help='How to materialize pseudo-BIDS volumes from the processed data. Links fall back to copies where unsupported.')
+	parser.add_argument('--stream',action='store_true',help='Download, process and reformat each experiment as soon as the previous stage is done with it, instead of one stage for all experiments at a time. Only applies when no stage is selected with the `--*-only` flags.')
+	parser.add_argument('--queue-size',type=int,help='Maximum number of downloaded experiments waiting to be processed when using `--stream`. Defaults to twice `--jobs`.')
+	parser.add_argument('--delete-source',action='store_true',help='Delete each NRRD volume once its processed volume is verified when using `--stream`, to bound disk use.')
+	parser.add_argument('--metrics-log',type=str,nargs='?',const=METRICS_FILENAME,help=f'Record per-stage and per-experiment timing, I/O and memory measurements to this JSON-lines file (`{METRICS_FILENAME}` if no file is given), which is truncated first, and summarize them at the end of the run.')
+	parser.add_argument('--matrix',action='store_true',help=f'Additionally consolidate the pseudo-BIDS volumes into a single chunked HDF5 experiment-by-voxel matrix, `{MATRIX_FILENAME}` in the pseudo-BIDS directory.')
+	parser.add_argument('--structures',action='store_true',help=f'Additionally reduce the pseudo-BIDS volumes to a table of mean projection density per brain structure, including its descendants in the structure graph, `{STRUCTURE_SUMMARY_FILENAME}` in the pseudo-BIDS directory.')
+	parser.add_argument('--annotation',type=str,help='Structure annotation on the grid of the registered volumes for `--structures`. Defaults to the ABI annotation registered to the DSURQEC template of the resolution, in the template directory.')
+	parser.add_argument('--force',action='store_true',help='Process all experiments, even those whose processed data is up to date with their inputs.')
+	parser.add_argument('--dry-run',action='store_true',help='Only report which experiments would be processed, and why, then exit.')
+	parser.add_argument('--connections-per-host',type=int,default=CONNECTIONS_PER_HOST,help='Maximum number of simultaneous requests to any one host.')
+	parser.add_argument('--api-server',type=str,default=API_SERVER,help='Base URL of the Allen Brain Institute API, e.g. a local stand-in for testing.')
+	parser.add_argument('--shard',type=parse_shard,metavar='i/N',help='Only download and process the experiments of shard `i` (counting from 0) of `N`, partitioned by a hash of the experiment ID, e.g. `--shard $SLURM_ARRAY_TASK_ID/8` in a job array. Shards keep their own manifest, query rows, metadata index and metrics log, so they may run at the same time on shared directories. Pseudo-BIDS data, `--matrix`, `--structures` and `--archive` are left to `--merge`.')
+	parser.add_argument('--merge',action='store_true',help='Combine the manifests of all shards of a `--shard` build, check that every experiment was processed, and write the pseudo-BIDS data, as well as `--matrix`, `--structures` and `--archive` if given.')
+	parser.add_argument('--query',type=parse_query_criterion,action='append',metavar='COLUMN=VALUE',help=f'Print the experiments in the source data metadata index matching all given column values as JSON lines, then exit. Columns: {", ".join(METADATA_INDEX_COLUMNS)}.')
 	args=parser.parse_args()
+	if args.shard and args.merge:
+		parser.error("`--shard` and `--merge` are mutually exclusive.")
+	if args.shard and (args.archive or args.matrix or args.structures):
+		parser.error("`--archive`, `--matrix` and `--structures` cover all shards, and are only built with `--merge`.")
+	if args.structures:
+		for annotation in sorted({args.annotation or get_annotation_image(resolution) for resolution in args.resolution or [None]}):
+			if not os.path.isfile(annotation):
+				parser.error(f"No structure annotation at `{annotation}` for `--structures`, give its path with `--annotation`.")
+	http_cache = args.offline or bool(args.http_cache_dir) and args.http_cache_size > 0
+	if args.query_cache_ttl > 0 and not http_cache:
+		parser.error("`--query-cache-ttl` needs the HTTP cache, see `--http-cache-dir`.")
+
+	CONNECTIONS_PER_HOST = args.connections_per_host
+	encoding = {'dtype': args.output_dtype, 'compression_level': args.compression_level, 'max_error': args.max_quantization_error}
+	set_api_server(args.api_server)
+	set_shard(args.shard)
+	if http_cache:
+		set_http_cache(args.http_cache_dir or os.path.join(args.cache_dir, "http"), max_size=int(args.http_cache_size * 2**30), offline=args.offline)
 
 	now = datetime.today().strftime('%Y-%m-%dT%H:%M:%S')
-	source_dir_name = os.path.join("sourcedata")
-	procdata_dir_name = os.path.join("procdata")
-	bids_dir_name = os.path.join("bids")
-	Path(source_dir_name).mkdir(parents=True, exist_ok=True)
-	download_annotation_file(source_dir_name)
-	if (args.download_only and not args.process_only and not args.bids_only) or (not args.download_only and not args.process_only and not args.bids_only):
-		info=get_exp_id(startRow=args.startRow,numRows=args.numRows,totalRows=args.totalRows)
+	resolutions = args.resolution or [None]
+	multiple = len(resolutions) > 1
+	layouts = {resolution: dataset_dirs(resolution) for resolution in resolutions}
+	source_dir_name, procdata_dir_name, bids_dir_name = layouts[resolutions[0]]
+	if args.query:
+		criteria = dict(args.query)
+		if not os.path.isdir(source_dir_name):
+			print(f"❌No source data to query in `{source_dir_name}`, download it first.", file=sys.stderr)
+			sys.exit(1)
+		for experiment in query_metadata_index(build_metadata_index(source_dir_name), **criteria):
+			print(json.dumps(experiment))
+		return
+	if args.dry_run:
+		for resolution, (source_dir, procdata_dir, _) in layouts.items():
+			process_data(source_dir, procdata_dir=procdata_dir, resolution=resolution, registration=args.registration, force=args.force, dry_run=True, encoding=encoding)
+		return
+	if args.shard and args.metrics_log:
+		args.metrics_log = shard_filename(args.metrics_log)
+	set_metrics_log(args.metrics_log or None)
+	for source_dir, _, _ in layouts.values():
+		Path(source_dir).mkdir(parents=True, exist_ok=True)
+	all_stages = not args.download_only and not args.process_only and not args.bids_only
+	download = args.download_only and not args.process_only and not args.bids_only or all_stages
+	process = args.process_only and not args.download_only and not args.bids_only or all_stages
+	bids = args.bids_only and not args.download_only and not args.process_only or all_stages
+	if args.merge:
+		download = process = False
+		bids = True
+	elif args.shard and bids:
+		# Pseudo-BIDS files are named by seed and Cre line, so experiments of different shards may share one.
+		print("Pseudo-BIDS data is written once all shards are done, with `--merge`.")
+		bids = False
+	if process and args.scratch_dir is None:
+		required = max(scratch_bytes(resolution, args.jobs, args.batch_size) for resolution in resolutions)
+		args.scratch_dir = default_scratch_dir(required)
+		if args.scratch_dir != MEMORY_SCRATCH_DIR:
+			print(f"`{MEMORY_SCRATCH_DIR}` has less than the {required / 2**20:.0f} MiB of scratch space needed, using `{args.scratch_dir}`.")
+	info = rows = None
+	if download:
+		if not args.shard or args.shard[0] == 0:
+			# The hierarchy is the same for all shards, so only the first one fetches it; `--merge --structures` fetches it if missing.
+			download_annotation_file(source_dir_name)
+		rows_path = os.path.join(source_dir_name, shard_filename(QUERY_FILENAME))
+		info=get_exp_id(startRow=args.startRow,numRows=args.numRows,totalRows=args.totalRows,rows_path=rows_path,jobs=args.jobs,cache_ttl=args.query_cache_ttl)
+		if args.per_experiment_metadata and multiple:
+			print("Metadata is written from the query response when building several resolutions, so that it is not requested once per resolution.")
+		rows = None if args.per_experiment_metadata and not multiple else load_exp_rows(rows_path)
+		for source_dir, _, _ in layouts.values():
+			if source_dir != source_dir_name:
+				shutil.copyfile(rows_path, os.path.join(source_dir, shard_filename(QUERY_FILENAME)))
 		# In case there are any failures, the specific ID can be investigated by redefining `info` here.
 		#print(info)
 		#info = info[:3]
 		#info = [157556400, 311845972]
 		#print(info)
-		get_sourcedata(info, dir_name=source_dir_name, resolution=args.resolution)
-	if args.process_only and not args.download_only and not args.bids_only or (not args.download_only and not args.process_only and not args.bids_only):
-		process_data(source_dir_name, procdata_dir=procdata_dir_name, resolution=args.resolution)
-	if args.bids_only and not args.download_only and not args.process_only or (not args.download_only and not args.process_only and not args.bids_only):
-		bids_rename(procdata_dir_name, bids_dir_name)
+	# Registration saturates the CPUs on its own, so resolutions take turns processing while the others download.
+	# Streaming interleaves both, so resolutions take turns streaming altogether.
+	processing = threading.Lock()
+
+	def build(resolution):
+		source_dir, procdata_dir, bids_dir = layouts[resolution]
+		failures = {}
+		if args.stream and all_stages and not args.merge:
+			with processing:
+				failures.update(stream_data(info, source_dir, procdata_dir, bids_dir if bids else None, resolution=resolution, jobs=args.jobs, ants_threads=args.ants_threads, scratch_dir=args.scratch_dir, registration=args.registration, cache_dir=args.cache_dir, link_mode=args.link_mode, rows=rows, queue_size=args.queue_size, delete_source=args.delete_source, force=args.force, encoding=encoding))
+		else:
+			if args.merge:
+				failures.update(merge_shards(source_dir, procdata_dir, resolution=resolution, registration=args.registration, encoding=encoding))
+			if download:
+				failures.update(get_sourcedata(info, dir_name=source_dir, resolution=resolution, jobs=args.jobs, rows=rows))
+			if process:
+				with processing:
+					failures.update(process_data(source_dir, procdata_dir=procdata_dir, resolution=resolution, jobs=args.jobs, ants_threads=args.ants_threads, scratch_dir=args.scratch_dir, registration=args.registration, cache_dir=args.cache_dir, validate_tolerance=args.validate_tolerance, batch_size=args.batch_size, force=args.force, encoding=encoding))
+			if bids:
+				bids_rename(procdata_dir, bids_dir, link_mode=args.link_mode)
+		if args.matrix:
+			matrix_path = os.path.join(bids_dir, MATRIX_FILENAME)
+			count = write_connectivity_matrix(bids_dir, matrix_path, resolution=resolution)
+			print(f"Wrote {count} experiments to `{matrix_path}`.")
+		if args.structures:
+			structure_graph = os.path.join(source_dir_name, STRUCTURE_GRAPH_FILENAME)
+			if not os.path.isfile(structure_graph):
+				download_annotation_file(source_dir_name)
+			summary_path = os.path.join(bids_dir, STRUCTURE_SUMMARY_FILENAME)
+			count = write_structure_summary(bids_dir, summary_path, structure_graph, annotation=args.annotation, resolution=resolution, jobs=args.jobs)
+			print(f"Summarized {count} experiments by structure to `{summary_path}`.")
+		if args.archive:
+			package = f"{PACKAGE_NAME}{dataset_suffix(resolution)}-{args.version}"
+			# The matrix and structure summary are derived from the volumes, and are not part of the release.
+			digest = create_archive(package + ".tar.xz", bids_dir, arcname=package, exclude=(MATRIX_FILENAME, STRUCTURE_SUMMARY_FILENAME), jobs=args.jobs)
+			print(f"Created `{package}.tar.xz` (SHA512 {digest}).")
+		return failures
+
+	failures = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(resolutions)) as executor:
+		for resolution, resolution_failures in zip(resolutions, executor.map(build, resolutions)):
+			failures.update({(resolution, key): e for key, e in resolution_failures.items()})
+	if args.metrics_log:
+		summarize_metrics(args.metrics_log)
+	if failures:
+		sys.exit(1)
 
 
 if __name__ == "__main__":
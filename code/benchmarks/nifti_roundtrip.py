@@ -0,0 +1,102 @@
+"""
+Benchmark the intermediate NIfTI round-trip of `process_experiment`.
+
+Compares writing the uncompressed NIfTI next to the processed data (the former behaviour) against writing it to the memory-backed scratch directory, reporting wall time and the bytes each path causes to be written to storage.
+The file is read back once, as ANTs would, and the intermediate files of both paths are checked for bit-identity.
+
+Usage:
+	python code/benchmarks/nifti_roundtrip.py --resolution 25 --repeats 3
+	python code/benchmarks/nifti_roundtrip.py --nrrd sourcedata/<experiment>/<file>.nrrd --target-dir procdata
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import nrrd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import abi_connectivity
+
+
+def synthetic_nrrd(path, resolution,
+	encoding='gzip',
+	):
+	shape = tuple(int(round(s * 100 / resolution)) for s in abi_connectivity.ABI_GRID_100UM)
+	data = numpy.random.default_rng(0).random(shape, dtype=numpy.float32)
+	header = {
+		'space': 'left-posterior-superior',
+		'space directions': numpy.eye(3) * resolution,
+		'encoding': encoding,
+		}
+	nrrd.write(path, data, header)
+	return path
+
+
+def storage_write_bytes():
+	"""Bytes this process caused to be written to storage, see proc(5)."""
+	with open("/proc/self/io") as f:
+		for line in f:
+			if line.startswith("write_bytes:"):
+				return int(line.split()[1])
+
+
+def roundtrip(nrrd_path, nii_dir):
+	os.sync()
+	written = storage_write_bytes()
+	start = time.perf_counter()
+	nii_path = abi_connectivity.nrrd_to_nifti(nrrd_path, nii_dir)
+	checksum = hashlib.sha256()
+	with open(nii_path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			checksum.update(chunk)
+	size = os.path.getsize(nii_path)
+	os.remove(nii_path)
+	os.sync()
+	elapsed = time.perf_counter() - start
+	return elapsed, storage_write_bytes() - written, size, checksum.hexdigest()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--nrrd', type=str, help='NRRD volume to convert, a synthetic one is generated if omitted.')
+	parser.add_argument('--resolution', '-x', type=int, default=100, help='Resolution of the synthetic volume, in microns.')
+	parser.add_argument('--target-dir', type=str, help='On-disk directory standing in for `procdata/`, a temporary directory in the working directory if omitted.')
+	parser.add_argument('--scratch-dir', type=str, default=abi_connectivity.MEMORY_SCRATCH_DIR)
+	parser.add_argument('--repeats', '-n', type=int, default=3)
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix="nifti-roundtrip-", dir=".")
+	try:
+		nrrd_path = args.nrrd or synthetic_nrrd(os.path.join(workdir, "projection_density.nrrd"), args.resolution)
+		target_dir = args.target_dir or workdir
+		scratch_dir = tempfile.mkdtemp(prefix="nifti-roundtrip-", dir=args.scratch_dir)
+		results = {'disk': [], 'scratch': []}
+		for _ in range(args.repeats):
+			results['disk'].append(roundtrip(nrrd_path, target_dir))
+			results['scratch'].append(roundtrip(nrrd_path, scratch_dir))
+		shutil.rmtree(scratch_dir)
+	finally:
+		shutil.rmtree(workdir)
+
+	identical = len({r[3] for runs in results.values() for r in runs}) == 1
+	print(f"\nIntermediate NIfTI: {results['disk'][0][2] / 1e6:.1f} MB, bit-identical across paths: {identical}")
+	print(f"{'path':<10}{'wall time [s]':>16}{'storage writes [MB]':>22}")
+	for name, runs in results.items():
+		elapsed = numpy.median([r[0] for r in runs])
+		written = numpy.median([r[1] for r in runs])
+		print(f"{name:<10}{elapsed:>16.3f}{written / 1e6:>22.1f}")
+	saved_time = numpy.median([r[0] for r in results['disk']]) - numpy.median([r[0] for r in results['scratch']])
+	saved_bytes = numpy.median([r[1] for r in results['disk']]) - numpy.median([r[1] for r in results['scratch']])
+	print(f"Saved per experiment: {saved_time:.3f} s and {saved_bytes / 1e6:.1f} MB of storage writes.")
+	if not identical:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,97 @@
+"""
+Benchmark `nrrd_to_nifti` against the former swapaxes/reverse implementation.
+
+Each variant runs in its own process, so that its peak RSS can be measured.
+The NIfTI files written by both variants are checked to be voxel-identical, with the same affine, and the script exits non-zero otherwise.
+
+Usage:
+	python code/benchmarks/nrrd_to_nifti.py --resolution 25 --encoding raw
+"""
+
+import argparse
+import concurrent.futures
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import nibabel
+import numpy
+import nrrd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import abi_connectivity
+from nifti_roundtrip import synthetic_nrrd
+
+
+def legacy_nrrd_to_nifti(file, target_dir):
+	readnrrd = nrrd.read(file)
+	data = readnrrd[0]
+	header = readnrrd[1]
+
+	affine_matrix = numpy.array(header["space directions"],dtype=float)
+	affine_matrix = affine_matrix*0.001
+	affine_matrix = numpy.insert(affine_matrix,3,[0,0,0], axis=1)
+	affine_matrix = numpy.insert(affine_matrix,3,[0,0,0,1], axis=0)
+
+	data.setflags(write=1)
+	data = numpy.swapaxes(data,0,2)
+	data = numpy.swapaxes(data,1,2)
+	data = data[:,:,::-1]
+	data = data[:,::-1,:]
+	data = data[::-1,:,:]
+	img = nibabel.Nifti1Image(data,affine_matrix)
+	nii_path = os.path.join(target_dir, os.path.basename(file).split(".")[0] + '.nii')
+	nibabel.save(img,nii_path)
+	return nii_path
+
+
+def run(variant, nrrd_path, target_dir):
+	start = time.perf_counter()
+	if variant == 'legacy':
+		nii_path = legacy_nrrd_to_nifti(nrrd_path, target_dir)
+	else:
+		nii_path = abi_connectivity.nrrd_to_nifti(nrrd_path, target_dir)
+	elapsed = time.perf_counter() - start
+	# Kilobytes on Linux.
+	return nii_path, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--nrrd', type=str, help='NRRD volume to convert, a synthetic one is generated if omitted.')
+	parser.add_argument('--resolution', '-x', type=int, default=100, help='Resolution of the synthetic volume, in microns.')
+	parser.add_argument('--encoding', type=str, choices=['gzip', 'raw'], default='gzip', help='Encoding of the synthetic volume.')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix="nrrd-to-nifti-", dir=".")
+	try:
+		nrrd_path = args.nrrd or synthetic_nrrd(os.path.join(workdir, "projection_density.nrrd"), args.resolution, encoding=args.encoding)
+		results = {}
+		for variant in ('legacy', 'current'):
+			target_dir = os.path.join(workdir, variant)
+			os.makedirs(target_dir)
+			with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+				results[variant] = executor.submit(run, variant, nrrd_path, target_dir).result()
+
+		legacy = nibabel.load(results['legacy'][0])
+		current = nibabel.load(results['current'][0])
+		identical = (
+			numpy.array_equal(numpy.asanyarray(legacy.dataobj), numpy.asanyarray(current.dataobj))
+			and numpy.array_equal(legacy.affine, current.affine)
+			)
+	finally:
+		shutil.rmtree(workdir)
+
+	print(f"\nOutputs voxel-identical: {identical}")
+	print(f"{'variant':<10}{'wall time [s]':>16}{'peak RSS [MB]':>16}")
+	for variant, (_, elapsed, rss) in results.items():
+		print(f"{variant:<10}{elapsed:>16.3f}{rss / 1e6:>16.1f}")
+	if not identical:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
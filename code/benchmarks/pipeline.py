@@ -0,0 +1,269 @@
+"""
+Benchmark the pipeline stages end to end against synthetic experiments served by a local API stand-in.
+
+Synthetic projection density volumes are generated on the ABI CCF grid at the requested resolution, with the NRRD header fields of the real downloads, and served together with `query.json` and `query.xml` responses from a local HTTP server.
+The server supports keep-alive, `Range` and `If-Range` requests and optionally adds a fixed latency per request, so that no traffic reaches api.brain-map.org.
+
+Each stage (`get_exp_id`, `get_sourcedata`, `nrrd_to_nifti`, `process_data`, `bids_rename`, `create_archive`) is timed in turn, and the per-stage metrics log of `abi_connectivity` is summarized.
+Registration needs ANTs and the DSURQEC templates; without them `process_data` is skipped, and the processed data for the later stages is made of the converted but unregistered volumes instead.
+
+Usage:
+	python code/benchmarks/pipeline.py --experiments 16 --jobs 4
+	python code/benchmarks/pipeline.py --resolution 25 --experiments 4 --latency 0.05 --output bench-25um.json
+"""
+
+import argparse
+import http.server
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import nibabel
+import numpy
+import nrrd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import abi_connectivity
+
+# (acronym, safe name) of injection sites, and specimen names, the latter including wild-type ones without a Cre line.
+STRUCTURES = [
+	("CP", "Caudoputamen"),
+	("MOp", "Primary motor area"),
+	("VTA", "Ventral tegmental area"),
+	("SSp-bfd", "Primary somatosensory area, barrel field"),
+	("ACAd", "Anterior cingulate area, dorsal part"),
+	]
+SPECIMENS = [
+	"Drd1a-Cre-299",
+	"Sst-IRES-Cre-166",
+	"Pvalb-IRES-Cre-307",
+	"Rbp4-Cre_KL100-412",
+	"C57BL/6J-183",
+	]
+
+
+def synthetic_rows(count):
+	"""Query rows in the layout of the `query.json` response."""
+	rows = []
+	for i in range(count):
+		acronym, safe_name = STRUCTURES[i % len(STRUCTURES)]
+		rows.append({
+			'id': 100000000 + i,
+			'failed': False,
+			'specimen': {
+				'id': 200000000 + i,
+				'name': SPECIMENS[(i // len(STRUCTURES)) % len(SPECIMENS)],
+				'stereotaxic_injections': [{
+					'id': 300000000 + i,
+					'injection_method': "iontophoresis",
+					'injection_quality': "good",
+					'primary_injection_structure': {'id': 400 + i % len(STRUCTURES), 'acronym': acronym, 'safe_name': safe_name, 'name': safe_name},
+					'structures': [],
+					}],
+				},
+			})
+	return rows
+
+
+def synthetic_projection_density(path, exp, resolution):
+	"""Write a smooth injection-like blob on the ABI CCF grid in PIR order, with the header of the real downloads."""
+	shape = tuple(int(round(s * 100 / resolution)) for s in abi_connectivity.ABI_GRID_100UM)
+	rng = numpy.random.default_rng(exp)
+	sigma = 1000 / resolution
+	profiles = [numpy.exp(-(numpy.arange(n, dtype=numpy.float32) - rng.uniform(0.25, 0.75) * n) ** 2 / (2 * sigma ** 2)) for n in shape]
+	data = rng.uniform(0.2, 1) * profiles[0][:, None, None] * profiles[1][None, :, None] * profiles[2][None, None, :]
+	data[data < 1e-4] = 0
+	header = {
+		'space': 'left-posterior-superior',
+		'space directions': numpy.eye(3) * resolution,
+		'space origin': numpy.zeros(3),
+		'kinds': ['domain', 'domain', 'domain'],
+		'encoding': 'gzip',
+		}
+	nrrd.write(path, data.astype(numpy.float32), header, compression_level=6)
+	return path
+
+
+def serve(rows, volumes, metadata, latency):
+	"""Start the API stand-in on a free local port, returning the server."""
+	rows_by_id = {row['id']: row for row in rows}
+
+	class Handler(http.server.BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def log_message(self, *args):
+			pass
+
+		def send(self, body, content_type, status=200, headers=()):
+			self.send_response(status)
+			self.send_header('Content-Type', content_type)
+			self.send_header('Content-Length', str(len(body)))
+			for key, value in headers:
+				self.send_header(key, value)
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			time.sleep(latency)
+			url = urllib.parse.urlsplit(self.path)
+			query = urllib.parse.parse_qs(url.query)
+			if url.path.endswith("/query.json"):
+				start = int(query.get('start_row', ['0'])[0])
+				num = int(query.get('num_rows', ['2000'])[0])
+				page = rows[start:start + num]
+				body = {'success': True, 'id': 0, 'start_row': start, 'num_rows': len(page), 'total_rows': len(rows), 'msg': page}
+				return self.send(json.dumps(body).encode(), 'application/json')
+			if url.path.endswith("/SectionDataSet/query.xml"):
+				exp = int(query['id'][0])
+				with open(metadata[exp], 'rb') as f:
+					return self.send(f.read(), 'text/xml')
+			m = re.match(r".*/grid_data/download_file/(\d+)$", url.path)
+			if m and int(m.group(1)) in rows_by_id:
+				exp = int(m.group(1))
+				with open(volumes[exp], 'rb') as f:
+					body = f.read()
+				etag = f'"{exp}-{len(body)}"'
+				headers = [
+					('Content-Disposition', f'attachment; filename={os.path.basename(volumes[exp])}'),
+					('ETag', etag),
+					('Last-Modified', "Mon, 01 Jan 2024 00:00:00 GMT"),
+					]
+				requested = re.match(r"bytes=(\d+)-$", self.headers.get('Range', ''))
+				if requested and self.headers.get('If-Range', etag) == etag:
+					offset = int(requested.group(1))
+					if offset >= len(body):
+						return self.send(b'', 'application/octet-stream', status=416)
+					headers.append(('Content-Range', f"bytes {offset}-{len(body) - 1}/{len(body)}"))
+					return self.send(body[offset:], 'application/octet-stream', status=206, headers=headers)
+				return self.send(body, 'application/octet-stream', headers=headers)
+			self.send(b'', 'text/plain', status=404)
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+def stand_in_processing(source_dir, procdata_dir):
+	"""Fill `procdata_dir` with converted but unregistered volumes, for the stages after `process_data`."""
+	for nrrd_dir in sorted(os.listdir(source_dir)):
+		nrrd_dir = os.path.join(source_dir, nrrd_dir)
+		if not os.path.isdir(nrrd_dir):
+			continue
+		nrrd_data, xml_data = abi_connectivity.find_experiment_files(nrrd_dir)
+		target_dir = os.path.join(procdata_dir, os.path.basename(nrrd_dir))
+		os.makedirs(target_dir, exist_ok=True)
+		img = abi_connectivity.nrrd_to_image(nrrd_data)
+		nibabel.save(img, os.path.join(target_dir, os.path.basename(nrrd_data).split(".")[0] + "_2dsurqec.nii.gz"))
+		shutil.copyfile(xml_data, os.path.join(target_dir, os.path.basename(xml_data)))
+
+
+def timed(results, stage, function, *args, **kwargs):
+	print(f"\n=== {stage} ===")
+	start = time.perf_counter()
+	value = function(*args, **kwargs)
+	results[stage] = time.perf_counter() - start
+	return value
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--experiments', '-n', type=int, default=8, help='Number of synthetic experiments.')
+	parser.add_argument('--resolution', '-x', type=int, choices=[100, 25], default=100, help='Resolution of the synthetic volumes, in microns.')
+	parser.add_argument('--jobs', '-j', type=int, default=1)
+	parser.add_argument('--page-size', type=int, default=2000, help='Rows per query page.')
+	parser.add_argument('--latency', type=float, default=0, help='Seconds the stand-in waits before answering each request.')
+	parser.add_argument('--per-experiment-metadata', action='store_true', help='Request the XML metadata of each experiment, instead of writing it from the query rows.')
+	parser.add_argument('--registration', type=str, choices=['ants', 'cached'], default='ants')
+	parser.add_argument('--template-dir', type=str, default=abi_connectivity.TEMPLATE_DIR, help='Directory holding the DSURQEC templates and composite transform.')
+	parser.add_argument('--scratch-dir', type=str, help='Defaults to the memory-backed scratch directory if it has room, as in `abi_connectivity.py`.')
+	parser.add_argument('--output', type=str, help='JSON file to write the stage timings to, for comparison between runs.')
+	parser.add_argument('--keep', action='store_true', help='Keep the working directory.')
+	args = parser.parse_args()
+
+	abi_connectivity.TEMPLATE_DIR = args.template_dir
+	reference = abi_connectivity.get_reference_image(args.resolution)[0]
+	transform = os.path.join(args.template_dir, abi_connectivity.COMPOSITE_TRANSFORM)
+	can_register = shutil.which("antsApplyTransforms") and os.path.isfile(reference) and os.path.isfile(transform)
+
+	workdir = tempfile.mkdtemp(prefix="pipeline-benchmark-", dir=".")
+	results = {}
+	try:
+		served_dir = os.path.join(workdir, "served")
+		os.makedirs(served_dir)
+		print(f"Generating {args.experiments} synthetic experiments at {args.resolution}um...")
+		rows = synthetic_rows(args.experiments)
+		volumes = {}
+		metadata = {}
+		for row in rows:
+			exp = row['id']
+			volumes[exp] = synthetic_projection_density(os.path.join(served_dir, f"11_wks_coronal_{exp}_{args.resolution}um_projection_density.nrrd"), exp, args.resolution)
+			metadata[exp] = abi_connectivity.write_exp_metadata(row, served_dir)
+		server = serve(rows, volumes, metadata, args.latency)
+		abi_connectivity.set_api_server(f"http://127.0.0.1:{server.server_address[1]}/")
+
+		source_dir = os.path.join(workdir, "sourcedata")
+		procdata_dir = os.path.join(workdir, "procdata")
+		bids_dir = os.path.join(workdir, "bids")
+		scratch_dir = tempfile.mkdtemp(prefix="pipeline-benchmark-", dir=args.scratch_dir or abi_connectivity.default_scratch_dir(abi_connectivity.scratch_bytes(args.resolution, args.jobs)))
+		os.makedirs(source_dir)
+		metrics_path = os.path.join(workdir, abi_connectivity.METRICS_FILENAME)
+		abi_connectivity.set_metrics_log(metrics_path)
+
+		rows_path = os.path.join(source_dir, abi_connectivity.QUERY_FILENAME)
+		info = timed(results, 'get_exp_id', abi_connectivity.get_exp_id, startRow=0, numRows=args.page_size, totalRows=-1, rows_path=rows_path, jobs=args.jobs)
+		query_rows = None if args.per_experiment_metadata else abi_connectivity.load_exp_rows(rows_path)
+		timed(results, 'get_sourcedata', abi_connectivity.get_sourcedata, info, source_dir, resolution=args.resolution, jobs=args.jobs, rows=query_rows)
+
+		def convert_all():
+			for nrrd_dir in sorted(os.listdir(source_dir)):
+				if os.path.isdir(os.path.join(source_dir, nrrd_dir)):
+					nii_path = abi_connectivity.nrrd_to_nifti(abi_connectivity.find_experiment_files(os.path.join(source_dir, nrrd_dir))[0], scratch_dir)
+					os.remove(nii_path)
+		timed(results, 'nrrd_to_nifti', convert_all)
+
+		if can_register:
+			failures = timed(results, 'process_data', abi_connectivity.process_data, source_dir, procdata_dir, resolution=args.resolution, jobs=args.jobs, scratch_dir=scratch_dir, registration=args.registration, cache_dir=os.path.join(workdir, "cache"))
+			if failures:
+				raise RuntimeError(f"Processing failed for {len(failures)} experiments.")
+		else:
+			print(f"\nNo ANTs or no templates in `{args.template_dir}`, skipping `process_data` and using unregistered volumes.")
+			stand_in_processing(source_dir, procdata_dir)
+
+		timed(results, 'bids_rename', abi_connectivity.bids_rename, procdata_dir, bids_dir)
+		timed(results, 'create_archive', abi_connectivity.create_archive, os.path.join(workdir, "benchmark.tar.xz"), bids_dir, arcname="benchmark", jobs=args.jobs)
+		shutil.rmtree(scratch_dir)
+		server.shutdown()
+
+		print()
+		abi_connectivity.summarize_metrics(metrics_path)
+	finally:
+		if args.keep:
+			print(f"Kept `{workdir}`.")
+		else:
+			shutil.rmtree(workdir)
+
+	print(f"\n{args.experiments} experiments at {args.resolution}um, {args.jobs} jobs, {args.latency} s latency:")
+	print(f"{'stage':<16}{'wall time [s]':>16}{'per experiment [s]':>21}")
+	for stage, elapsed in results.items():
+		print(f"{stage:<16}{elapsed:>16.3f}{elapsed / args.experiments:>21.3f}")
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({
+				'experiments': args.experiments,
+				'resolution': args.resolution,
+				'jobs': args.jobs,
+				'latency': args.latency,
+				'registered': bool(can_register),
+				'seconds': results,
+				}, f, indent=1)
+
+
+if __name__ == "__main__":
+	main()
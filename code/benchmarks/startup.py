@@ -0,0 +1,99 @@
+"""
+Benchmark the startup time of `abi_connectivity.py` for invocations which need no processing stage.
+
+`--help` and `--bids-only` (on a small synthetic processed data tree) are run repeatedly in fresh interpreters, and each run is timed from process start to exit.
+The modules imported by each invocation are recorded with `-X importtime`, and the script exits non-zero if any of the heavy dependencies only needed for conversion, registration or the HDF5 matrix (nibabel, nrrd, scipy, h5py, nipype) is imported, or if the median run time exceeds `--limit`.
+
+Usage:
+	python code/benchmarks/startup.py --runs 10
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import abi_connectivity
+from pipeline import synthetic_rows
+
+SCRIPT = os.path.abspath(abi_connectivity.__file__)
+HEAVY_MODULES = ("nibabel", "nrrd", "scipy", "h5py", "nipype")
+
+
+def synthetic_procdata(procdata_dir, count):
+	"""Write experiment directories as `process_data` leaves them, with tiny volumes, since only the startup is of interest."""
+	for row in synthetic_rows(count):
+		safe_name = abi_connectivity.get_safe_name(row).lower().replace(" ", "_")
+		target_dir = os.path.join(procdata_dir, f"{safe_name}-{row['id']}")
+		os.makedirs(target_dir)
+		abi_connectivity.write_exp_metadata(row, target_dir)
+		img = nibabel.Nifti1Image(numpy.zeros((4, 4, 4), dtype=numpy.float32), numpy.eye(4))
+		nibabel.save(img, os.path.join(target_dir, f"11_wks_coronal_{row['id']}_100um_projection_density_2dsurqec.nii.gz"))
+
+
+def imported_modules(importtime):
+	"""Top-level package names listed in `-X importtime` output."""
+	modules = set()
+	for line in importtime.splitlines():
+		if line.startswith("import time:") and "|" in line:
+			modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+	return modules
+
+
+def run(arguments, cwd, runs):
+	"""Run the script `runs` times, returning the wall times and the heavy modules imported."""
+	command = [sys.executable, SCRIPT] + arguments
+	times = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+		times.append(time.perf_counter() - start)
+	result = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+	return times, sorted(imported_modules(result.stderr).intersection(HEAVY_MODULES))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--runs', '-n', type=int, default=5, help='Number of timed runs per invocation.')
+	parser.add_argument('--experiments', type=int, default=8, help='Number of synthetic processed experiments for `--bids-only`.')
+	parser.add_argument('--limit', type=float, default=1.0, help='Median seconds per invocation above which the benchmark fails.')
+	parser.add_argument('--keep', action='store_true', help='Keep the working directory.')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix="startup-benchmark-", dir=".")
+	results = {}
+	try:
+		synthetic_procdata(os.path.join(workdir, "procdata"), args.experiments)
+		invocations = {
+			'--help': ['--help'],
+			'--bids-only': ['--bids-only', '--link-mode', 'symlink', '--metrics-log', '', '--http-cache-size', '0'],
+			}
+		for name, arguments in invocations.items():
+			results[name] = run(arguments, workdir, args.runs)
+	finally:
+		if args.keep:
+			print(f"Kept `{workdir}`.")
+		else:
+			shutil.rmtree(workdir)
+
+	failed = False
+	print(f"{'invocation':<14}{'median [s]':>12}{'max [s]':>10}  heavy imports")
+	for name, (times, heavy) in results.items():
+		median = statistics.median(times)
+		ok = median <= args.limit and not heavy
+		failed = failed or not ok
+		print(f"{name:<14}{median:>12.3f}{max(times):>10.3f}  {', '.join(heavy) or '-'} {'✔️' if ok else '❌'}")
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
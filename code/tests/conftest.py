@@ -0,0 +1,173 @@
+"""
+Fixtures shared by the tests: a synthetic NRRD writer and a local stand-in for the ABI API.
+"""
+
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+
+import numpy
+import nrrd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import abi_connectivity
+
+
+def synthetic_nrrd(path,
+	shape=(6, 4, 5),
+	encoding='raw',
+	endian='little',
+	seed=0,
+	):
+	"""Write a small projection density volume with the header fields of the ABI downloads, and return its data."""
+	data = numpy.random.default_rng(seed).random(shape, dtype=numpy.float32)
+	header = {
+		'space': 'left-posterior-superior',
+		'space directions': numpy.eye(3) * 100,
+		'encoding': encoding,
+		'endian': endian,
+		}
+	nrrd.write(path, data, header)
+	return data
+
+
+def synthetic_row(exp, seed='CP', cre="Drd1a-Cre"):
+	"""Query row of an experiment, as returned by `get_exp_id`."""
+	return {
+		'id': exp,
+		'failed': False,
+		'specimen': {
+			'id': exp + 1,
+			'name': f"{cre}-{exp}",
+			'stereotaxic_injections': [{
+				'id': exp + 2,
+				'injection_method': "iontophoresis",
+				'injection_quality': "3",
+				'primary_injection_structure': {'id': 672, 'acronym': seed, 'safe_name': f"Structure {seed}"},
+				'structures': [],
+				}],
+			},
+		}
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+	"""
+	Serves query rows, NRRD volumes by experiment ID and the structure graph, like api.brain-map.org.
+
+	Volumes honour `Range` and `If-Range`, and answer `If-None-Match` with their ETag by `304 Not Modified`.
+	`truncate` maps experiment IDs to the number of bytes after which the next response for them is cut off, and `requests` logs the path and headers of every request.
+	"""
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), StandInHandler)
+		self.rows = []
+		self.volumes = {}
+		self.truncate = {}
+		self.requests = []
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self.server_address[1]}/"
+
+	def volume_requests(self, exp=None):
+		return [(path, headers) for path, headers in self.requests if "grid_data" in path and (exp is None or f"/{exp}?" in path)]
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def send(self, body,
+		status=200,
+		headers=(),
+		):
+		self.send_response(status)
+		self.send_header('Content-Length', str(len(body)))
+		for key, value in headers:
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		server = self.server
+		server.requests.append((self.path, dict(self.headers)))
+		url = urllib.parse.urlsplit(self.path)
+		query = urllib.parse.parse_qs(url.query)
+		if url.path.endswith("query.json"):
+			start = int(query.get('start_row', ['0'])[0])
+			count = int(query.get('num_rows', ['2000'])[0])
+			rows = server.rows[start:start + count]
+			body = json.dumps({'success': True, 'start_row': start, 'num_rows': len(rows), 'total_rows': len(server.rows), 'msg': rows}).encode()
+			return self.send(body, headers=[('Content-Type', 'application/json')])
+		if "structure_graph_download" in url.path:
+			return self.send(b'{"msg": []}' if url.path.endswith(".json") else b'<Response/>')
+		m = re.match(r".*/grid_data/download_file/(\d+)$", url.path)
+		if not m or int(m.group(1)) not in server.volumes:
+			return self.send(b'', status=404)
+		exp = int(m.group(1))
+		body = server.volumes[exp]
+		etag = f'"{exp}-{len(body)}"'
+		headers = [('ETag', etag), ('Content-Disposition', f"attachment; filename=11_wks_coronal_{exp}_100um_projection_density.nrrd")]
+		if self.headers.get('If-None-Match') == etag:
+			return self.send(b'', status=304, headers=[('ETag', etag)])
+		start = 0
+		range_header = self.headers.get('Range')
+		if range_header and self.headers.get('If-Range', etag) == etag:
+			start = int(range_header.split("=")[1].split("-")[0])
+			headers.append(('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}"))
+		self.send_response(206 if start else 200)
+		self.send_header('Content-Length', str(len(body) - start))
+		for key, value in headers:
+			self.send_header(key, value)
+		self.end_headers()
+		cut = server.truncate.pop(exp, None)
+		if cut is not None:
+			self.wfile.write(body[start:start + cut])
+			self.close_connection = True
+			return
+		self.wfile.write(body[start:])
+
+
+@pytest.fixture(autouse=True)
+def module_state():
+	"""Restore the module-level settings of `abi_connectivity` which tests change."""
+	names = ('API_SERVER', 'API_DATA_PATH', 'TEMPLATE_DIR', 'SCRATCH_DIR', 'SHARD', 'HTTP_CACHE_DIR', 'HTTP_CACHE_SIZE', 'OFFLINE')
+	saved = {name: getattr(abi_connectivity, name) for name in names}
+	yield
+	for name, value in saved.items():
+		setattr(abi_connectivity, name, value)
+	abi_connectivity._http_cache_used = None
+	abi_connectivity._connections.__dict__.clear()
+
+
+@pytest.fixture
+def api_server(tmp_path):
+	"""Start a `StandIn` server and point `abi_connectivity` at it."""
+	server = StandIn()
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	abi_connectivity.set_api_server(server.url)
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def add_experiment(server, exp, directory,
+	seed=0,
+	**row,
+	):
+	"""Serve a synthetic experiment, returning the bytes of its volume."""
+	path = os.path.join(directory, f"{exp}.nrrd")
+	synthetic_nrrd(path, encoding='gzip', seed=seed)
+	with open(path, 'rb') as f:
+		server.volumes[exp] = f.read()
+	server.rows.append(synthetic_row(exp, **row))
+	return server.volumes[exp]
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+import abi_connectivity
+from conftest import add_experiment
+
+
+def volume_url(server, exp):
+	return f"{server.url}grid_data/download_file/{exp}?image=projection_density&resolution=100"
+
+
+def test_download_resumes_partial_file(api_server, tmp_path):
+	body = add_experiment(api_server, 101, tmp_path)
+	path = tmp_path / "101.nrrd.part"
+	path.write_bytes(body[:100])
+
+	headers, checksum = abi_connectivity.download_with_retry(volume_url(api_server, 101), str(path), validator=f'"101-{len(body)}"')
+
+	assert path.read_bytes() == body
+	assert checksum == hashlib.sha256(body).hexdigest()
+	_, request_headers = api_server.volume_requests(101)[-1]
+	assert request_headers['Range'] == "bytes=100-"
+
+
+def test_interrupted_download_is_resumed(api_server, tmp_path):
+	body = add_experiment(api_server, 102, tmp_path)
+	api_server.truncate[102] = 200
+	path = tmp_path / "102.nrrd.part"
+
+	_, checksum = abi_connectivity.download_with_retry(volume_url(api_server, 102), str(path), backoff=0)
+
+	assert path.read_bytes() == body
+	assert checksum == hashlib.sha256(body).hexdigest()
+	assert [headers.get('Range') for _, headers in api_server.volume_requests(102)] == [None, "bytes=200-"]
+
+
+def test_changed_upstream_file_is_downloaded_afresh(api_server, tmp_path):
+	body = add_experiment(api_server, 103, tmp_path)
+	path = tmp_path / "103.nrrd.part"
+	path.write_bytes(b"NRRD0004 stale partial file")
+
+	abi_connectivity.download_with_retry(volume_url(api_server, 103), str(path), validator='"outdated"')
+
+	assert path.read_bytes() == body
+
+
+def test_sourcedata_sync_uses_manifest(api_server, tmp_path):
+	bodies = {exp: add_experiment(api_server, exp, tmp_path, seed=exp) for exp in (201, 202)}
+	source_dir = tmp_path / "sourcedata"
+	source_dir.mkdir()
+	rows = {row['id']: row for row in api_server.rows}
+
+	assert abi_connectivity.get_sourcedata(list(bodies), str(source_dir), rows=rows) == {}
+	manifest = abi_connectivity.load_manifest(str(source_dir / abi_connectivity.MANIFEST_FILENAME))
+	assert {key: entry['status'] for key, entry in manifest.items()} == {'201': 'complete', '202': 'complete'}
+	assert manifest['201']['sha256'] == hashlib.sha256(bodies[201]).hexdigest()
+
+	# Nothing is downloaded again, unless it went missing.
+	api_server.requests.clear()
+	os.remove(source_dir / manifest['202']['directory'] / manifest['202']['filename'])
+	assert abi_connectivity.get_sourcedata(list(bodies), str(source_dir), rows=rows) == {}
+	assert [path for path, _ in api_server.volume_requests()] == [volume_url(api_server, 202)[len(api_server.url) - 1:]]
+	assert (source_dir / manifest['202']['directory'] / manifest['202']['filename']).read_bytes() == bodies[202]
+
+
+def test_failed_download_is_recorded(api_server, tmp_path):
+	add_experiment(api_server, 301, tmp_path)
+	source_dir = tmp_path / "sourcedata"
+	source_dir.mkdir()
+	rows = {row['id']: row for row in api_server.rows}
+	rows[302] = dict(rows[301], id=302)
+
+	failures = abi_connectivity.get_sourcedata([301, 302], str(source_dir), rows=rows, retry_passes=0)
+
+	assert list(failures) == [302]
+	with open(source_dir / abi_connectivity.MANIFEST_FILENAME) as f:
+		manifest = {entry['id']: entry for entry in map(json.loads, f)}
+	assert manifest[301]['status'] == 'complete'
+	assert manifest[302]['status'] == 'failed'
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import abi_connectivity
+from conftest import add_experiment
+
+
+def volume_url(server, exp):
+	return f"{server.url}grid_data/download_file/{exp}?image=projection_density&resolution=100"
+
+
+def test_cached_download_is_revalidated(api_server, tmp_path):
+	body = add_experiment(api_server, 401, tmp_path)
+	abi_connectivity.set_http_cache(str(tmp_path / "cache"))
+	url = volume_url(api_server, 401)
+
+	_, checksum = abi_connectivity.cached_download(url, str(tmp_path / "first.nrrd"))
+	_, cached_checksum = abi_connectivity.cached_download(url, str(tmp_path / "second.nrrd"))
+
+	assert cached_checksum == checksum
+	assert (tmp_path / "second.nrrd").read_bytes() == body
+	# The second request was answered by `304 Not Modified`, and both downloads link to the cached content.
+	_, headers = api_server.volume_requests(401)[-1]
+	assert headers['If-None-Match'] == f'"401-{len(body)}"'
+	blob = abi_connectivity._blob_path(checksum)
+	assert os.path.samefile(tmp_path / "first.nrrd", blob)
+	assert os.path.samefile(tmp_path / "second.nrrd", blob)
+
+
+def test_offline_mode_serves_cache(api_server, tmp_path):
+	body = add_experiment(api_server, 402, tmp_path)
+	url = volume_url(api_server, 402)
+	query_url = f"{api_server.url}api/v2/data/query.json?num_rows=1"
+	abi_connectivity.set_http_cache(str(tmp_path / "cache"))
+	abi_connectivity.cached_download(url, str(tmp_path / "online.nrrd"))
+	query = abi_connectivity.fetch_url(query_url)
+
+	abi_connectivity.set_http_cache(str(tmp_path / "cache"), offline=True)
+	api_server.requests.clear()
+
+	abi_connectivity.cached_download(url, str(tmp_path / "offline.nrrd"))
+	assert (tmp_path / "offline.nrrd").read_bytes() == body
+	assert abi_connectivity.fetch_url(query_url) == query
+	assert api_server.requests == []
+	with pytest.raises(LookupError):
+		abi_connectivity.fetch_url(f"{api_server.url}api/v2/data/query.json?num_rows=2")
+	with pytest.raises(LookupError):
+		abi_connectivity.cached_download(volume_url(api_server, 403), str(tmp_path / "missing.nrrd"))
+
+
+def test_evicted_content_is_downloaded_again(api_server, tmp_path):
+	body = add_experiment(api_server, 404, tmp_path)
+	url = volume_url(api_server, 404)
+	abi_connectivity.set_http_cache(str(tmp_path / "cache"))
+	_, checksum = abi_connectivity.cached_download(url, str(tmp_path / "volume.nrrd"))
+
+	abi_connectivity.http_cache_evict(url)
+
+	assert not os.path.exists(abi_connectivity._blob_path(checksum))
+	assert abi_connectivity.http_cache_lookup(url) is None
+	# The downloaded copy is left alone.
+	assert (tmp_path / "volume.nrrd").read_bytes() == body
+	api_server.requests.clear()
+	abi_connectivity.cached_download(url, str(tmp_path / "again.nrrd"))
+	assert (tmp_path / "again.nrrd").read_bytes() == body
+	assert 'If-None-Match' not in api_server.volume_requests(404)[-1][1]
+
+
+@pytest.mark.parametrize('link_mode', ['copy', 'hardlink', 'symlink', 'reflink'])
+def test_materialize(tmp_path, link_mode):
+	source = tmp_path / "source.nii.gz"
+	source.write_bytes(b"registered volume")
+	target = tmp_path / "bids" / "target.nii.gz"
+	target.parent.mkdir()
+
+	assert abi_connectivity.materialize(str(source), str(target), link_mode=link_mode)
+
+	assert target.read_bytes() == source.read_bytes()
+	assert target.is_symlink() == (link_mode == 'symlink')
+	if link_mode == 'hardlink':
+		assert os.path.samefile(source, target)
+	# Up to date targets are left untouched.
+	assert not abi_connectivity.materialize(str(source), str(target), link_mode=link_mode)
+	# Replaced sources are materialized again, except by symbolic links, which follow them anyway.
+	(tmp_path / "reprocessed.nii.gz").write_bytes(b"registered volume, reprocessed")
+	os.replace(tmp_path / "reprocessed.nii.gz", source)
+	assert abi_connectivity.materialize(str(source), str(target), link_mode=link_mode) == (link_mode != 'symlink')
+	assert target.read_bytes() == source.read_bytes()
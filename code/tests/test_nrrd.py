@@ -0,0 +1,45 @@
+import nibabel
+import numpy
+import pytest
+
+import abi_connectivity
+from conftest import synthetic_nrrd
+
+
+def legacy_orientation(data):
+	"""PIR to RAS reorientation as done by the swapaxes/reverse implementation `nrrd_to_nifti` replaced."""
+	data = numpy.swapaxes(data, 0, 2)
+	data = numpy.swapaxes(data, 1, 2)
+	return data[::-1, ::-1, ::-1]
+
+
+@pytest.mark.parametrize('encoding, endian', [('raw', 'little'), ('raw', 'big'), ('gzip', 'little')])
+def test_conversion_is_voxel_identical(tmp_path, encoding, endian):
+	data = synthetic_nrrd(str(tmp_path / "projection_density.nrrd"), encoding=encoding, endian=endian)
+
+	nii_path = abi_connectivity.nrrd_to_nifti(str(tmp_path / "projection_density.nrrd"), str(tmp_path / "nifti"))
+
+	img = nibabel.load(nii_path)
+	expected = legacy_orientation(data)
+	assert img.shape == expected.shape
+	numpy.testing.assert_array_equal(numpy.asanyarray(img.dataobj), expected)
+	# The header stores the affine in single precision.
+	numpy.testing.assert_allclose(img.affine, numpy.diag([0.1, 0.1, 0.1, 1]), rtol=1e-6)
+
+
+def test_raw_data_is_memory_mapped(tmp_path):
+	data = synthetic_nrrd(str(tmp_path / "projection_density.nrrd"))
+
+	mapped, _ = abi_connectivity.read_nrrd(str(tmp_path / "projection_density.nrrd"))
+
+	assert isinstance(mapped, numpy.memmap)
+	numpy.testing.assert_array_equal(mapped, data)
+
+
+def test_nrrd_dtype():
+	assert abi_connectivity.nrrd_dtype({'type': 'float', 'endian': 'big'}) == numpy.dtype('>f4')
+	assert abi_connectivity.nrrd_dtype({'type': 'unsigned short', 'endian': 'little'}) == numpy.dtype('<u2')
+	assert abi_connectivity.nrrd_dtype({'type': 'uchar'}) == numpy.dtype('u1')
+	assert abi_connectivity.nrrd_dtype({'type': 'block'}) is None
+	with pytest.raises(ValueError):
+		abi_connectivity.nrrd_dtype({'type': 'float'})
@@ -0,0 +1,132 @@
+import gzip
+import os
+
+import nibabel
+import numpy
+import pytest
+
+import abi_connectivity
+from conftest import synthetic_nrrd
+
+
+def worker_settings():
+	return abi_connectivity.TEMPLATE_DIR, abi_connectivity._metrics_path
+
+
+def test_workers_take_over_settings(tmp_path):
+	abi_connectivity.TEMPLATE_DIR = str(tmp_path)
+	with abi_connectivity.process_pool(1) as pool:
+		assert pool.submit(worker_settings).result() == (str(tmp_path), None)
+
+
+@pytest.fixture
+def identity_registration(tmp_path, monkeypatch):
+	"""
+	Register synthetic experiments to a template with their own grid, by an identity sampling map and a stand-in for ANTs which adds `perturbation` to its output.
+	"""
+	nrrd_dir = tmp_path / "sourcedata" / "structure_1-501"
+	nrrd_dir.mkdir(parents=True)
+	synthetic_nrrd(str(nrrd_dir / "11_wks_coronal_501_100um_projection_density.nrrd"))
+	(nrrd_dir / "11_wks_coronal_501.xml").write_text("<Response/>")
+	img = abi_connectivity.nrrd_to_image(str(nrrd_dir / "11_wks_coronal_501_100um_projection_density.nrrd"))
+	template_dir = tmp_path / "template"
+	template_dir.mkdir()
+	nibabel.save(nibabel.Nifti1Image(numpy.zeros(img.shape, dtype=numpy.float32), img.affine), str(template_dir / "dsurqec_200micron_masked.nii"))
+	(template_dir / abi_connectivity.COMPOSITE_TRANSFORM).write_bytes(b"identity")
+	abi_connectivity.TEMPLATE_DIR = str(template_dir)
+
+	def load_sampling_map(img, ref_image, **kwargs):
+		shape = img.shape[:3]
+		return numpy.arange(numpy.prod(shape)), numpy.indices(shape, dtype=numpy.float32).reshape(3, -1)
+
+	def apply_composite(file, resolution, num_threads=None, output_dir=None, compressed=True):
+		source = nibabel.load(file)
+		registered = numpy.asanyarray(source.dataobj, dtype=numpy.float32) + apply_composite.perturbation
+		output_image = os.path.join(output_dir, abi_connectivity.registered_name(file, 200, compressed=compressed))
+		nibabel.save(nibabel.Nifti1Image(registered, source.affine), output_image)
+		return output_image
+
+	apply_composite.perturbation = numpy.zeros(img.shape, dtype=numpy.float32)
+	monkeypatch.setattr(abi_connectivity, 'load_sampling_map', load_sampling_map)
+	monkeypatch.setattr(abi_connectivity, 'apply_composite', apply_composite)
+	return str(nrrd_dir), img, apply_composite
+
+
+def test_cached_registration_is_validated(tmp_path, identity_registration):
+	nrrd_dir, img, _ = identity_registration
+
+	registered = abi_connectivity.process_experiment(nrrd_dir, str(tmp_path / "procdata"), registration='cached', cache_dir=str(tmp_path / "cache"), scratch_dir=str(tmp_path), validate_tolerance=1e-4)
+
+	numpy.testing.assert_allclose(numpy.asanyarray(nibabel.load(registered).dataobj), numpy.asanyarray(img.dataobj), atol=1e-5)
+
+
+def test_deviating_cached_registration_fails_validation(tmp_path, identity_registration):
+	nrrd_dir, _, apply_composite = identity_registration
+	apply_composite.perturbation.flat[7] = 1.0
+
+	with pytest.raises(ValueError, match="deviates from ANTs"):
+		abi_connectivity.process_experiment(nrrd_dir, str(tmp_path / "procdata"), registration='cached', cache_dir=str(tmp_path / "cache"), scratch_dir=str(tmp_path), validate_tolerance=1e-4)
+
+
+def write_volume(path, data):
+	nibabel.save(nibabel.Nifti1Image(data, numpy.diag([0.2, 0.2, 0.2, 1])), str(path))
+	return str(path)
+
+
+def test_float32_encoding_is_lossless(tmp_path):
+	data = numpy.random.default_rng(0).normal(size=(7, 6, 5)).astype(numpy.float32)
+	source = write_volume(tmp_path / "registered.nii", data)
+
+	record = abi_connectivity.encode_volume(source, str(tmp_path / "registered.nii.gz"))
+
+	assert record == {'dtype': 'float32', 'compression_level': 6}
+	numpy.testing.assert_array_equal(numpy.asanyarray(nibabel.load(str(tmp_path / "registered.nii.gz")).dataobj), data)
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'int16'])
+def test_integer_encoding(tmp_path, dtype):
+	data = numpy.random.default_rng(1).uniform(-0.05, 0.8, size=(7, 6, 5)).astype(numpy.float32)
+	data[::2] = 0
+	source = write_volume(tmp_path / "registered.nii", data)
+
+	record = abi_connectivity.encode_volume(source, str(tmp_path / "registered.nii.gz"), {'dtype': dtype})
+
+	img = nibabel.load(str(tmp_path / "registered.nii.gz"))
+	assert img.get_data_dtype() == numpy.dtype(dtype)
+	decoded = img.get_fdata(dtype=numpy.float32)
+	# Zero stays exact, and every value is within half a quantization step.
+	assert (decoded[::2] == 0).all()
+	error = numpy.abs(decoded - data).max()
+	assert error <= record['scl_slope'] / 2 * (1 + 1e-3)
+	assert error == pytest.approx(record['quantization_error'], rel=1e-3)
+
+
+def test_quantization_error_beyond_maximum_fails(tmp_path):
+	source = write_volume(tmp_path / "registered.nii", numpy.random.default_rng(2).random((7, 6, 5), dtype=numpy.float32))
+
+	with pytest.raises(ValueError, match="exceeding the maximum"):
+		abi_connectivity.encode_volume(source, str(tmp_path / "registered.nii.gz"), {'dtype': 'uint16', 'max_error': 1e-9})
+	assert not os.path.exists(tmp_path / "registered.nii.gz")
+
+
+@pytest.mark.parametrize('block_size', [1, 1000, 64 * 1024])
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_parallel_gzip_round_trip(tmp_path, block_size, jobs):
+	rng = numpy.random.default_rng(3)
+	data = rng.bytes(50000) + bytes(100000) + rng.integers(0, 4, 50000, dtype=numpy.uint8).tobytes()
+
+	with open(tmp_path / "data.gz", 'wb') as handle:
+		writer = abi_connectivity._ParallelGzipWriter(handle, jobs, 6, block_size=block_size)
+		for start in range(0, len(data), 7777):
+			writer.write(data[start:start + 7777])
+		assert writer.tell() == len(data)
+		writer.close()
+
+	assert gzip.decompress((tmp_path / "data.gz").read_bytes()) == data
+
+
+def test_parallel_gzip_empty(tmp_path):
+	with open(tmp_path / "empty.gz", 'wb') as handle:
+		abi_connectivity._ParallelGzipWriter(handle, 2, 6).close()
+
+	assert gzip.decompress((tmp_path / "empty.gz").read_bytes()) == b''